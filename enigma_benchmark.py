@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+"""
+Benchmarks the pipeline stages on synthetic data, keeping a history of the timings.
+
+Usage:
+  enigma_benchmark.py run [options] <workdir>
+  enigma_benchmark.py show [options] <history>
+
+Arguments:
+    <workdir>          Where to write the synthetic data (it is reused between runs)
+    <history>          A benchmark history file (ex. <workdir>/benchmark_history.json)
+
+Options:
+  --sizes LIST             Comma separated cohort sizes for the group stages (default = 10,100,1000)
+  --images N               Number of subjects the per image stages are timed on (default = 10)
+  --stages LIST            Comma separated stages to run (default = all of them, see below)
+  --history FILE           The history to add the results to (default = <workdir>/benchmark_history.json)
+  --label STR              Label for this run (default = the git commit of this repo)
+  --tolerance F            Flag stages more than this fraction slower than the last run (default = 0.25)
+  --check                  Exit with an error if a stage got slower than the tolerance
+  --last N                 Number of runs to show (default = 10)
+  -v,--verbose             Verbose logging
+  --debug                  Debug logging in Erin's very verbose style
+
+DETAILS
+"run" makes synthetic subjects in the ENIGMA template space (FA maps, skeletons
+and their ROI tables, made from the ENIGMA templates with random noise, always
+with the same seed) and times the stages:
+
+  skeleton_index  building the skeleton/atlas index (once, from an empty cache)
+  extract         enigma_roi.extract_roi for each subject (per image)
+  average         enigma_roi.average_subject_tracts for each subject
+  concat          run_group_enigma_concat.py on the whole cohort
+  qc_images       run_group_qc_enigma.render_pic (and the subject page) for each subject (per image)
+  qc_images_numpy the same, with the numpy QC renderer (see enigma_qc.py)
+  qc_index        run_group_qc_index.py and run_group_qc_enigma.build_index on the whole cohort
+  participant     run_participant_enigma_extract.py --calc-all for each subject (per image)
+  participant_rerun the same again, where every step is up to date (an error if any step is rerun)
+
+The group stages (average, concat, qc_index) are run for every cohort size
+(from 10 up to 10000 subjects). The per image stages are run once, on the
+first "--images" subjects, and are reported per subject. The data of each
+cohort size is made once and kept in <workdir>/cohort-<size>.
+
+FSL is not needed. The participant stage puts stand-ins for the FSL tools
+(tbss_2_reg, tbss_3_postreg, tbss_skeleton, fslmaths, applywarp and
+fslreorient2std) first on the PATH. They copy or mask their inputs, so the
+stage times this repos own code (preprocessing, skeleton projection, ROI
+extraction, QC images and step records) and not the registration.
+
+Each run is added to the history (a JSON list) with the label, date, host and
+python/numpy versions. Every stage is compared to the last run in the history
+from the same host, and the ones that got slower by more than "--tolerance"
+are flagged ("--check" makes that an error, ex. for a test job).
+Differences of less than 0.1 seconds are not flagged.
+"show" prints the seconds of each stage for the last runs in a history.
+
+This is a benchmark, not a test - it checks how long things take, not their results.
+"""
+from docopt import docopt
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import json
+import os
+import platform
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import time
+import enigma_roi
+import enigma_trace
+
+DEBUG = False
+VERBOSE = False
+
+ENIGMAREPO = os.path.dirname(os.path.realpath(__file__))
+
+STAGES = ['skeleton_index', 'extract', 'average', 'concat', 'qc_images', 'qc_images_numpy', 'qc_index', 'participant', 'participant_rerun']
+
+## bump this when the synthetic data changes (so cached cohorts are made again)
+DATA_VERSION = 1
+SEED = 2015
+
+## stages less than this many seconds slower are not flagged (timer noise)
+MIN_SLOWDOWN = 0.1
+
+## stand-ins for the FSL tools the participant pipeline calls (see DETAILS)
+FSL_STUBS = {
+'tbss_2_reg': '''
+import glob, os, shutil, sys
+## tbss_2_reg -t <target>: the "warp" is a copy of the FA map
+os.chdir('FA')
+shutil.copy(sys.argv[sys.argv.index('-t') + 1], 'target.nii.gz')
+for fa in glob.glob('*_FA.nii.gz'):
+    shutil.copy(fa, fa.replace('.nii.gz', '_to_target_warp.nii.gz'))
+''',
+'tbss_3_postreg': '''
+import glob, os, shutil
+## the synthetic FA maps are already in template space
+os.chdir('FA')
+for fa in glob.glob('*_FA.nii.gz'):
+    shutil.copy(fa, fa.replace('.nii.gz', '_to_target.nii.gz'))
+''',
+'tbss_skeleton': '''
+import sys
+import nibabel as nib
+import numpy as np
+## project by masking with the skeleton mask (the -a data if given)
+args = sys.argv[1:]
+if '-a' in args:
+    data, output = args[args.index('-a') + 1], args[args.index('-a') - 1]
+else:
+    data, output = args[-2], args[-1]
+skeleton = np.asanyarray(nib.load(args[args.index('-s') + 1]).dataobj) > 0
+img = nib.load(data)
+values = np.asanyarray(img.dataobj).astype(np.float32)
+values[~skeleton] = 0
+nib.save(nib.Nifti1Image(values, img.affine), output)
+''',
+'fslmaths': '''
+import shutil, sys
+import nibabel as nib
+import numpy as np
+args = sys.argv[1:]
+if '-mas' in args:
+    img = nib.load(args[0])
+    mask = np.asanyarray(nib.load(args[args.index('-mas') + 1]).dataobj) > 0
+    nib.save(nib.Nifti1Image(np.asanyarray(img.dataobj) * mask, img.affine), args[args.index('-mas') + 2])
+else:
+    output = args[args.index('-odt') - 1] if '-odt' in args else args[-1]
+    if output != args[0]:
+        shutil.copy(args[0], output)
+''',
+'applywarp': '''
+import shutil, sys
+shutil.copy(sys.argv[sys.argv.index('-i') + 1], sys.argv[sys.argv.index('-o') + 1])
+''',
+'fslreorient2std': '''
+import shutil, sys
+shutil.copy(sys.argv[1], sys.argv[2])
+''',
+}
+
+def enigma_paths():
+    '''
+    the ENIGMA templates (ENIGMAHOME, or the enigmaDTI folder of this repo) and ROI files
+    '''
+    ENIGMAHOME = os.getenv('ENIGMAHOME')
+    if ENIGMAHOME == None:
+        ENIGMAHOME = os.path.join(ENIGMAREPO, 'enigmaDTI')
+        ENIGMAROI = os.path.join(ENIGMAREPO, 'ROIextraction_info')
+    else:
+        ENIGMAROI = ENIGMAHOME
+    return {'template': os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA.nii.gz'),
+            'mask': os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA_mask.nii.gz'),
+            'skeleton': os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA_skeleton.nii.gz'),
+            'skeleton_mask': os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA_skeleton_mask.nii.gz'),
+            'lookup_table': os.path.join(ENIGMAROI, 'ENIGMA_look_up_table.txt'),
+            'atlas': os.path.join(ENIGMAROI, 'JHU-WhiteMatter-labels-1mm.nii.gz')}
+
+def subject_id(i):
+    return 'sub-{:05d}'.format(i)
+
+def synthetic_FA(template, mask, rng):
+    '''
+    a subjects FA map: the template FA times (1 + 5% noise) inside the brain mask
+    '''
+    FA = template * (1 + 0.05 * rng.standard_normal(template.shape, dtype = np.float32))
+    return np.clip(FA, 0, 1) * mask
+
+def write_volume(data, affine, path):
+    nib.save(nib.Nifti1Image(data.astype(np.float32), affine), path)
+
+def make_cohort(cohortdir, size, images, paths):
+    '''
+    make (or reuse) the synthetic cohort in cohortdir:
+    <subject>/FA/<subject>_FAskel.nii.gz and _FA_to_target.nii.gz for the first images subjects,
+    <subject>/ROI/<subject>_FAskel_ROIout.csv and _ROIout_avg.csv for every subject,
+    and a placeholder QC image for every subject (for the index pages)
+    '''
+    marker = os.path.join(cohortdir, '.benchmark_data.json')
+    settings = {'version': DATA_VERSION, 'seed': SEED, 'size': size, 'images': images}
+    if os.path.isfile(marker):
+        with open(marker, 'r') as f:
+            if json.load(f) == settings:
+                return
+    print("Making a synthetic cohort of {} subjects in {}".format(size, cohortdir))
+    if os.path.isdir(cohortdir):
+        shutil.rmtree(cohortdir)
+    rng = np.random.default_rng(SEED)
+    template_img = nib.load(paths['template'])
+    template = np.asanyarray(template_img.dataobj).astype(np.float32)
+    mask = np.asanyarray(nib.load(paths['mask']).dataobj) > 0
+    skeleton = np.asanyarray(nib.load(paths['skeleton']).dataobj) > 0
+
+    ## one real ROI table, the rest are made by scaling its averages
+    base_csv = None
+    for i in range(size):
+        subject = subject_id(i)
+        for folder in ['FA', 'ROI']:
+            os.makedirs(os.path.join(cohortdir, subject, folder))
+        skel_nii = os.path.join(cohortdir, subject, 'FA', subject + '_FAskel.nii.gz')
+        roi_csv = os.path.join(cohortdir, subject, 'ROI', subject + '_FAskel_ROIout')
+        if i < images or base_csv == None:
+            FA = synthetic_FA(template, mask, rng)
+            write_volume(FA, template_img.affine, skel_nii.replace('skel', '_to_target'))
+            write_volume(FA * skeleton, template_img.affine, skel_nii)
+        if base_csv == None:
+            enigma_roi.extract_roi(paths['lookup_table'], paths['skeleton'], paths['atlas'], roi_csv, skel_nii,
+                                   index_dir = os.path.join(cohortdir, '.index'))
+            base_csv = enigma_roi.read_roi_table(roi_csv + '.csv')
+        else:
+            tracts, averages, nvoxels = base_csv
+            scaled = np.asarray(averages) * (1 + 0.05 * rng.standard_normal(len(averages)))
+            enigma_roi.write_roi_table(roi_csv + '.csv', zip(tracts, scaled, nvoxels))
+        enigma_roi.average_subject_tracts(roi_csv + '.csv', roi_csv + '_avg.csv')
+        if i >= images and os.path.isfile(skel_nii):
+            ## only the first images subjects keep their images
+            os.remove(skel_nii)
+            os.remove(skel_nii.replace('skel', '_to_target'))
+
+    ## placeholder QC images (the index pages only need the file names)
+    placeholder = os.path.join(cohortdir, '.placeholder.png')
+    from PIL import Image
+    Image.new('RGB', (8, 8)).save(placeholder)
+    for i in range(size):
+        subject = subject_id(i)
+        os.makedirs(os.path.join(cohortdir, 'QC', subject))
+        shutil.copy(placeholder, os.path.join(cohortdir, subject, 'FA', subject + '_FAskel.png'))
+        for display_mode in ['z', 'x']:
+            shutil.copy(placeholder, os.path.join(cohortdir, 'QC', subject,
+                                                  '{}_FAskel_{}.png'.format(subject, display_mode)))
+    with open(marker, 'w') as f:
+        json.dump(settings, f)
+
+def make_fsl_stubs(stubdir, paths):
+    '''
+    write the FSL stand-ins to <stubdir>/bin (and the files the pipeline expects in FSLDIR)
+    '''
+    bindir = os.path.join(stubdir, 'bin')
+    os.makedirs(bindir, exist_ok = True)
+    for name, source in FSL_STUBS.items():
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as f:
+            f.write('#!{}\n'.format(sys.executable) + source.lstrip())
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    standard = os.path.join(stubdir, 'data', 'standard')
+    os.makedirs(standard, exist_ok = True)
+    if not os.path.isfile(os.path.join(standard, 'LowerCingulum_1mm.nii.gz')):
+        shutil.copy(paths['skeleton_mask'], os.path.join(standard, 'LowerCingulum_1mm.nii.gz'))
+    return bindir
+
+def make_dtifit(dtifitdir, images, paths):
+    '''
+    synthetic dtifit outputs (FA, MD, L1, L2, L3) for the participant stage
+    '''
+    FAmaps = [os.path.join(dtifitdir, subject_id(i) + '_FA.nii.gz') for i in range(images)]
+    if all(os.path.isfile(FAmap.replace('FA.nii.gz', 'L3.nii.gz')) for FAmap in FAmaps):
+        return FAmaps
+    os.makedirs(dtifitdir, exist_ok = True)
+    rng = np.random.default_rng(SEED)
+    template_img = nib.load(paths['template'])
+    template = np.asanyarray(template_img.dataobj).astype(np.float32)
+    mask = np.asanyarray(nib.load(paths['mask']).dataobj) > 0
+    for FAmap in FAmaps:
+        FA = synthetic_FA(template, mask, rng)
+        L1 = (0.0008 + 0.0012 * FA) * mask
+        L2 = L3 = (0.0008 - 0.0004 * FA) * mask
+        for name, data in [('FA', FA), ('MD', (L1 + L2 + L3) / 3), ('L1', L1), ('L2', L2), ('L3', L3)]:
+            write_volume(data, template_img.affine, FAmap.replace('FA.nii.gz', name + '.nii.gz'))
+    return FAmaps
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+def run_script(script, args, env = None, cwd = None):
+    '''
+    run one of the scripts of this repo (in a new python, like it would be run)
+    '''
+    cmd = [sys.executable, os.path.join(ENIGMAREPO, script)] + args
+    if DEBUG: print(' '.join(cmd))
+    stdout = None if VERBOSE else subprocess.DEVNULL
+    start = time.perf_counter()
+    subprocess.run(cmd, check = True, env = env, stdout = stdout, cwd = cwd)
+    return time.perf_counter() - start
+
+def result(stage, subjects, seconds, per_image = False):
+    if VERBOSE or DEBUG:
+        print("{:<16} {:>6} subjects {:10.3f}s".format(stage, subjects, seconds))
+    return {'stage': stage,
+            'subjects': subjects,
+            'per_image': per_image,
+            'seconds': round(seconds, 4),
+            'per_subject': round(seconds / max(subjects, 1), 5)}
+
+def run_benchmarks(workdir, sizes, images, stages, paths):
+    '''
+    time the stages, returns a list of results (see result())
+    '''
+    results = []
+    ## the per image stages use the largest cohort (its first images subjects have images)
+    image_cohort = os.path.join(workdir, 'cohort-{}'.format(max(sizes)))
+
+    for size in sizes:
+        make_cohort(os.path.join(workdir, 'cohort-{}'.format(size)), size, min(images, size), paths)
+    images = min(images, max(sizes))
+
+    if 'skeleton_index' in stages:
+        index_dir = os.path.join(workdir, 'index_cold')
+        if os.path.isdir(index_dir):
+            shutil.rmtree(index_dir)
+        results.append(result('skeleton_index', 1,
+                       timed(enigma_roi.load_skeleton_index, paths['skeleton'], paths['atlas'], index_dir)))
+
+    if 'extract' in stages:
+        index_dir = os.path.join(workdir, 'index')
+        enigma_roi.load_skeleton_index(paths['skeleton'], paths['atlas'], index_dir)
+        outdir = os.path.join(workdir, 'extract')
+        os.makedirs(outdir, exist_ok = True)
+        start = time.perf_counter()
+        for subject in [subject_id(i) for i in range(images)]:
+            enigma_roi.extract_roi(paths['lookup_table'], paths['skeleton'], paths['atlas'],
+                                   os.path.join(outdir, subject + '_FAskel_ROIout'),
+                                   os.path.join(image_cohort, subject, 'FA', subject + '_FAskel.nii.gz'),
+                                   index_dir = index_dir)
+        results.append(result('extract', images, time.perf_counter() - start, per_image = True))
+
+    for stage, renderer in [('qc_images', 'nilearn'), ('qc_images_numpy', 'numpy')]:
+        if stage not in stages:
+            continue
+        import run_group_qc_enigma
+        run_group_qc_enigma.DEBUG = False
+        run_group_qc_enigma.QC_RENDERER = renderer
+        QCdir = os.path.join(workdir, stage)
+        if os.path.isdir(QCdir):
+            shutil.rmtree(QCdir)
+        os.makedirs(QCdir, exist_ok = True)
+        start = time.perf_counter()
+        for subject in [subject_id(i) for i in range(images)]:
+            subject_session, qc_subdir, pics = run_group_qc_enigma.subject_pics(
+                os.path.join(image_cohort, subject, 'FA', subject + '_FAskel.nii.gz'), QCdir, ['FA'])
+            for skel_nii, pic, display_mode in pics:
+                run_group_qc_enigma.render_pic(skel_nii, pic, display_mode)
+            run_group_qc_enigma.write_subject_page(subject_session, qc_subdir, [pic for skel_nii, pic, display_mode in pics])
+        results.append(result(stage, images, time.perf_counter() - start, per_image = True))
+
+    if 'participant' in stages or 'participant_rerun' in stages:
+        stubdir = os.path.join(workdir, 'fsl_stub')
+        env = dict(os.environ,
+                   PATH = make_fsl_stubs(stubdir, paths) + os.pathsep + os.environ.get('PATH', ''),
+                   FSLDIR = stubdir)
+        FAmaps = make_dtifit(os.path.join(workdir, 'dtifit'), images, paths)
+        participantdir = os.path.join(workdir, 'participant')
+        if os.path.isdir(participantdir):
+            shutil.rmtree(participantdir)
+        ## the first run is given paths relative to the workdir (like a user typing them),
+        ## the rerun absolute ones, which must find the same step records
+        seconds = 0
+        for FAmap in FAmaps:
+            subject = os.path.basename(FAmap).replace('_FA.nii.gz', '')
+            seconds += run_script('run_participant_enigma_extract.py',
+                                  ['--calc-all', os.path.relpath(os.path.join(participantdir, subject), workdir),
+                                   os.path.relpath(FAmap, workdir)], env = env, cwd = workdir)
+        if 'participant' in stages:
+            results.append(result('participant', images, seconds, per_image = True))
+
+    if 'participant_rerun' in stages:
+        seconds = 0
+        for FAmap in FAmaps:
+            subject = os.path.basename(FAmap).replace('_FA.nii.gz', '')
+            trace = enigma_trace.trace_path(os.path.join(participantdir, subject))
+            n_lines = len(enigma_trace.read_trace(trace))
+            seconds += run_script('run_participant_enigma_extract.py',
+                                  ['--calc-all', os.path.join(participantdir, subject), FAmap], env = env)
+            rerun = [line['name'] for line in enigma_trace.read_trace(trace)[n_lines:] if line['kind'] == 'step']
+            if len(rerun) > 0:
+                sys.exit("The rerun of {} ran steps that were up to date: {}".format(subject, ', '.join(rerun)))
+        results.append(result('participant_rerun', images, seconds, per_image = True))
+
+    for size in sizes:
+        cohortdir = os.path.join(workdir, 'cohort-{}'.format(size))
+        if 'average' in stages:
+            start = time.perf_counter()
+            for i in range(size):
+                roi_csv = os.path.join(cohortdir, subject_id(i), 'ROI', subject_id(i) + '_FAskel_ROIout')
+                enigma_roi.average_subject_tracts(roi_csv + '.csv', roi_csv + '_avg.csv')
+            results.append(result('average', size, time.perf_counter() - start))
+        if 'concat' in stages:
+            results.append(result('concat', size, run_script('run_group_enigma_concat.py',
+                           [cohortdir, 'FA', os.path.join(workdir, 'concat-{}.csv'.format(size))])))
+        if 'qc_index' in stages:
+            import run_group_qc_enigma
+            run_group_qc_enigma.DEBUG = False
+            seconds = run_script('run_group_qc_index.py', [cohortdir, 'FAskel'])
+            seconds += timed(run_group_qc_enigma.build_index, os.path.join(cohortdir, 'QC'), 'FA', 'z')
+            results.append(result('qc_index', size, seconds))
+    return results
+
+def git_label():
+    try:
+        return subprocess.run(['git', '-C', ENIGMAREPO, 'rev-parse', '--short', 'HEAD'], check = True,
+                              stdout = subprocess.PIPE, stderr = subprocess.DEVNULL).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def read_history(history_file):
+    if not os.path.isfile(history_file):
+        return []
+    with open(history_file, 'r') as f:
+        return json.load(f)
+
+def write_history(history_file, history):
+    '''
+    write the history to a temporary file first, then move it into place
+    '''
+    tmp_path = '{}.tmp{}'.format(history_file, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(history, f, indent = 1)
+    os.replace(tmp_path, history_file)
+
+def compare(results, previous, tolerance):
+    '''
+    print each result next to the same stage/size of the previous run
+    returns the stages that got slower by more than tolerance
+    '''
+    before = {}
+    if previous != None:
+        before = {(r['stage'], r['subjects']): r['seconds'] for r in previous['results']}
+        print("Compared to {} ({})".format(previous['label'], previous['date']))
+    slower = []
+    print('{:<16} {:>8} {:>12} {:>12} {:>12} {:>8}'.format('stage', 'subjects', 'seconds', 's/subject', 'before', 'ratio'))
+    for r in results:
+        line = '{:<16} {:>8} {:>12.3f} {:>12.5f}'.format(r['stage'], r['subjects'], r['seconds'], r['per_subject'])
+        key = (r['stage'], r['subjects'])
+        if key in before and before[key] > 0:
+            ratio = r['seconds'] / before[key]
+            line += ' {:>12.3f} {:>8.2f}'.format(before[key], ratio)
+            if ratio > 1 + tolerance and r['seconds'] - before[key] > MIN_SLOWDOWN:
+                line += '  SLOWER'
+                slower.append(key)
+        print(line)
+    return slower
+
+def show(history, last):
+    rows = []
+    for entry in history[-last:]:
+        row = {'label': entry['label'], 'date': entry['date'], 'host': entry['host']}
+        for r in entry['results']:
+            row['{}@{}'.format(r['stage'], r['subjects'])] = r['seconds']
+        rows.append(row)
+    with pd.option_context('display.width', 250, 'display.max_columns', 50):
+        print(pd.DataFrame(rows).set_index('label').T.to_string())
+
+def main():
+
+    global DEBUG
+    global VERBOSE
+
+    arguments       = docopt(__doc__)
+    workdir         = arguments['<workdir>']
+    sizes           = arguments['--sizes']
+    images          = arguments['--images']
+    stages          = arguments['--stages']
+    history_file    = arguments['--history']
+    label           = arguments['--label']
+    tolerance       = arguments['--tolerance']
+    CHECK           = arguments['--check']
+    last            = arguments['--last']
+    VERBOSE         = arguments['--verbose']
+    DEBUG           = arguments['--debug']
+
+    if DEBUG: print(arguments)
+
+    if arguments['show']:
+        show(read_history(arguments['<history>']), 10 if last == None else int(last))
+        return
+
+    sizes = [10, 100, 1000] if sizes == None else [int(size) for size in sizes.split(',')]
+    images = 10 if images == None else int(images)
+    stages = STAGES if stages == None else stages.split(',')
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if len(unknown) > 0:
+        sys.exit("Unknown stage(s) {} (the stages are {})".format(', '.join(unknown), ', '.join(STAGES)))
+    tolerance = 0.25 if tolerance == None else float(tolerance)
+    workdir = os.path.abspath(workdir)
+    if history_file == None: history_file = os.path.join(workdir, 'benchmark_history.json')
+    if label == None: label = git_label()
+
+    os.makedirs(workdir, exist_ok = True)
+    paths = enigma_paths()
+    results = run_benchmarks(workdir, sorted(sizes), images, stages, paths)
+
+    entry = {'label': label,
+             'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+             'host': socket.gethostname(),
+             'python': platform.python_version(),
+             'numpy': np.__version__,
+             'nibabel': nib.__version__,
+             'images': images,
+             'results': results}
+    history = read_history(history_file)
+    same_host = [e for e in history if e['host'] == entry['host']]
+    slower = compare(results, same_host[-1] if len(same_host) > 0 else None, tolerance)
+    history.append(entry)
+    write_history(history_file, history)
+    print("Added to {}".format(history_file))
+
+    if CHECK and len(slower) > 0:
+        sys.exit("{} stage(s) got more than {:.0%} slower".format(len(slower), tolerance))
+
+if __name__ == '__main__':
+    main()
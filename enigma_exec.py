@@ -0,0 +1,191 @@
+"""
+Running the parts of the participant pipelines, and their shell commands.
+
+docmd runs one external command (ex. tbss_2_reg) and raises a CommandError
+if it exits with a non zero code, so that a failed registration stops the
+run instead of skeletonizing and plotting files that were never made.
+Failed commands can be retried (retries = N) for transient failures
+(ex. a busy filesystem or license server).
+
+run_commands runs a set of commands that may depend on each other
+(a Command names the commands it has to run after) as asyncio subprocesses,
+at most n_jobs at a time. As soon as one fails the running ones are killed,
+the ones waiting on it are cancelled, and its CommandError is raised.
+The wall time, CPU time and peak memory of every command run (from os.wait4,
+so they are the commands own even when several run at once) are added to
+COMMAND_LOG, and to the trace file if one is given (see enigma_trace.py).
+
+run_branches runs one function over several independent branches
+(ex. the MD, AD and RD branches of run_participant_enigma_extract.py, after FA is done)
+in worker processes, at most n_jobs at a time. Worker processes are used
+(rather than threads) because the branches make their QC images with
+matplotlib, which is not thread safe.
+
+Every branch is run to the end even if another one fails, then a BranchError
+naming the failed branches (with their tracebacks printed) is raised.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
+import os
+import subprocess
+import time
+import traceback
+import enigma_trace
+
+## a command to run with run_commands, after the commands named in after
+Command = namedtuple('Command', ['name', 'cmdlist', 'after'])
+
+## the trace line (see enigma_trace.py) of every command run by this process
+COMMAND_LOG = []
+
+class CommandError(RuntimeError):
+    '''
+    an external command exited with a non zero code (or could not be started)
+    '''
+    def __init__(self, cmdlist, returncode, attempts = 1):
+        self.cmdlist = cmdlist
+        self.returncode = returncode
+        self.attempts = attempts
+        RuntimeError.__init__(self, "{} exited with code {} (after {} attempt(s)): {}".format(
+            cmdlist[0], returncode, attempts, ' '.join(cmdlist)))
+
+def wait_for(proc):
+    '''
+    wait for a child process, returning its exit code and its own resource usage
+    '''
+    pid, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, usage
+
+async def run_command(cmdlist, semaphore, waiters, retries = 0, retry_delay = 10, debug = False, trace = None):
+    '''
+    run one command once the semaphore allows it, retrying a failed command up to retries times
+    (waiters is the thread pool that waits on the processes)
+    returns the trace line (see enigma_trace.py) of the last attempt
+    '''
+    attempt = 0
+    while True:
+        attempt += 1
+        async with semaphore:
+            start = time.time()
+            started = time.monotonic()
+            try:
+                proc = subprocess.Popen(cmdlist)
+            except OSError as e:
+                ## not found or not executable - retrying will not help
+                line = enigma_trace.command_line(cmdlist, start, time.monotonic() - started, None, 127, attempt)
+                COMMAND_LOG.append(line)
+                enigma_trace.write_line(trace, line)
+                raise CommandError(cmdlist, 127, attempt) from e
+            waiting = waiters.submit(wait_for, proc)
+            try:
+                returncode, usage = await asyncio.wrap_future(waiting)
+            except asyncio.CancelledError:
+                proc.kill()
+                waiting.result()
+                raise
+            wall = time.monotonic() - started
+        line = enigma_trace.command_line(cmdlist, start, wall, usage, returncode, attempt)
+        COMMAND_LOG.append(line)
+        enigma_trace.write_line(trace, line)
+        if debug: print("  {} finished in {:.1f}s (exit code {})".format(cmdlist[0], wall, returncode))
+        if returncode == 0:
+            return line
+        if attempt > retries:
+            raise CommandError(cmdlist, returncode, attempt)
+        print("{} failed with exit code {}, retrying in {}s".format(cmdlist[0], returncode, retry_delay), flush = True)
+        await asyncio.sleep(retry_delay)
+
+async def run_command_graph(commands, n_jobs, retries, retry_delay, debug, dryrun, trace, waiters):
+    semaphore = asyncio.Semaphore(max(1, n_jobs))
+    tasks = {}
+
+    async def run_after(command):
+        for name in command.after:
+            ## raises (and so cancels this command) if the one it depends on failed
+            await tasks[name]
+        if debug: print(' '.join(command.cmdlist), flush = True)
+        if not dryrun:
+            await run_command(command.cmdlist, semaphore, waiters, retries, retry_delay, debug, trace)
+
+    for command in commands:
+        tasks[command.name] = asyncio.ensure_future(run_after(command))
+    done, pending = await asyncio.wait(list(tasks.values()), return_when = asyncio.FIRST_EXCEPTION)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions = True)
+    for command in commands:
+        task = tasks[command.name]
+        if task in done and task.exception() != None:
+            raise task.exception()
+
+def run_commands(commands, n_jobs = 1, retries = 0, retry_delay = 10, debug = False, dryrun = False, trace = None):
+    '''
+    run a list of Commands, at most n_jobs at a time, each after the ones it depends on
+
+    commands        list of Command(name, cmdlist, after) - after is a list of names
+    n_jobs          how many commands can run at once
+    retries         how many times to retry a failed command (default = 0)
+    retry_delay     seconds to wait before a retry
+    debug           print each command as it starts
+    dryrun          only print (with debug) the commands
+    trace           the trace file to add each commands timing to (see enigma_trace.py)
+
+    raises CommandError for the first command that failed (the others are killed or cancelled)
+    '''
+    names = [command.name for command in commands]
+    for command in commands:
+        missing = [name for name in command.after if name not in names]
+        if len(missing) > 0:
+            raise ValueError("{} runs after unknown command(s) {}".format(command.name, ', '.join(missing)))
+    with ThreadPoolExecutor(max_workers = max(1, n_jobs)) as waiters:
+        asyncio.run(run_command_graph(commands, n_jobs, retries, retry_delay, debug, dryrun, trace, waiters))
+
+def docmd(cmdlist, debug = False, dryrun = False, retries = 0, retry_delay = 10, trace = None):
+    '''
+    run one command (a list), raising a CommandError if it fails
+    '''
+    run_commands([Command(cmdlist[0], cmdlist, [])], 1, retries, retry_delay, debug, dryrun, trace)
+
+class BranchError(RuntimeError):
+    '''
+    one or more branches failed
+    '''
+    def __init__(self, failed):
+        self.failed = failed
+        RuntimeError.__init__(self, "{} failed".format(', '.join(failed)))
+
+def report_failure(name, error):
+    print("{} failed:".format(name))
+    print(''.join(traceback.format_exception(type(error), error, error.__traceback__)), flush = True)
+
+def run_branches(func, branches, n_jobs = 1, initializer = None, initargs = ()):
+    '''
+    run func(*args, **kwargs) for every (name, args, kwargs) in branches
+
+    func            the function to run (must be importable - a module level function)
+    branches        list of (name, args, kwargs)
+    n_jobs          how many branches to run at once (1 runs them one after another, in this process)
+    initializer     run once in each worker process with initargs (ex. to set the script globals)
+    '''
+    failed = []
+    if n_jobs <= 1 or len(branches) <= 1:
+        for name, args, kwargs in branches:
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                report_failure(name, e)
+                failed.append(name)
+    else:
+        with ProcessPoolExecutor(max_workers = min(n_jobs, len(branches)),
+                                 initializer = initializer, initargs = initargs) as pool:
+            futures = [(name, pool.submit(func, *args, **kwargs)) for name, args, kwargs in branches]
+            for name, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    report_failure(name, e)
+                    failed.append(name)
+    if len(failed) > 0:
+        raise BranchError(failed)
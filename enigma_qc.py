@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""
+Draws the skeleton QC images (the skeleton in orange on top of the _to_target image)
+and the dtifit direction maps.
+
+Usage:
+  enigma_qc.py render [options] <skel_nii> <png>
+  enigma_qc.py verify [options] <skel_nii>
+
+Arguments:
+    <skel_nii>         A skeleton image (ex. FA/sub-01_FAskel.nii.gz), with its _to_target image next to it
+    <png>              The QC image to write
+
+Options:
+  --display-mode MODE      Which slices to draw, z (axial), x (sagittal) or y (coronal) (default = z)
+  --renderer NAME          Draw with nilearn or numpy (default = numpy)
+  --png-dir DIR            verify: also write the nilearn and numpy images of every display mode here
+  --debug                  Debug logging
+  -h,--help                Print this help
+
+DETAILS
+The QC images were made with nilearn.plotting.plot_img, which needs all of
+nilearn and matplotlib (a few seconds to import, and a second or two per image).
+The "numpy" renderer draws the same slices with nibabel, numpy and Pillow only:
+the fixed MNI cut coordinates are turned into voxel indices through the image
+affine (the same way nilearn does it: the image is reordered to RAS, the
+coordinate is transformed with the inverse affine and rounded), the slices are
+rotated like nilearn does, the background is drawn in gray and the skeleton
+in the "Oranges" colormap, and the panels are put side by side (with the cut
+coordinates and a colorbar) in a PNG.
+
+The participant and group QC scripts take "--qc-renderer numpy" to use it.
+
+direction_map draws the dtifit principal direction (V1) as colors, red for
+left-right, green for anterior-posterior and blue for inferior-superior, where
+the FA is above 0.15 (it is used by run_group_dtifit_qc.py).
+
+"verify" checks, for every display mode, that the numpy renderer picks the same
+slices as nilearn (the same voxel index and the same 2D cut of the data),
+and with "--png-dir" writes both images side by side for a look.
+"""
+from docopt import docopt
+import nibabel as nib
+import numpy as np
+import os
+import sys
+
+DEBUG = False
+
+RENDERERS = ['nilearn', 'numpy']
+
+## the cuts (in MNI mm) of the skeleton QC images
+CUT_COORDS = {'x': [-36, -16, 2, 10, 42],
+              'y': [-40, -20, -10, 0, 10, 20],
+              'z': [-4, 2, 8, 12, 20, 40]}
+
+## anything above this is drawn as skeleton
+THRESHOLD = 0.000001
+
+## the ColorBrewer "Oranges" colors (what matplotlib builds its Oranges colormap from)
+ORANGES = np.array([[255, 245, 235], [254, 230, 206], [253, 208, 162],
+                    [253, 174, 107], [253, 141, 60], [241, 105, 19],
+                    [217, 72, 1], [166, 54, 3], [127, 39, 4]], dtype = np.float64)
+
+## each voxel is drawn as a SCALE x SCALE block of pixels
+SCALE = 2
+
+## the direction maps show V1 where the FA is above this
+DIRECTION_FA_THRESHOLD = 0.15
+
+## and cut each axis at these fractions of the volume (like fsl slices)
+DIRECTION_CUTS = [0.4, 0.5, 0.6]
+
+def background_path(skel_nii):
+    return skel_nii.replace("skel", "_to_target")
+
+def overlay_skel(skel_nii, overlay_png_path, display_mode = "z", renderer = "nilearn"):
+    '''
+    create an overlay image montage of
+    skel_nii image in orange on top of its _to_target image
+
+    skel_nii        the nifty image to be overlayed (i.e. "FAskel.nii.gz")
+    overlay_png_path     the name of the output (output.png)
+    display_mode    x, y or z
+    renderer        nilearn or numpy
+    '''
+    if renderer == "numpy":
+        overlay_skel_numpy(skel_nii, overlay_png_path, display_mode)
+    elif renderer == "nilearn":
+        overlay_skel_nilearn(skel_nii, overlay_png_path, display_mode)
+    else:
+        raise ValueError("Unknown QC renderer {} (use one of {})".format(renderer, ', '.join(RENDERERS)))
+
+def overlay_skel_nilearn(skel_nii, overlay_png_path, display_mode = "z"):
+    '''
+    draw the QC image with nilearn plotting (imported here, it is slow to import)
+    '''
+    import nilearn.plotting
+    import matplotlib.pyplot
+    nilearn.plotting.plot_img(skel_nii,
+        bg_img = background_path(skel_nii),
+        threshold = THRESHOLD,
+        display_mode = display_mode,
+        cut_coords = CUT_COORDS[display_mode],
+        cmap = "Oranges",
+        colorbar = True,
+        output_file = overlay_png_path)
+    ## nilearn leaves its figures open, close them so a long running process does not keep them all in memory
+    matplotlib.pyplot.close('all')
+
+def slice_index(affine, display_mode, coord):
+    '''
+    the voxel index along the display_mode axis of an MNI coordinate (for a RAS ordered image)
+    '''
+    axis = "xyz".index(display_mode)
+    point = [0, 0, 0, 1]
+    point[axis] = coord
+    return int(np.round(np.linalg.inv(affine).dot(point)[axis]))
+
+def cut_slice(data, axis, index):
+    '''
+    the 2D cut of a RAS ordered volume, rotated like nilearn does (superior/anterior up)
+    '''
+    index = min(max(index, 0), data.shape[axis] - 1)
+    return np.rot90(np.take(data, index, axis = axis))
+
+def load_ras(nii_path):
+    '''
+    the image data and affine, reordered to RAS (like nilearn.image.reorder_img)
+    '''
+    img = nib.as_closest_canonical(nib.load(nii_path))
+    return np.asanyarray(img.dataobj).astype(np.float32), img.affine
+
+def colormap(values, vmin, vmax):
+    '''
+    Oranges colors (uint8 RGB) for values between vmin and vmax
+    '''
+    scaled = (values - vmin) / max(vmax - vmin, 1e-12) * (len(ORANGES) - 1)
+    scaled = np.clip(scaled, 0, len(ORANGES) - 1)
+    stops = np.arange(len(ORANGES))
+    return np.stack([np.interp(scaled, stops, ORANGES[:, c]) for c in range(3)], axis = -1).astype(np.uint8)
+
+def crop_box(mask, margin = 4):
+    '''
+    the row and column slices around the True part of a 2D mask (all of it if the mask is empty)
+    '''
+    if not mask.any():
+        return slice(None), slice(None)
+    box = []
+    for axis in [1, 0]:
+        found = np.flatnonzero(mask.any(axis = axis))
+        box.append(slice(max(found[0] - margin, 0), found[-1] + margin + 1))
+    return tuple(box)
+
+def gray(values, vmin, vmax):
+    scaled = np.clip((values - vmin) / max(vmax - vmin, 1e-12), 0, 1) * 255
+    return np.repeat(scaled[..., None], 3, axis = -1).astype(np.uint8)
+
+def overlay_skel_numpy(skel_nii, overlay_png_path, display_mode = "z"):
+    '''
+    draw the QC image with numpy and Pillow (the same slices and colors as overlay_skel_nilearn)
+    '''
+    from PIL import Image, ImageDraw
+
+    skel, affine = load_ras(skel_nii)
+    bg, bg_affine = load_ras(background_path(skel_nii))
+    axis = "xyz".index(display_mode)
+    skel_values = skel[skel > THRESHOLD]
+    vmin, vmax = (skel_values.min(), skel_values.max()) if skel_values.size > 0 else (0, 1)
+    bg_min, bg_max = bg.min(), bg.max()
+    ## crop every panel to the extent of the brain (like nilearn does)
+    rows, cols = crop_box(np.rot90((bg > bg_min).any(axis = axis)))
+
+    panels = []
+    for coord in CUT_COORDS[display_mode]:
+        bg_cut = cut_slice(bg, axis, slice_index(bg_affine, display_mode, coord))
+        skel_cut = cut_slice(skel, axis, slice_index(affine, display_mode, coord))
+        rgb = gray(bg_cut, bg_min, bg_max)
+        if skel_cut.shape == bg_cut.shape:
+            on_skeleton = skel_cut > THRESHOLD
+            rgb[on_skeleton] = colormap(skel_cut[on_skeleton], vmin, vmax)
+        rgb = rgb[rows, cols]
+        panel = Image.fromarray(rgb).resize((rgb.shape[1] * SCALE, rgb.shape[0] * SCALE), Image.NEAREST)
+        draw = ImageDraw.Draw(panel)
+        draw.text((4, panel.height - 14), '{}={}'.format(display_mode, coord), fill = (255, 255, 255))
+        if display_mode in ['y', 'z']:
+            draw.text((4, 4), 'L', fill = (255, 255, 255))
+            draw.text((panel.width - 12, 4), 'R', fill = (255, 255, 255))
+        panels.append(panel)
+
+    ## the colorbar, vmax at the top
+    height = max(panel.height for panel in panels)
+    bar = colormap(np.linspace(vmax, vmin, height)[:, None].repeat(12, axis = 1), vmin, vmax)
+    colorbar = Image.new('RGB', (70, height))
+    colorbar.paste(Image.fromarray(bar), (0, 0))
+    draw = ImageDraw.Draw(colorbar)
+    draw.text((20, 2), '{:.3g}'.format(vmax), fill = (255, 255, 255))
+    draw.text((20, height - 14), '{:.3g}'.format(vmin), fill = (255, 255, 255))
+
+    if DEBUG: print("Writing {}".format(overlay_png_path))
+    montage(panels + [colorbar]).save(overlay_png_path)
+
+def montage(panels, gap = 4):
+    '''
+    the panels (PIL images) side by side in one line, centered vertically on a black background
+    '''
+    from PIL import Image
+    height = max(panel.height for panel in panels)
+    line = Image.new('RGB', (sum(panel.width for panel in panels) + gap * (len(panels) - 1), height))
+    x = 0
+    for panel in panels:
+        line.paste(panel, (x, (height - panel.height) // 2))
+        x += panel.width + gap
+    return line
+
+def direction_map(FA_nii, V1_nii, png_path):
+    '''
+    draw the dtifit principal directions as colors (|V1| x FA mask) in one line of
+    sagittal, coronal and axial slices (replaces the fsl slices / imagemagick pictures)
+
+    FA_nii        the dtifit FA image
+    V1_nii        the dtifit V1 image (4D, the x, y and z of the direction)
+    png_path      the name of the output (output.png)
+    '''
+    from PIL import Image
+
+    FA, affine = load_ras(FA_nii)
+    V1_img = nib.load(V1_nii)
+    V1 = np.asanyarray(nib.as_closest_canonical(V1_img).dataobj).astype(np.float32)
+    if V1.ndim != 4 or V1.shape[:3] != FA.shape:
+        raise ValueError("{} ({}) does not match {} ({})".format(V1_nii, V1.shape, FA_nii, FA.shape))
+    ## the reorder to RAS moves the voxel axes but not the vector components, so
+    ## the component along voxel axis i is moved to the axis that voxel axis went to
+    ## (the sign does not matter, only the absolute value is drawn)
+    axes = nib.io_orientation(V1_img.affine)[:, 0].astype(int)
+    direction = np.zeros(V1.shape[:3] + (3,), dtype = V1.dtype)
+    for component in range(3):
+        direction[..., axes[component]] = V1[..., component]
+    rgb = np.abs(direction) * (FA > DIRECTION_FA_THRESHOLD)[..., None]
+    rgb = (np.clip(rgb, 0, 1) * 255).astype(np.uint8)
+
+    panels = []
+    for axis in [0, 1, 2]:
+        rows, cols = crop_box(np.rot90((FA > 0).any(axis = axis)))
+        for cut in DIRECTION_CUTS:
+            index = int(round(cut * (rgb.shape[axis] - 1)))
+            view = cut_slice(rgb, axis, index)[rows, cols]
+            panels.append(Image.fromarray(np.ascontiguousarray(view)).resize(
+                (view.shape[1] * SCALE, view.shape[0] * SCALE), Image.NEAREST))
+    if DEBUG: print("Writing {}".format(png_path))
+    montage(panels).save(png_path)
+
+def verify(skel_nii, png_dir = None):
+    '''
+    check that the numpy renderer cuts the same slices as nilearn, returns the number of mismatches
+    '''
+    from nilearn.image import coord_transform, get_data, reorder_img
+
+    nilearn_img = reorder_img(nib.load(skel_nii), resample = 'continuous')
+    nilearn_data = get_data(nilearn_img)
+    data, affine = load_ras(skel_nii)
+    mismatches = 0
+    for display_mode, cut_coords in CUT_COORDS.items():
+        axis = "xyz".index(display_mode)
+        for coord in cut_coords:
+            coords = [0, 0, 0]
+            coords[axis] = coord
+            nilearn_index = int(np.round(coord_transform(*coords, np.linalg.inv(nilearn_img.affine))[axis]))
+            index = slice_index(affine, display_mode, coord)
+            same_cut = np.array_equal(cut_slice(data, axis, index),
+                                      np.rot90(np.take(nilearn_data, nilearn_index, axis = axis)))
+            ok = index == nilearn_index and same_cut
+            mismatches += 0 if ok else 1
+            print('{}={:<4} nilearn voxel {:<4} numpy voxel {:<4} same cut: {:<5} {}'.format(
+                display_mode, coord, nilearn_index, index, str(same_cut), 'ok' if ok else 'MISMATCH'))
+        if png_dir != None:
+            os.makedirs(png_dir, exist_ok = True)
+            stem = os.path.join(png_dir, os.path.basename(skel_nii).replace('.nii.gz', '_' + display_mode))
+            overlay_skel_nilearn(skel_nii, stem + '_nilearn.png', display_mode)
+            overlay_skel_numpy(skel_nii, stem + '_numpy.png', display_mode)
+    return mismatches
+
+def main():
+
+    global DEBUG
+
+    arguments       = docopt(__doc__)
+    skel_nii        = arguments['<skel_nii>']
+    display_mode    = arguments['--display-mode']
+    renderer        = arguments['--renderer']
+    png_dir         = arguments['--png-dir']
+    DEBUG           = arguments['--debug']
+
+    if DEBUG: print(arguments)
+    if display_mode == None: display_mode = 'z'
+    if renderer == None: renderer = 'numpy'
+
+    if arguments['render']:
+        overlay_skel(skel_nii, arguments['<png>'], display_mode, renderer)
+
+    if arguments['verify']:
+        mismatches = verify(skel_nii, png_dir)
+        if mismatches > 0:
+            sys.exit("{} cut(s) do not match nilearn".format(mismatches))
+
+if __name__ == '__main__':
+    main()
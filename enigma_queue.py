@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+"""
+A work queue (on a shared filesystem) for running the participant pipelines from many nodes.
+
+Usage:
+  enigma_queue.py add [options] <queuedir> <dtifitdir> <outputdir>
+  enigma_queue.py worker [options] <queuedir>
+  enigma_queue.py status [options] <queuedir>
+  enigma_queue.py retry [options] <queuedir>
+
+Arguments:
+    <queuedir>         Queue directory (somewhere all the nodes can see, ex. <outputdir>/queue)
+    <dtifitdir>        Top directory of the dtifit outputs (ex. <OUT_DIR>/dtifit in BIDS layout)
+    <outputdir>        Top directory for the enigmaDTI outputs
+
+Options:
+  --fa-pattern STR         Glob (under dtifitdir) for the FA maps (default = '**/*FA.nii.gz')
+  --calc-MD                Option to process MD image as well
+  --calc-all               Option to process MD, AD and RD
+  --batch-warp             Mask and warp the non-FA (and NODDI) maps together in one applywarp call
+  --recalc-MD              Calculate MD as the mean of L1, L2 and L3 (instead of using the dtifit MD image)
+  --noddi-dir DIR          Also queue the NODDI extraction, from the qsirecon NODDI outputs in DIR
+  --noddi-outputdir DIR    Where the NODDI extraction writes to (default = <outputdir>/../enigmaNODDI)
+  --lease-seconds SEC      A task whose lease is not renewed for this long is taken back (default = 900)
+  --max-attempts N         How many times a task is tried before it is marked failed (default = 2)
+  --poll-seconds SEC       How long an idle worker waits before looking for work again (default = 30)
+  --threads-per-job N      Number of threads each task may use (default = 1)
+  -v,--verbose             Verbose logging
+  --debug                  Debug logging in Erin's very verbose style
+  -n,--dry-run             Dry run (add: print the tasks, worker: print what would be run)
+  -h,--help                Print this help
+
+DETAILS
+This replaces the fixed size SLURM array of example_kimel_workflow.sh. The "add"
+command writes one task per FA map (run_participant_enigma_extract.py), and
+with "--noddi-dir" a second task (run_participant_noddi_enigma_extract.py) that
+waits for the first. Running "add" again only adds the FA maps that are new.
+Any number of identical "worker" processes (on any nodes, or several on one machine)
+then take tasks until there is nothing left to do, so slow participants no longer
+hold up a whole array, and no array size has to match the cohort.
+
+Everything is kept as small files in the <queuedir>:
+  tasks/<task>.json        what to run (and which tasks have to be done first)
+  leases/<task>.lease      which worker is running a task - created with O_CREAT|O_EXCL,
+                           so only one worker can hold it, and touched every
+                           lease-seconds / 4 while the task runs
+  done/<task>.json         the finished tasks (with the time it took)
+  failed/<task>.json       the failed attempts of a task
+  logs/<task>.log          the output of the latest attempt
+
+When a worker dies (or its node does) its lease stops being renewed, and after
+"--lease-seconds" another worker takes the task back (the stale lease is renamed
+away first, so only one worker can take it, and put back if it turns out to be
+a fresh lease another worker took in the meantime). A worker that finds its
+lease gone stops its task (and every command the task started). This needs the clocks of the nodes to roughly agree (ntp).
+A task that is tried again runs in the same output folder: the participant
+script skips the steps its records show are up to date (ex. a finished FNIRT
+registration) and only reruns the step that failed and the ones after it.
+
+Tasks that fail "--max-attempts" times are left as failed; "retry" clears
+their failed attempts so that workers will try them again.
+
+To try it out on one machine:
+  enigma_queue.py add ${OUT_DIR}/enigmaDTI/queue ${OUT_DIR}/dtifit ${OUT_DIR}/enigmaDTI
+  for i in 1 2 3 4; do enigma_queue.py worker ${OUT_DIR}/enigmaDTI/queue & done; wait
+"""
+from docopt import docopt
+import glob
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+import run_cohort_enigma_extract as cohort
+
+DRYRUN = False
+DEBUG = False
+VERBOSE = False
+
+QUEUE_DIRS = ['tasks', 'leases', 'done', 'failed', 'logs']
+
+def queue_path(queuedir, subdir, task, ext):
+    return os.path.join(queuedir, subdir, task + ext)
+
+def read_json(path, default = None):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+def write_json(path, data):
+    '''
+    write a json file under a temporary name and rename it into place
+    '''
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent = 1)
+    os.replace(tmp_path, path)
+
+def worker_name():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+##############################################################################
+## adding tasks
+
+def participant_tasks(FAmap, outputdir, noddi_dir, noddi_outputdir, enigma_options, noddi_options):
+    '''
+    the task(s) for one FA map, as a list of dictionaries
+    '''
+    participant = cohort.participant_id(FAmap)
+    participant_dir = os.path.join(outputdir, participant)
+    repo = os.path.dirname(os.path.realpath(__file__))
+    enigma = {'task': participant + '.enigma',
+              'participant': participant,
+              'cmd': [sys.executable, os.path.join(repo, 'run_participant_enigma_extract.py')] +
+                     enigma_options + [participant_dir, FAmap],
+              'FAmap': FAmap,
+              'outputdir': participant_dir,
+              'depends': []}
+    tasks = [enigma]
+    if noddi_dir:
+        subject, session = participant.split('_', 1) if '_ses-' in participant else (participant, None)
+        noddi_cmd = [sys.executable, os.path.join(repo, 'run_participant_noddi_enigma_extract.py')] + \
+            noddi_options + ['--noddi_outputdir', noddi_dir, '--enigma_outputdir', outputdir,
+                             '--outputdir', noddi_outputdir, '--subject', subject]
+        if session:
+            noddi_cmd += ['--session', session]
+        tasks.append({'task': participant + '.noddi',
+                      'participant': participant,
+                      'cmd': noddi_cmd,
+                      'FAmap': FAmap,
+                      'outputdir': None,
+                      'depends': [enigma['task']]})
+    return tasks
+
+def add_tasks(queuedir, FAmaps, outputdir, noddi_dir, noddi_outputdir, enigma_options, noddi_options):
+    '''
+    write the task files for the FA maps that are not in the queue yet
+    returns the number of tasks added
+    '''
+    for subdir in QUEUE_DIRS:
+        os.makedirs(os.path.join(queuedir, subdir), exist_ok = True)
+    added = 0
+    for FAmap in FAmaps:
+        for task in participant_tasks(FAmap, outputdir, noddi_dir, noddi_outputdir,
+                                      enigma_options, noddi_options):
+            task_file = queue_path(queuedir, 'tasks', task['task'], '.json')
+            if os.path.exists(task_file):
+                continue
+            if DEBUG or DRYRUN: print(' '.join(task['cmd']))
+            if not DRYRUN:
+                ## participants that were already run (ex. by an earlier SLURM array) are marked done
+                if task['outputdir'] and cohort.is_done(FAmap, task['outputdir']):
+                    write_json(queue_path(queuedir, 'done', task['task'], '.json'), {'already_done': True})
+                write_json(task_file, task)
+            added += 1
+    return added
+
+##############################################################################
+## leases
+
+def lease_is_stale(lease_file, lease_seconds):
+    try:
+        return time.time() - os.stat(lease_file).st_mtime > lease_seconds
+    except FileNotFoundError:
+        return False
+
+def read_lease(lease_file):
+    '''
+    (modification time, contents) of a lease file, or None if it is gone
+    '''
+    try:
+        mtime = os.stat(lease_file).st_mtime
+    except FileNotFoundError:
+        return None
+    return mtime, read_json(lease_file, {})
+
+def take_lease(queuedir, task, worker, lease_seconds):
+    '''
+    try to take the lease on a task (taking back a stale one)
+    returns True if this worker now holds it
+    '''
+    lease_file = queue_path(queuedir, 'leases', task, '.lease')
+    seen = read_lease(lease_file)
+    if seen != None and time.time() - seen[0] > lease_seconds:
+        ## only one worker can rename the stale lease away
+        stale_file = '{}.stale.{}'.format(lease_file, worker)
+        try:
+            os.rename(lease_file, stale_file)
+        except FileNotFoundError:
+            return False
+        ## but another worker may have taken the task back (with a fresh lease) between the
+        ## check and the rename - then this worker renamed the fresh lease, so it puts it back
+        moved = read_lease(stale_file)
+        if moved == None or time.time() - moved[0] <= lease_seconds or \
+                moved[1].get('taken') != seen[1].get('taken'):
+            try:
+                os.link(stale_file, lease_file)
+            except FileExistsError:
+                pass
+            os.remove(stale_file)
+            return False
+        print('Taking back {} from {} (lease expired)'.format(task, moved[1].get('worker')), flush = True)
+        os.remove(stale_file)
+    try:
+        fd = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'worker': worker, 'host': socket.gethostname(), 'pid': os.getpid(),
+                   'taken': time.time()}, f)
+    return True
+
+def renew_lease(queuedir, task, worker):
+    '''
+    touch the lease, returns False if this worker no longer holds it
+    '''
+    lease_file = queue_path(queuedir, 'leases', task, '.lease')
+    if read_json(lease_file, {}).get('worker') != worker:
+        return False
+    try:
+        os.utime(lease_file)
+    except FileNotFoundError:
+        return False
+    return True
+
+def release_lease(queuedir, task, worker):
+    lease_file = queue_path(queuedir, 'leases', task, '.lease')
+    if read_json(lease_file, {}).get('worker') == worker:
+        try:
+            os.remove(lease_file)
+        except FileNotFoundError:
+            pass
+
+##############################################################################
+## the state of the queue
+
+def queue_state(queuedir, lease_seconds, max_attempts):
+    '''
+    returns a list of (task, state) in task order, where state is one of
+    done, failed, running, expired (lease not renewed), blocked (waiting on another task) or waiting
+    '''
+    tasks = [read_json(f) for f in sorted(glob.glob(os.path.join(queuedir, 'tasks', '*.json')))]
+    tasks = [t for t in tasks if t != None]
+    done = set(os.path.basename(f)[:-len('.json')] for f in glob.glob(os.path.join(queuedir, 'done', '*.json')))
+    states = []
+    for task in tasks:
+        name = task['task']
+        lease_file = queue_path(queuedir, 'leases', name, '.lease')
+        if name in done:
+            state = 'done'
+        elif len(read_json(queue_path(queuedir, 'failed', name, '.json'), [])) >= max_attempts:
+            state = 'failed'
+        elif os.path.exists(lease_file):
+            state = 'expired' if lease_is_stale(lease_file, lease_seconds) else 'running'
+        elif not all(d in done for d in task['depends']):
+            state = 'blocked'
+        else:
+            state = 'waiting'
+        states.append((task, state))
+    return states
+
+##############################################################################
+## running tasks
+
+def stop_task(proc):
+    '''
+    stop a task and everything it started (its process group)
+    '''
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+def run_task(queuedir, task, worker, lease_seconds, threads):
+    '''
+    run one task (this worker holds its lease), renewing the lease while it runs
+    returns the return code (or None if the lease was lost)
+    '''
+    name = task['task']
+    failed_file = queue_path(queuedir, 'failed', name, '.json')
+    attempts = read_json(failed_file, [])
+    start = time.time()
+    if task['outputdir']:
+        ## a retry (or a rerun after a worker died before marking the task done) runs in
+        ## place - the steps that were finished are skipped, whatever branch failed
+        os.makedirs(task['outputdir'], exist_ok = True)
+
+    print('{} running {}'.format(worker, name), flush = True)
+    if DEBUG: print(' '.join(task['cmd']))
+    env = cohort.thread_env(threads)
+    if task['outputdir']:
+        env['TMPDIR'] = os.path.join(task['outputdir'], 'tmp')
+        os.makedirs(env['TMPDIR'], exist_ok = True)
+    with open(queue_path(queuedir, 'logs', name, '.log'), 'w') as log:
+        log.write('{} {}\n'.format(worker, ' '.join(task['cmd'])))
+        log.flush()
+        ## in its own process group, so that stopping it also stops the FSL commands it runs
+        proc = subprocess.Popen(task['cmd'], cwd = task['outputdir'], env = env,
+                                stdout = log, stderr = subprocess.STDOUT, start_new_session = True)
+        try:
+            while True:
+                try:
+                    returncode = proc.wait(timeout = lease_seconds / 4)
+                    break
+                except subprocess.TimeoutExpired:
+                    if not renew_lease(queuedir, name, worker):
+                        print('{} lost the lease on {}, stopping it'.format(worker, name), flush = True)
+                        stop_task(proc)
+                        proc.wait()
+                        return None
+        except BaseException:
+            ## the worker is being stopped - do not leave the pipeline running on its own
+            stop_task(proc)
+            raise
+
+    if returncode == 0 and task['outputdir']:
+        shutil.rmtree(env['TMPDIR'], ignore_errors = True)
+    record = {'worker': worker, 'returncode': returncode, 'seconds': time.time() - start, 'finished': time.time()}
+    if returncode == 0:
+        write_json(queue_path(queuedir, 'done', name, '.json'), record)
+    else:
+        write_json(failed_file, attempts + [record])
+    print('{} {} {} ({:.0f}s)'.format(worker, name, 'done' if returncode == 0 else 'failed',
+                                      record['seconds']), flush = True)
+    return returncode
+
+def run_worker(queuedir, lease_seconds, max_attempts, poll_seconds, threads):
+    '''
+    take and run tasks until every task is done or failed
+    '''
+    worker = worker_name()
+    if DRYRUN:
+        for task, state in queue_state(queuedir, lease_seconds, max_attempts):
+            if state in ['waiting', 'expired']:
+                print('{} would run {}: {}'.format(worker, task['task'], ' '.join(task['cmd'])))
+        return
+    while True:
+        states = queue_state(queuedir, lease_seconds, max_attempts)
+        ran = False
+        for task, state in states:
+            if state in ['waiting', 'expired'] and take_lease(queuedir, task['task'], worker, lease_seconds):
+                try:
+                    run_task(queuedir, task, worker, lease_seconds, threads)
+                finally:
+                    release_lease(queuedir, task['task'], worker)
+                ran = True
+                break
+        if ran:
+            continue
+        ## nothing to take - stop if nothing is left that could still be run
+        active = [task for task, state in states if state in ['waiting', 'expired', 'running'] or
+                  (state == 'blocked' and not failed_dependency(task, states))]
+        if len(active) == 0:
+            if VERBOSE: print('{} finished, nothing left to do'.format(worker))
+            return
+        time.sleep(poll_seconds)
+
+def failed_dependency(task, states):
+    failed = set(t['task'] for t, state in states if state == 'failed')
+    return any(d in failed for d in task['depends'])
+
+def print_queue_status(queuedir, lease_seconds, max_attempts):
+    states = queue_state(queuedir, lease_seconds, max_attempts)
+    counts = {}
+    for task, state in states:
+        counts[state] = counts.get(state, 0) + 1
+    print('{} tasks: '.format(len(states)) +
+          ', '.join('{} {}'.format(n, state) for state, n in sorted(counts.items())))
+    for task, state in states:
+        if state in ['running', 'expired']:
+            lease_file = queue_path(queuedir, 'leases', task['task'], '.lease')
+            lease = read_json(lease_file, {})
+            print('  {} {} on {} for {:.0f}s'.format(task['task'], state, lease.get('worker'),
+                                                    time.time() - lease.get('taken', time.time())))
+        if state == 'failed':
+            print('  {} failed (see {})'.format(task['task'], queue_path(queuedir, 'logs', task['task'], '.log')))
+
+def main():
+
+    global DEBUG
+    global VERBOSE
+    global DRYRUN
+
+    arguments       = docopt(__doc__)
+    queuedir        = arguments['<queuedir>']
+    dtifitdir       = arguments['<dtifitdir>']
+    outputdir       = arguments['<outputdir>']
+    fa_pattern      = arguments['--fa-pattern']
+    noddi_dir       = arguments['--noddi-dir']
+    noddi_outputdir = arguments['--noddi-outputdir']
+    lease_seconds   = arguments['--lease-seconds']
+    max_attempts    = arguments['--max-attempts']
+    poll_seconds    = arguments['--poll-seconds']
+    threads         = arguments['--threads-per-job']
+    VERBOSE         = arguments['--verbose']
+    DEBUG           = arguments['--debug']
+    DRYRUN          = arguments['--dry-run']
+
+    if DEBUG: print(arguments)
+
+    queuedir = os.path.abspath(queuedir)
+    lease_seconds = 900 if lease_seconds == None else float(lease_seconds)
+    max_attempts = 2 if max_attempts == None else int(max_attempts)
+    poll_seconds = 30 if poll_seconds == None else float(poll_seconds)
+    threads = 1 if threads == None else int(threads)
+
+    if arguments['add']:
+        outputdir = os.path.abspath(outputdir)
+        if fa_pattern == None: fa_pattern = '**/*FA.nii.gz'
+        if noddi_dir:
+            noddi_dir = os.path.abspath(noddi_dir)
+            if noddi_outputdir == None:
+                noddi_outputdir = os.path.join(os.path.dirname(outputdir), 'enigmaNODDI')
+            noddi_outputdir = os.path.abspath(noddi_outputdir)
+        enigma_options = [opt for opt in ['--calc-MD', '--calc-all', '--batch-warp', '--recalc-MD', '--debug']
+                          if arguments[opt]]
+        noddi_options = [opt for opt in ['--batch-warp', '--debug'] if arguments[opt]]
+        FAmaps = sorted(os.path.abspath(f) for f in glob.glob(os.path.join(dtifitdir, fa_pattern), recursive = True))
+        if len(FAmaps) == 0:
+            sys.exit('Could not find any FA maps matching {}'.format(os.path.join(dtifitdir, fa_pattern)))
+        added = add_tasks(queuedir, FAmaps, outputdir, noddi_dir, noddi_outputdir, enigma_options, noddi_options)
+        print('Added {} tasks for {} FA maps to {}'.format(added, len(FAmaps), queuedir))
+
+    if arguments['worker']:
+        run_worker(queuedir, lease_seconds, max_attempts, poll_seconds, threads)
+
+    if arguments['status']:
+        print_queue_status(queuedir, lease_seconds, max_attempts)
+
+    if arguments['retry']:
+        failed = glob.glob(os.path.join(queuedir, 'failed', '*.json'))
+        for failed_file in failed:
+            if DEBUG: print('Removing {}'.format(failed_file))
+            if not DRYRUN: os.remove(failed_file)
+        print('Cleared the failed attempts of {} tasks'.format(len(failed)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+"""
+Extract ENIGMA DTI ROI values from a skeletonized image with nibabel/numpy.
+
+Usage:
+  enigma_roi.py extract [options] <lookup_table> <skeleton> <atlas> <outputcsv> <image>
+  enigma_roi.py average [options] <inputcsv> <outputcsv>
+  enigma_roi.py index [options] <skeleton> <atlas>
+
+Arguments:
+    <lookup_table>     Tab-delimited atlas look up table (ex. ENIGMA_look_up_table.txt)
+    <skeleton>         Template skeleton image (ex. ENIGMA_DTI_FA_skeleton.nii.gz)
+    <atlas>            Atlas label image (ex. JHU-WhiteMatter-labels-1mm.nii.gz)
+    <outputcsv>        Output csv name (for extract, ".csv" will be appended)
+    <image>            Subject skeletonized image (ex. *_FAskel.nii.gz)
+    <inputcsv>         Subject ROI table written by extract (ex. *_ROIout.csv)
+
+Options:
+  --index-dir <dir>        Where to keep the skeleton index (default: $ENIGMA_INDEX_DIR or ~/.cache/enigmaDTI)
+  --debug                  Debug logging
+  -h,--help                Print this help
+
+DETAILS
+This is an in-process replacement for ROIextraction_info/singleSubjROI_exe
+(singleSubject_FA_ROI.cpp). It takes the same arguments and writes the same
+*_ROIout.csv table (Tract,Average,nVoxels), where the first row "AverageFA" is
+the average over the whole skeleton and the other rows follow the look up table.
+As in the original, only voxels with values above zero are averaged.
+
+Next to the table, extract also writes <outputcsv>_coverage.json (with the
+"_ROIout" at the end of the name replaced, ex. *_FAskel_coverage.json): how much
+of the template skeleton has data (values above zero), the coverage of every
+tract relative to the template (0 is the original "No values were found for this
+track"), the number of zero, NaN and negative voxels, and percentiles of the
+values. run_group_skeleton_coverage.py gathers these into a group table.
+Sums are accumulated in double precision, so averages can differ from the
+c++ output (which accumulated in float) in the last printed digit.
+
+Instead of scanning the whole image once per label, all label averages
+are computed in one pass using numpy.bincount over the atlas labels
+found within the template skeleton.
+
+The template skeleton and atlas never change, so which voxels are on the
+skeleton (and their labels) is worked out once and saved as a versioned index
+(flat voxel indices sorted by label, their label ids and per-label offsets).
+The index is keyed on the sha256 of both template files, memory-mapped on load,
+and rebuilt automatically if either template changes. Each subject image is then
+only gathered at the skeleton voxels. The "index" command builds it ahead of time
+(ex. before submitting a big array job).
+
+The "average" command is the replacement for averageSubjectTracts_exe
+(average_subj_tract_info.cpp). It drops the small brainstem ROIs and adds the
+bilateral and composite tracts (CC, IC, CR, ALIC...) as voxel weighted averages,
+writing the *_ROIout_avg.csv table (sorted by tract name, like the original).
+The combination rules are held as a sparse weight matrix over the base ROIs,
+so that one matrix product gives every tract for one subject
+or for a whole subjects x ROIs matrix.
+"""
+from docopt import docopt
+from collections import namedtuple
+import numpy as np
+import nibabel as nib
+import pandas as pd
+import scipy.sparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+DEBUG = False
+
+## bump this if the layout of the saved skeleton index changes
+INDEX_VERSION = 1
+
+## voxels      flat (fortran order) indices of the template skeleton voxels, sorted by label
+## labels      the atlas label of each of those voxels
+## offsets     voxels[offsets[L]:offsets[L+1]] are the skeleton voxels with label L
+SkeletonIndex = namedtuple('SkeletonIndex', ['shape', 'voxels', 'labels', 'offsets'])
+
+## indexes already loaded by this process
+_loaded_indexes = {}
+
+## ROIs that are left out of the averaged table (too small to be reliable)
+DROPPED_ROIS = ['ML-R', 'ML-L', 'ICP-R', 'ICP-L', 'SCP-R', 'SCP-L', 'CP-R', 'CP-L']
+
+## the bilateral and composite tracts and the ROIs they are averaged from
+TRACT_COMBINATIONS = [
+    ('IC-R', ['ALIC-R', 'PLIC-R', 'RLIC-R']),
+    ('IC-L', ['ALIC-L', 'PLIC-L', 'RLIC-L']),
+    ('ALIC', ['ALIC-L', 'ALIC-R']),
+    ('PLIC', ['PLIC-L', 'PLIC-R']),
+    ('RLIC', ['RLIC-L', 'RLIC-R']),
+    ('IC',   ['ALIC-R', 'PLIC-R', 'RLIC-R', 'ALIC-L', 'PLIC-L', 'RLIC-L']),
+    ('CR-R', ['ACR-R', 'SCR-R', 'PCR-R']),
+    ('CC',   ['BCC', 'GCC', 'SCC']),
+    ('CR-L', ['ACR-L', 'SCR-L', 'PCR-L']),
+    ('ACR',  ['ACR-L', 'ACR-R']),
+    ('SCR',  ['SCR-L', 'SCR-R']),
+    ('PCR',  ['PCR-L', 'PCR-R']),
+    ('CR',   ['ACR-R', 'SCR-R', 'PCR-R', 'ACR-L', 'SCR-L', 'PCR-L']),
+    ('CST',  ['CST-L', 'CST-R']),
+    ('PTR',  ['PTR-L', 'PTR-R']),
+    ('SS',   ['SS-L', 'SS-R']),
+    ('EC',   ['EC-L', 'EC-R']),
+    ('CGC',  ['CGC-L', 'CGC-R']),
+    ('CGH',  ['CGH-L', 'CGH-R']),
+    ('SLF',  ['SLF-L', 'SLF-R']),
+    ('SFO',  ['SFO-L', 'SFO-R']),
+    ('IFO',  ['IFO-L', 'IFO-R']),
+    ('FXST', ['FX/ST-L', 'FX/ST-R']),
+    ('UNC',  ['UNC-L', 'UNC-R']),
+]
+
+def read_look_up_table(lookup_table):
+    '''
+    read the tab-delimited atlas look up table
+
+    lookup_table    path to the look up table (ex. ENIGMA_look_up_table.txt)
+
+    returns a list of (label_code, label_name) tuples in file order
+    '''
+    labels = []
+    with open(lookup_table, 'r') as lut:
+        for line in lut.read().splitlines():
+            tokens = [t for t in line.split('\t') if t.strip()]
+            if len(tokens) == 0:
+                continue
+            if len(tokens) < 3:
+                raise ValueError("Wrong table format in {}. Only found {} columns".format(
+                    lookup_table, len(tokens)))
+            labels.append((int(tokens[0]), tokens[1]))
+    return labels
+
+def load_volume(nii_path):
+    '''
+    load a 3D image as a numpy array (without any datatype conversion)
+    '''
+    return np.asanyarray(nib.load(nii_path).dataobj)
+
+def file_hash(path):
+    '''
+    sha256 hex digest of a files contents
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def default_index_dir():
+    '''
+    the directory the skeleton index is cached in
+    ($ENIGMA_INDEX_DIR if set, otherwise ~/.cache/enigmaDTI)
+    '''
+    index_dir = os.getenv('ENIGMA_INDEX_DIR')
+    if index_dir == None:
+        index_dir = os.path.join(os.path.expanduser('~'), '.cache', 'enigmaDTI')
+    return index_dir
+
+def build_skeleton_index(skeleton_nii, atlas_nii):
+    '''
+    work out which voxels are on the template skeleton and their atlas labels
+
+    returns a SkeletonIndex
+    '''
+    skeleton = load_volume(skeleton_nii)
+    atlas = load_volume(atlas_nii)
+    if skeleton.shape != atlas.shape:
+        raise ValueError("Image dimensions do not match: skeleton {}, atlas {}".format(
+            skeleton.shape, atlas.shape))
+
+    voxels = np.flatnonzero(skeleton.ravel(order='F') > 0)
+    labels = atlas.ravel(order='F')[voxels].astype(np.int64)
+    if labels.min(initial=0) < 0:
+        raise ValueError("Negative labels found in atlas {}".format(atlas_nii))
+
+    order = np.argsort(labels, kind='stable')
+    voxels = voxels[order].astype(np.int64)
+    labels = labels[order].astype(np.int32)
+    offsets = np.searchsorted(labels, np.arange(labels.max(initial=0) + 2)).astype(np.int64)
+    return SkeletonIndex(skeleton.shape, voxels, labels, offsets)
+
+def save_skeleton_index(index, index_path, info):
+    '''
+    write the index arrays (plus an index.json describing them) to index_path
+    the files are written to a temporary directory first and then moved into place
+    '''
+    parent = os.path.dirname(index_path)
+    os.makedirs(parent, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+    try:
+        os.chmod(tmpdir, 0o755)
+        for name in ['voxels', 'labels', 'offsets']:
+            np.save(os.path.join(tmpdir, name + '.npy'), getattr(index, name))
+        info = dict(info, shape = list(index.shape))
+        with open(os.path.join(tmpdir, 'index.json'), 'w') as f:
+            json.dump(info, f, indent = 2)
+        os.rename(tmpdir, index_path)
+    except OSError:
+        ## another process may have just written the same index
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if not os.path.isdir(index_path):
+            raise
+
+def read_skeleton_index(index_path):
+    '''
+    memory-map a saved index
+    '''
+    with open(os.path.join(index_path, 'index.json'), 'r') as f:
+        info = json.load(f)
+    arrays = [np.load(os.path.join(index_path, name + '.npy'), mmap_mode='r')
+              for name in ['voxels', 'labels', 'offsets']]
+    return SkeletonIndex(tuple(info['shape']), *arrays)
+
+def load_skeleton_index(skeleton_nii, atlas_nii, index_dir = None):
+    '''
+    get the SkeletonIndex for these templates,
+    from this process, from the on-disk cache, or by building (and saving) it
+
+    skeleton_nii    template skeleton (ex. ENIGMA_DTI_FA_skeleton.nii.gz)
+    atlas_nii       atlas labels (ex. JHU-WhiteMatter-labels-1mm.nii.gz)
+    index_dir       where the index is cached (default: default_index_dir())
+    '''
+    if index_dir == None:
+        index_dir = default_index_dir()
+
+    stats = [os.stat(f) for f in [skeleton_nii, atlas_nii]]
+    memo_key = (os.path.realpath(skeleton_nii), os.path.realpath(atlas_nii), index_dir) + \
+        tuple((st.st_size, st.st_mtime_ns) for st in stats)
+    if memo_key in _loaded_indexes:
+        return _loaded_indexes[memo_key]
+
+    info = {'version': INDEX_VERSION,
+            'skeleton': os.path.abspath(skeleton_nii),
+            'skeleton_sha256': file_hash(skeleton_nii),
+            'atlas': os.path.abspath(atlas_nii),
+            'atlas_sha256': file_hash(atlas_nii)}
+    key = hashlib.sha256('{version}:{skeleton_sha256}:{atlas_sha256}'.format(**info).encode()).hexdigest()
+    index_path = os.path.join(index_dir, 'skeleton_index_v{}_{}'.format(INDEX_VERSION, key[:16]))
+
+    if os.path.isfile(os.path.join(index_path, 'index.json')):
+        if DEBUG: print("Reading skeleton index {}".format(index_path))
+        index = read_skeleton_index(index_path)
+    else:
+        if DEBUG: print("Building skeleton index {}".format(index_path))
+        index = build_skeleton_index(skeleton_nii, atlas_nii)
+        try:
+            save_skeleton_index(index, index_path, info)
+        except OSError as e:
+            ## not being able to cache is not a reason to stop
+            print("Could not save skeleton index to {}: {}".format(index_path, e))
+
+    _loaded_indexes[memo_key] = index
+    return index
+
+def skeleton_values(image_nii, index):
+    '''
+    read a subject image at the template skeleton voxels (in index order)
+    '''
+    data = load_volume(image_nii)
+    if data.shape != index.shape:
+        raise ValueError("Image dimensions of {} {} do not match the skeleton {}".format(
+            image_nii, data.shape, index.shape))
+    return data.ravel(order='F')[index.voxels]
+
+def roi_stats(values, index, label_codes):
+    '''
+    calculate the mean and number of voxels on the skeleton
+    for the whole skeleton and for every label in the atlas
+
+    values        subject values at the skeleton voxels (from skeleton_values)
+    index         the SkeletonIndex
+    label_codes   list of atlas label values to report
+
+    returns (whole_average, whole_nvoxels, averages, nvoxels)
+    where averages and nvoxels are arrays matching label_codes
+    '''
+    label_codes = np.asarray(label_codes, dtype=np.int64)
+    nbins = max(len(index.offsets) - 1, int(label_codes.max(initial=0)) + 1)
+
+    ## only values above zero count (this also drops nans)
+    valid = values > 0
+    valid_values = np.where(valid, values, 0).astype(np.float64)
+    sums = np.bincount(index.labels, weights=valid_values, minlength=nbins)
+    counts = np.bincount(index.labels, weights=valid, minlength=nbins).astype(np.int64)
+
+    whole_nvoxels = int(counts.sum())
+    with np.errstate(invalid='ignore', divide='ignore'):
+        whole_average = sums.sum() / whole_nvoxels
+        averages = sums[label_codes] / counts[label_codes]
+    return whole_average, whole_nvoxels, averages, counts[label_codes]
+
+def roi_label_weights(labels, label_codes):
+    '''
+    sparse matrix of shape (n_voxels, 1 + n_codes) that sums skeleton voxels
+    into the whole skeleton (first column) and into each label in label_codes
+
+    labels        atlas label of each skeleton voxel
+    label_codes   list of atlas label values to report
+    '''
+    labels = np.asarray(labels, dtype=np.int64)
+    label_codes = np.asarray(label_codes, dtype=np.int64)
+    nvoxels = len(labels)
+    code_column = np.full(max(labels.max(initial=0), label_codes.max(initial=0)) + 1, -1)
+    code_column[label_codes] = np.arange(1, len(label_codes) + 1)
+    on_label = code_column[labels]
+    in_lut = on_label > 0
+    rows = np.concatenate([np.arange(nvoxels), np.flatnonzero(in_lut)])
+    cols = np.concatenate([np.zeros(nvoxels, dtype=np.int64), on_label[in_lut]])
+    return scipy.sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, cols)),
+        shape = (nvoxels, len(label_codes) + 1))
+
+def group_roi_stats(values, labels, label_codes, chunk_size = 256):
+    '''
+    calculate the ROI averages and voxel counts for a whole group at once
+    (only values above zero count, as in roi_stats)
+
+    values        subjects x skeleton voxels array (can be a numpy memmap)
+    labels        atlas label of each skeleton voxel (column of values)
+    label_codes   list of atlas label values to report
+    chunk_size    number of subjects to hold in memory at a time
+
+    returns (averages, nvoxels), each of shape (n_subjects, 1 + len(label_codes))
+    where the first column is the whole skeleton
+    '''
+    weights = roi_label_weights(labels, label_codes)
+    nsubjects = values.shape[0]
+    sums = np.zeros((nsubjects, weights.shape[1]))
+    counts = np.zeros((nsubjects, weights.shape[1]))
+    for start in range(0, nsubjects, chunk_size):
+        chunk = np.asarray(values[start:start + chunk_size], dtype=np.float64)
+        valid = chunk > 0
+        sums[start:start + chunk_size] = np.where(valid, chunk, 0) @ weights
+        counts[start:start + chunk_size] = valid.astype(np.float64) @ weights
+    with np.errstate(invalid='ignore', divide='ignore'):
+        averages = sums / counts
+    return averages, counts.astype(np.int64)
+
+def coverage_path(outputcsv):
+    '''
+    where extract_roi writes the coverage diagnostics for an <outputcsv> name
+    '''
+    if outputcsv.endswith('_ROIout'):
+        outputcsv = outputcsv[:-len('_ROIout')]
+    return outputcsv + '_coverage.json'
+
+def coverage_stats(values, index, labels, nvoxels):
+    '''
+    the skeleton coverage diagnostics of one subject image
+
+    values        subject values at the skeleton voxels (from skeleton_values)
+    index         the SkeletonIndex
+    labels        list of (label_code, label_name) tuples (from read_look_up_table)
+    nvoxels       the number of voxels with values above zero for each label (from roi_stats)
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    valid = values > 0
+    template_nvoxels = np.diff(index.offsets)
+    tract_coverage = {}
+    for (code, name), n in zip(labels, nvoxels):
+        template_n = int(template_nvoxels[code]) if code < len(template_nvoxels) else 0
+        if template_n > 0:
+            tract_coverage[name] = round(float(n) / template_n, 4)
+    percentiles = [1, 5, 25, 50, 75, 95, 99]
+    points = np.percentile(values[valid], percentiles) if valid.any() else [np.nan] * len(percentiles)
+    worst_tract = min(tract_coverage, key=tract_coverage.get) if tract_coverage else None
+    return {'skeleton_nvoxels': int(len(values)),
+            'covered_nvoxels': int(valid.sum()),
+            'coverage': round(float(valid.mean()), 4) if len(values) > 0 else 0.0,
+            'zero_nvoxels': int((values == 0).sum()),
+            'nan_nvoxels': int(np.isnan(values).sum()),
+            'negative_nvoxels': int((values < 0).sum()),
+            'mean': float(values[valid].mean()) if valid.any() else None,
+            'std': float(values[valid].std()) if valid.any() else None,
+            'percentiles': {str(q): (None if np.isnan(v) else float(v)) for q, v in zip(percentiles, points)},
+            'worst_tract': worst_tract,
+            'worst_tract_coverage': tract_coverage[worst_tract] if worst_tract else None,
+            'empty_tracts': [name for name, coverage in tract_coverage.items() if coverage == 0],
+            'tract_coverage': tract_coverage}
+
+def write_roi_table(csvfile, rows):
+    '''
+    write a Tract,Average,nVoxels table
+    values are printed with 6 significant digits (like the c++ iostreams did)
+
+    csvfile     output path
+    rows        list of (tract, average, nvoxels)
+    '''
+    with open(csvfile, 'w') as table:
+        table.write('Tract,Average,nVoxels\n')
+        for tract, average, nvoxels in rows:
+            table.write('{},{:g},{:g}\n'.format(tract, average, nvoxels))
+
+def extract_roi(lookup_table, skeleton_nii, atlas_nii, outputcsv, image_nii, index_dir = None):
+    '''
+    the python version of singleSubjROI_exe
+    writes <outputcsv>.csv with the average along the skeleton and per ROI
+
+    lookup_table    tab-delimited look up table for the atlas
+    skeleton_nii    template skeleton (ex. ENIGMA_DTI_FA_skeleton.nii.gz)
+    atlas_nii       atlas labels (ex. JHU-WhiteMatter-labels-1mm.nii.gz)
+    outputcsv       the output name without the ".csv" extension
+    image_nii       the subjects skeletonized image (ex. FAskel.nii.gz)
+    index_dir       where the skeleton index is cached (default: default_index_dir())
+    '''
+    labels = read_look_up_table(lookup_table)
+    index = load_skeleton_index(skeleton_nii, atlas_nii, index_dir)
+    values = skeleton_values(image_nii, index)
+    whole_average, whole_nvoxels, averages, nvoxels = roi_stats(
+        values = values,
+        index = index,
+        label_codes = [code for code, name in labels])
+
+    rows = [('AverageFA', whole_average, whole_nvoxels)]
+    rows += [(name, averages[i], nvoxels[i]) for i, (code, name) in enumerate(labels)]
+    if DEBUG: print("Writing {}.csv".format(outputcsv))
+    write_roi_table(outputcsv + '.csv', rows)
+
+    ## the coverage diagnostics, while the values are in memory
+    coverage = dict(image = os.path.basename(image_nii), **coverage_stats(values, index, labels, nvoxels))
+    if DEBUG: print("Writing {}".format(coverage_path(outputcsv)))
+    with open(coverage_path(outputcsv), 'w') as f:
+        json.dump(coverage, f)
+
+def read_roi_table(csvfile):
+    '''
+    read a Tract,Average,nVoxels table
+
+    returns (tract_names, averages, nvoxels)
+    '''
+    table = pd.read_csv(csvfile, sep=',', comment='#')
+    return (table['Tract'].tolist(),
+            table['Average'].to_numpy(dtype=np.float64),
+            table['nVoxels'].to_numpy(dtype=np.float64))
+
+def tract_weights(roi_names):
+    '''
+    build the sparse weight matrix that maps the base ROIs onto the averaged tracts
+    kept base ROIs map onto themselves, composites onto each of their members
+
+    roi_names     list of the base ROI names (the Tract column of *_ROIout.csv)
+
+    returns (tract_names, weights) where weights is a
+    scipy.sparse matrix of shape (len(tract_names), len(roi_names))
+    '''
+    roi_index = {name: i for i, name in enumerate(roi_names)}
+    members = {name: [name] for name in roi_names if name not in DROPPED_ROIS}
+    for tract, rois in TRACT_COMBINATIONS:
+        missing = [roi for roi in rois if roi not in roi_index]
+        if missing:
+            raise ValueError("Cannot build {} - missing ROIs: {}".format(tract, ', '.join(missing)))
+        members.setdefault(tract, rois)
+
+    tract_names = sorted(members)
+    rows, cols = [], []
+    for row, tract in enumerate(tract_names):
+        for roi in members[tract]:
+            rows.append(row)
+            cols.append(roi_index[roi])
+    weights = scipy.sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, cols)),
+        shape = (len(tract_names), len(roi_names)))
+    return tract_names, weights
+
+def average_tracts(averages, nvoxels, roi_names):
+    '''
+    calculate the voxel weighted averages for all tracts in one matrix product
+
+    averages      ROI averages, shape (n_rois,) or (n_subjects, n_rois)
+    nvoxels       ROI voxel counts, same shape as averages
+    roi_names     list of the base ROI names (columns of averages)
+
+    returns (tract_names, tract_averages, tract_nvoxels)
+    '''
+    tract_names, weights = tract_weights(roi_names)
+    averages = np.asarray(averages, dtype=np.float64)
+    nvoxels = np.asarray(nvoxels, dtype=np.float64)
+    ## empty ROIs (nan average, 0 voxels) add nothing to the sums
+    weighted = np.where(nvoxels > 0, averages * nvoxels, 0)
+
+    tract_nvoxels = (weights @ nvoxels.T).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tract_averages = (weights @ weighted.T).T / tract_nvoxels
+    return tract_names, tract_averages, tract_nvoxels
+
+def average_subject_tracts(inputcsv, outputcsv):
+    '''
+    the python version of averageSubjectTracts_exe
+    reads a *_ROIout.csv table and writes the *_ROIout_avg.csv table
+
+    inputcsv      the ROI table from extract_roi (with ".csv")
+    outputcsv     the output table (with ".csv")
+    '''
+    roi_names, averages, nvoxels = read_roi_table(inputcsv)
+    tract_names, tract_averages, tract_nvoxels = average_tracts(averages, nvoxels, roi_names)
+    if DEBUG: print("Writing {}".format(outputcsv))
+    write_roi_table(outputcsv, zip(tract_names, tract_averages, tract_nvoxels))
+
+def main():
+
+    global DEBUG
+
+    arguments       = docopt(__doc__)
+    index_dir       = arguments['--index-dir']
+    DEBUG           = arguments['--debug']
+
+    if DEBUG: print(arguments)
+
+    if arguments['index']:
+        index = load_skeleton_index(arguments['<skeleton>'], arguments['<atlas>'], index_dir)
+        print("Skeleton index has {} voxels over {} labels".format(
+            len(index.voxels), len(index.offsets) - 1))
+
+    if arguments['extract']:
+        extract_roi(arguments['<lookup_table>'],
+                    arguments['<skeleton>'],
+                    arguments['<atlas>'],
+                    arguments['<outputcsv>'],
+                    arguments['<image>'],
+                    index_dir)
+
+    if arguments['average']:
+        average_subject_tracts(arguments['<inputcsv>'], arguments['<outputcsv>'])
+
+if __name__ == '__main__':
+    main()
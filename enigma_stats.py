@@ -0,0 +1,66 @@
+"""
+The robust z scores used by the group reports (run_group_outliers.py,
+run_group_skeleton_coverage.py, run_group_dtifit_qc.py and run_group_trace_report.py),
+so that "z > 3.5" means the same thing in all of them.
+
+robust_z scores every column of a subjects x measures array (or a single
+column) as (value - median) / spread, ignoring NaNs, where the spread is:
+
+1. 1.4826 x the median absolute deviation (MAD) - the standard deviation
+   for normally distributed values, but not pulled up by the outliers;
+2. where the MAD is 0 (more than half of the values are the same, ex. a
+   skeleton coverage of 1.0), 1.2533 x the mean absolute deviation from the
+   median (also the standard deviation for normal values);
+3. and at least MIN_RELATIVE_SPREAD (1%) of the absolute median (or the
+   min_spread given, in the units of the values), so values a fraction of a
+   percent from a (near) constant median are not scored as extreme.
+
+A column where every value is the median scores 0 (and NaN stays NaN).
+"""
+import numpy as np
+import warnings
+
+## the spread is at least this fraction of the absolute median
+MIN_RELATIVE_SPREAD = 0.01
+
+def column_medians(values):
+    '''
+    the median of every column, ignoring NaNs
+    (np.nanmedian goes column by column, so it is only used for the columns that have NaNs)
+    '''
+    has_nan = np.isnan(values).any(axis = 0)
+    median = np.full(values.shape[1:], np.nan)
+    if len(values) == 0:
+        return median
+    median[~has_nan] = np.median(values[:, ~has_nan], axis = 0)
+    if has_nan.any():
+        with warnings.catch_warnings():
+            ## an all NaN column (ex. a tract nobody has) has a NaN median
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median[has_nan] = np.nanmedian(values[:, has_nan], axis = 0)
+    return median
+
+def robust_z(values, min_spread = 0.0):
+    '''
+    robust z scores of every column of values (see above)
+
+    values          a 1D array, or a 2D array (rows x columns) scored column by column
+    min_spread      the smallest spread, in the units of the values (ex. 1 second of wall time)
+    '''
+    values = np.asarray(values, dtype = np.float64)
+    column = values.ndim == 1
+    if column:
+        values = values[:, None]
+    median = column_medians(values)
+    deviation = np.abs(values - median)
+    spread = 1.4826 * column_medians(deviation)
+    no_mad = ~(spread > 0)
+    if no_mad.any():
+        counted = ~np.isnan(deviation[:, no_mad])
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            spread[no_mad] = 1.2533 * np.nansum(deviation[:, no_mad], axis = 0) / counted.sum(axis = 0)
+    spread = np.fmax(spread, np.fmax(MIN_RELATIVE_SPREAD * np.abs(median), min_spread))
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        z = (values - median) / spread
+    z[deviation == 0] = 0.0
+    return z[:, 0] if column else z
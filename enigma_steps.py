@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Records of the pipeline steps run in an output folder, so that reruns skip the steps that are up to date.
+
+Usage:
+  enigma_steps.py status [options] <outputdir>
+  enigma_steps.py clear [options] <outputdir> [<step>...]
+
+Arguments:
+    <outputdir>        A participant output folder (ex. enigmaDTI/sub-01_ses-01)
+    <step>             Name of a step to clear (default: all of them)
+
+Options:
+  --debug                  Debug logging
+  -h,--help                Print this help
+
+DETAILS
+Each step of the participant pipeline (preproc, reg, postreg, skeletonize, ROI,
+average, QC, and the same for MD/AD/RD) declares its input files, output files and
+parameters (ex. skel_thresh, the template paths). Before running a step its key is
+worked out - a sha256 of the step name, the contents of its inputs (sha256 of each file),
+the names of its outputs and its parameters. If <outputdir>/.enigma_steps/<step>.json
+holds the same key, and the outputs are still there (with the same size and
+modification time as when they were recorded), the step is skipped.
+
+Because the inputs are hashed by content, a step that is rerun and makes the same
+outputs does not cause the steps after it to run again. Changing only the ROI
+look up table only reruns the ROI (and average) steps, and a crash only reruns
+the steps that had not finished.
+
+A step is only recorded if all of its outputs exist after it ran.
+"status" lists the recorded steps of an output folder, "clear" removes records
+(so the next run redoes those steps).
+"""
+from docopt import docopt
+import glob
+import hashlib
+import json
+import os
+import time
+
+DEBUG = False
+
+## bump this to invalidate every stored record
+STEP_CACHE_VERSION = 1
+
+## hashes of the files already read by this process, keyed by (path, size, mtime)
+_file_hashes = {}
+
+def record_dir(outputdir):
+    return os.path.join(outputdir, '.enigma_steps')
+
+def record_path(outputdir, step):
+    return os.path.join(record_dir(outputdir), step + '.json')
+
+def file_hash(path):
+    '''
+    sha256 of a files contents (remembered for as long as the file is unchanged)
+    '''
+    st = os.stat(path)
+    memo_key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        _file_hashes[memo_key] = sha.hexdigest()
+    return _file_hashes[memo_key]
+
+def step_key(step, inputs, outputs, params, outputdir):
+    '''
+    the key for a step, or None if any of its inputs are missing
+    '''
+    if not all(os.path.isfile(f) for f in inputs):
+        return None
+    description = {'version': STEP_CACHE_VERSION,
+                   'step': step,
+                   'inputs': [[os.path.basename(f), file_hash(f)] for f in inputs],
+                   'outputs': [os.path.relpath(f, outputdir) for f in outputs],
+                   'params': params}
+    return hashlib.sha256(json.dumps(description, sort_keys = True).encode()).hexdigest()
+
+def output_stats(outputs):
+    stats = {}
+    for f in outputs:
+        st = os.stat(f)
+        stats[f] = [st.st_size, st.st_mtime_ns]
+    return stats
+
+def read_record(outputdir, step):
+    try:
+        with open(record_path(outputdir, step), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def step_is_current(outputdir, step, key, outputs):
+    '''
+    True if the stored record for this step has this key and its outputs have not changed
+    '''
+    record = read_record(outputdir, step)
+    if key == None or record == None or record.get('key') != key:
+        return False
+    try:
+        return output_stats(outputs) == {f: stat for f, stat in record['outputs'].items()}
+    except FileNotFoundError:
+        return False
+
+def save_record(outputdir, step, key, inputs, outputs, params):
+    '''
+    store the record for a step that just ran
+    returns False (and stores nothing) if an output is missing
+    '''
+    missing = [f for f in outputs if not os.path.isfile(f)]
+    if key == None or len(missing) > 0:
+        print("Step {} did not make {} - it will be run again next time".format(step, ', '.join(missing)))
+        return False
+    record = {'step': step,
+              'key': key,
+              'finished': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'inputs': {f: file_hash(f) for f in inputs},
+              'params': params,
+              'outputs': output_stats(outputs)}
+    os.makedirs(record_dir(outputdir), exist_ok = True)
+    tmp_path = '{}.tmp{}'.format(record_path(outputdir, step), os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f, indent = 1)
+    os.replace(tmp_path, record_path(outputdir, step))
+    return True
+
+def clear_records(outputdir, steps = None):
+    '''
+    remove the records of these steps (or of all steps)
+    '''
+    if not steps:
+        paths = glob.glob(os.path.join(record_dir(outputdir), '*.json'))
+    else:
+        paths = [record_path(outputdir, step) for step in steps]
+    for path in paths:
+        if os.path.isfile(path):
+            if DEBUG: print("Removing {}".format(path))
+            os.remove(path)
+
+def main():
+
+    global DEBUG
+
+    arguments       = docopt(__doc__)
+    outputdir       = arguments['<outputdir>']
+    DEBUG           = arguments['--debug']
+
+    if DEBUG: print(arguments)
+
+    if arguments['status']:
+        for path in sorted(glob.glob(os.path.join(record_dir(outputdir), '*.json')),
+                           key = os.path.getmtime):
+            with open(path, 'r') as f:
+                record = json.load(f)
+            print('{:<24} {}  {}'.format(record['step'], record['finished'], record['key'][:12]))
+
+    if arguments['clear']:
+        clear_records(outputdir, arguments['<step>'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Typed, columnar (parquet) store of the group ENIGMA DTI results.
+
+Usage:
+  enigma_store.py tract [options] <store> <tract>
+  enigma_store.py export [options] <store> <metric> <outputcsv>
+
+Arguments:
+    <store>            Top directory of the results store
+    <tract>            Tract to read across all metrics (ex. CC, AverageFA)
+    <metric>           Metric to export (ex FA, MD, RD, OD)
+    <outputcsv>        Output csv name
+
+Options:
+  --metrics LIST           Comma separated list of metrics to read (default: all in the store)
+  --output-nVox            Read the "nVoxels" values instead of "Average"
+  --outputcsv CSV          Write the tract table to this csv (default: print it)
+  --debug                  Debug logging
+  -h,--help                Print this help
+
+DETAILS
+run_group_enigma_concat.py --store <store> adds to this store. The layout is
+
+  <store>/metric=<metric>/part-<timestamp>-<pid>.parquet
+
+Each part file holds one row per subject/session with the columns
+  id, subject, session     the participant folder name (ex. sub-01_ses-01) and its BIDS parts
+  source, source_size,
+  source_mtime_ns          the *_ROIout_avg.csv the row was read from
+  written                  when the row was added
+  <tract>_Average          (float64) and
+  <tract>_nVoxels          (int64) for every tract
+
+New subjects (or subjects whose csv changed) are appended as a new part file,
+so existing parts are never rewritten. When the same subject/session
+appears in more than one part, the most recently written row is the one that is read.
+Because parquet is columnar, reading one tract (across all metrics) only reads
+those columns from each part.
+
+The "tract" command prints (or writes) one tract for all metrics in the store,
+the "export" command writes a metric back out in the run_group_enigma_concat.py csv format.
+
+Requires pyarrow (used by pandas.read_parquet / DataFrame.to_parquet).
+"""
+from docopt import docopt
+import pandas as pd
+import glob
+import os
+import time
+
+DEBUG = False
+
+## what identifies a row
+STORE_KEY = ['subject', 'session']
+## the columns that describe a row (the rest are <tract>_Average and <tract>_nVoxels)
+INFO_COLUMNS = ['id', 'subject', 'session', 'source', 'source_size', 'source_mtime_ns', 'written']
+VALUE_COLUMNS = ['Average', 'nVoxels']
+
+def split_id(participant_id):
+    '''
+    split a participant folder name (ex. sub-01_ses-01) into (subject, session)
+    the session is '' when there is none
+    '''
+    if '_ses-' in participant_id:
+        subject, session = participant_id.split('_ses-', 1)
+        return subject, 'ses-' + session
+    return participant_id, ''
+
+def partition_dir(store, metric):
+    return os.path.join(store, 'metric={}'.format(metric))
+
+def store_metrics(store):
+    '''
+    the metrics that have a partition in the store
+    '''
+    return sorted(os.path.basename(d).split('=', 1)[1]
+                  for d in glob.glob(os.path.join(store, 'metric=*')))
+
+def part_files(store, metric):
+    '''
+    the part files for one metric, oldest first
+    '''
+    return sorted(glob.glob(os.path.join(partition_dir(store, metric), 'part-*.parquet')))
+
+def read_store(store, metric, columns = None):
+    '''
+    read one metric from the store as a DataFrame, keeping
+    only the most recently written row for each subject/session
+
+    columns    only read these columns (the key columns are always read)
+    '''
+    parts = part_files(store, metric)
+    if len(parts) == 0:
+        return pd.DataFrame(columns = INFO_COLUMNS if columns == None else STORE_KEY + list(columns))
+    if columns != None:
+        columns = STORE_KEY + [c for c in columns if c not in STORE_KEY]
+    tables = []
+    for part in parts:
+        if DEBUG: print("Reading {}".format(part))
+        if columns == None:
+            tables.append(pd.read_parquet(part))
+        else:
+            ## parts written before a tract was added will not have it
+            available = set(part_columns(part))
+            tables.append(pd.read_parquet(part, columns = [c for c in columns if c in available]))
+    table = pd.concat(tables, ignore_index = True)
+    return table.drop_duplicates(subset = STORE_KEY, keep = 'last').reset_index(drop = True)
+
+def part_columns(part):
+    '''
+    the column names in a part file (from the parquet schema, without reading the data)
+    '''
+    import pyarrow.parquet
+    return pyarrow.parquet.read_schema(part).names
+
+def read_tract(store, tract, metrics = None, value = 'Average'):
+    '''
+    read one tract for every metric in the store
+    returns a DataFrame with the subject and session and one column per metric
+    '''
+    if metrics == None:
+        metrics = store_metrics(store)
+    column = '{}_{}'.format(tract, value)
+    table = None
+    for metric in metrics:
+        values = read_store(store, metric, columns = ['id', column])
+        values = values.rename(columns = {column: metric})
+        if table is None:
+            table = values
+        else:
+            table = table.merge(values.drop(columns = 'id'), on = STORE_KEY, how = 'outer')
+    return table
+
+def append_store(store, metric, table):
+    '''
+    append a table (with the INFO_COLUMNS and <tract>_Average/<tract>_nVoxels columns)
+    as a new part file for this metric
+    the file is written under a temporary name and then renamed, so readers never see half a part
+    '''
+    outdir = partition_dir(store, metric)
+    os.makedirs(outdir, exist_ok = True)
+    now = time.time_ns()
+    stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(now // 10**9)) + '{:06d}'.format(now // 1000 % 10**6)
+    part = os.path.join(outdir, 'part-{}-{}.parquet'.format(stamp, os.getpid()))
+    tmp_part = os.path.join(outdir, '.tmp-' + os.path.basename(part))
+    if DEBUG: print("Writing {} rows to {}".format(len(table), part))
+    try:
+        table.to_parquet(tmp_part, index = False)
+        os.replace(tmp_part, part)
+    finally:
+        if os.path.exists(tmp_part):
+            os.remove(tmp_part)
+    return part
+
+def results_table(store, metric, value = 'Average'):
+    '''
+    the store contents for one metric in the run_group_enigma_concat.py layout
+    (id, then <tract>_<metric> columns)
+    '''
+    table = read_store(store, metric)
+    suffix = '_' + value
+    valuecols = [c for c in table.columns if c.endswith(suffix) and c not in INFO_COLUMNS]
+    results = table[['id'] + valuecols]
+    return results.rename(columns = {c: c[:-len(suffix)] + '_' + metric for c in valuecols})
+
+def main():
+
+    global DEBUG
+
+    arguments       = docopt(__doc__)
+    store           = arguments['<store>']
+    metrics         = arguments['--metrics']
+    value           = 'nVoxels' if arguments['--output-nVox'] else 'Average'
+    DEBUG           = arguments['--debug']
+
+    if DEBUG: print(arguments)
+
+    if arguments['tract']:
+        table = read_tract(store, arguments['<tract>'], metrics.split(',') if metrics else None, value)
+        if arguments['--outputcsv']:
+            table.to_csv(arguments['--outputcsv'], index = False)
+        else:
+            print(table.to_string(index = False))
+
+    if arguments['export']:
+        results = results_table(store, arguments['<metric>'], value)
+        results.to_csv(arguments['<outputcsv>'], sep=',', index = False)
+
+if __name__ == '__main__':
+    main()
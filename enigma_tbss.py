@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+In-process (nibabel/numpy) versions of some of the TBSS steps of the ENIGMA DTI pipeline.
+
+Usage:
+  enigma_tbss.py preproc [options] <image>...
+  enigma_tbss.py preproc-check [options] <image>
+  enigma_tbss.py voxel-index [options] <reference> <output>
+  enigma_tbss.py skeletonize [options] <projection> <to_target> <output>
+  enigma_tbss.py stack [options] <mask> <output> <image>...
+  enigma_tbss.py split [options] <stack> <image>...
+
+Arguments:
+    <image>            For preproc: FA image(s) to preprocess (in the current directory)
+    <reference>        Image that sets the grid of the voxel index (ex. *_FA_to_target.nii.gz)
+    <projection>       Projection index recorded for FA (ex. *_FA_projection_index.nii.gz)
+    <to_target>        Image in target space to skeletonize (ex. *_MD_to_target.nii.gz)
+    <output>           Output image
+    <mask>             Mask to apply to every image in the stack (ex. *_FA_mask.nii.gz)
+    <stack>            4D image to split back into 3D images
+    <image>            3D images to stack (or write when splitting), in volume order
+
+Options:
+  --shell-script <path>    tbss_1_preproc script to check against (default: tbss_1_preproc_noqa.sh in this repo)
+  --debug                  Debug logging
+  -h,--help                Print this help
+
+DETAILS
+tbss_1 preprocessing:
+"preproc" does what tbss_1_preproc_noqa.sh does (fslmaths -min 1 -ero -roi,
+-bin, -dilD -dilD -sub 1 -abs -add, then immv) with one read of the FA image
+and one write per output: FA/<image>_FA.nii.gz, FA/<image>_FA_mask.nii.gz,
+and the input moved into origdata/. Erosion and dilation use the 3x3x3 box
+kernel that fslmaths uses by default.
+"preproc-check" runs both the shell script (needs FSL) and "preproc" on a copy
+of the same image in temporary directories and checks that the output images
+are bit-for-bit identical (data, datatype and affine). It exits with 1 if not.
+
+Skeleton projection reuse:
+tbss_skeleton searches perpendicular to the skeleton for every skeleton voxel
+to decide which voxel projects onto it, and with "-a" it copies the value of
+the alternate image from that voxel. Running it once with an alternate image
+whose values are the voxel indices (voxel-index, 1-based, 0 = off skeleton)
+records that choice as the "projection index". Any other metric in the same
+target space can then be skeletonized with a single gather (skeletonize)
+instead of another tbss_skeleton run.
+Indices are stored as float (like every tbss_skeleton output), which is exact
+for grids of fewer than 2^24 voxels (MNI 1mm is about 7.2 million).
+
+Batched warping:
+All of the scalar maps of a subject are warped with the same FA warp.
+"stack" masks them (like fslmaths -mas) into one 4D image, so that a single
+applywarp call reads and interpolates the warp field once for all of them,
+and "split" writes the warped volumes back out as separate images.
+
+dtifit scalar maps:
+dtifit_scalar_maps() makes the masked MD, AD (L1) and RD ((L2 + L3) / 2)
+images in memory from one read of each dtifit image, so they can be written
+straight out for (or stacked for) applywarp without intermediate copies.
+"""
+from docopt import docopt
+import numpy as np
+import nibabel as nib
+import scipy.ndimage
+import datetime
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+
+DEBUG = False
+
+## largest integer that float32 holds exactly
+MAX_FLOAT_INDEX = 2**24
+
+def save_like(data, reference_img, output_nii, dtype = np.float32):
+    '''
+    write data to output_nii with the affine and header of reference_img
+    '''
+    img = nib.Nifti1Image(data.astype(dtype), reference_img.affine, reference_img.header)
+    img.set_data_dtype(dtype)
+    img.header.set_slope_inter(1, 0)
+    img.to_filename(output_nii)
+
+def image_stem(image_nii):
+    '''
+    the image filename without the directory or nifti extension (like imglob)
+    '''
+    stem = os.path.basename(image_nii)
+    for ext in ['.nii.gz', '.nii']:
+        if stem.endswith(ext):
+            return stem[:-len(ext)]
+    return stem
+
+def tbss_1_preproc(image_nii):
+    '''
+    the python version of tbss_1_preproc_noqa.sh for one FA image
+    outputs are written next to the image (which is moved into origdata/)
+
+    image_nii       the FA image (ex. sub-01_desc-dtifit.nii.gz)
+
+    returns the paths to the FA/<image>_FA.nii.gz and FA/<image>_FA_mask.nii.gz images
+    '''
+    workdir = os.path.dirname(os.path.abspath(image_nii))
+    stem = image_stem(image_nii)
+    FA_dir = os.path.join(workdir, 'FA')
+    os.makedirs(FA_dir, exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'origdata'), exist_ok=True)
+    FA_out = os.path.join(FA_dir, stem + '_FA.nii.gz')
+    mask_out = os.path.join(FA_dir, stem + '_FA_mask.nii.gz')
+
+    with open(os.path.join(workdir, '.tbsslog'), 'a') as log:
+        log.write('[{}] [{}] [{}] [enigma_tbss.tbss_1_preproc {}]\n'.format(
+            datetime.datetime.now().ctime(), socket.gethostname(), workdir, image_nii))
+
+    img = nib.load(image_nii)
+    kernel = np.ones((3, 3, 3), dtype=bool)
+
+    # erode a little and zero end slices (fslmaths -min 1 -ero -roi 1 X 1 Y 1 Z 0 1)
+    FA = np.minimum(img.get_fdata(dtype=np.float32), 1)
+    FA[~scipy.ndimage.binary_erosion(FA != 0, structure=kernel, border_value=1)] = 0
+    FA[[0, -1], :, :] = 0
+    FA[:, [0, -1], :] = 0
+    FA[:, :, [0, -1]] = 0
+    if DEBUG: print("Writing {}".format(FA_out))
+    save_like(FA, img, FA_out, dtype = img.get_data_dtype())
+
+    # create mask (for use in FLIRT & FNIRT)
+    # fslmaths -bin then -dilD -dilD -sub 1 -abs -add <mask> -odt char
+    mask = FA > 0
+    dilated = scipy.ndimage.binary_dilation(mask, structure=kernel, iterations=2)
+    if DEBUG: print("Writing {}".format(mask_out))
+    save_like(~dilated | mask, img, mask_out, dtype = np.uint8)
+
+    # move the input into origdata (immv)
+    shutil.move(image_nii, os.path.join(workdir, 'origdata', os.path.basename(image_nii)))
+    return FA_out, mask_out
+
+def check_preproc(image_nii, shell_script):
+    '''
+    run tbss_1_preproc_noqa.sh and tbss_1_preproc on copies of image_nii
+    and check that the outputs are bit-for-bit identical
+
+    returns True if all outputs match
+    '''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        workdirs = {}
+        for version in ['shell', 'python']:
+            workdirs[version] = os.path.join(tmpdir, version)
+            os.makedirs(workdirs[version])
+            shutil.copy(image_nii, workdirs[version])
+        image = os.path.basename(image_nii)
+        subprocess.check_call([shell_script, image], cwd = workdirs['shell'])
+        tbss_1_preproc(os.path.join(workdirs['python'], image))
+
+        stem = image_stem(image_nii)
+        all_match = True
+        for output in [os.path.join('FA', stem + '_FA.nii.gz'),
+                       os.path.join('FA', stem + '_FA_mask.nii.gz'),
+                       os.path.join('origdata', image)]:
+            shell_img = nib.load(os.path.join(workdirs['shell'], output))
+            python_img = nib.load(os.path.join(workdirs['python'], output))
+            match = (shell_img.get_data_dtype() == python_img.get_data_dtype() and
+                     np.array_equal(shell_img.affine, python_img.affine) and
+                     np.array_equal(np.asanyarray(shell_img.dataobj),
+                                    np.asanyarray(python_img.dataobj)))
+            print("{}: {}".format(output, 'identical' if match else 'DIFFERENT'))
+            all_match = all_match and match
+    finally:
+        shutil.rmtree(tmpdir)
+    return all_match
+
+def write_voxel_index(reference_nii, output_nii):
+    '''
+    write an image whose values are the (1-based, fortran order) voxel indices
+    used as the "-a" input to tbss_skeleton to record the skeleton projection
+
+    reference_nii   image that sets the grid (ex. FA_to_target.nii.gz)
+    output_nii      the voxel index image
+    '''
+    ref = nib.load(reference_nii)
+    shape = ref.shape[:3]
+    nvoxels = int(np.prod(shape))
+    if nvoxels >= MAX_FLOAT_INDEX:
+        raise ValueError("{} has too many voxels ({}) to index with float".format(
+            reference_nii, nvoxels))
+    index = np.arange(1, nvoxels + 1, dtype=np.float32).reshape(shape, order='F')
+    if DEBUG: print("Writing voxel index {}".format(output_nii))
+    save_like(index, ref, output_nii)
+
+def read_projection(projection_nii):
+    '''
+    read a projection index image as flat (0-based, fortran order) source voxels
+    returns (skeleton_voxels, source_voxels, shape)
+    '''
+    projection = np.asanyarray(nib.load(projection_nii).dataobj)
+    source = np.rint(projection.ravel(order='F')).astype(np.int64)
+    skeleton_voxels = np.flatnonzero(source > 0)
+    return skeleton_voxels, source[skeleton_voxels] - 1, projection.shape[:3]
+
+def skeletonize_from_projection(projection_nii, to_target_nii, output_nii):
+    '''
+    skeletonize an image in target space using a recorded projection index
+    (gives the same result as tbss_skeleton ... -a to_target_nii)
+
+    projection_nii  projection index (see write_voxel_index)
+    to_target_nii   image in target space (ex. MD_to_target.nii.gz)
+    output_nii      skeletonized output (ex. MDskel.nii.gz)
+    '''
+    skeleton_voxels, source_voxels, shape = read_projection(projection_nii)
+    target = nib.load(to_target_nii)
+    data = np.asanyarray(target.dataobj)
+    if data.shape[:3] != shape:
+        raise ValueError("Image dimensions of {} {} do not match the projection {}".format(
+            to_target_nii, data.shape, shape))
+
+    skel = np.zeros(int(np.prod(shape)), dtype=np.float32)
+    skel[skeleton_voxels] = data.ravel(order='F')[source_voxels]
+    if DEBUG: print("Writing {}".format(output_nii))
+    save_like(skel.reshape(shape, order='F'), target, output_nii)
+
+def read_mask(mask_nii):
+    '''
+    read a mask image as a boolean array (mask above 0, like fslmaths -mas)
+    '''
+    return np.asanyarray(nib.load(mask_nii).dataobj) > 0
+
+def write_stack(volumes, reference_img, output_nii):
+    '''
+    write a list of 3D arrays as the volumes of one 4D image
+    '''
+    if DEBUG: print("Writing {}".format(output_nii))
+    save_like(np.stack(volumes, axis=-1), reference_img, output_nii)
+
+def stack_masked(images_nii, mask_nii, output_nii):
+    '''
+    mask 3D images (voxels where the mask is not above 0 are set to 0)
+    and write them as the volumes of one 4D image
+
+    images_nii      list of 3D images (all on the same grid)
+    mask_nii        mask image (ex. FA_mask.nii.gz)
+    output_nii      the 4D output
+    '''
+    mask = read_mask(mask_nii)
+    volumes = []
+    for image_nii in images_nii:
+        data = nib.load(image_nii).get_fdata(dtype=np.float32)
+        if data.shape != mask.shape:
+            raise ValueError("Image dimensions of {} {} do not match the mask {}".format(
+                image_nii, data.shape, mask.shape))
+        volumes.append(np.where(mask, data, 0))
+    write_stack(volumes, nib.load(images_nii[0]), output_nii)
+
+def dtifit_scalar_maps(FAmap, DTItags, mask_nii, recalc_MD = False):
+    '''
+    calculate the masked non-FA maps of a dtifit output in memory
+    MD is dtifits _MD (or the mean of L1, L2 and L3 if recalc_MD),
+    AD is _L1 and RD is the mean of _L2 and _L3.
+    Each dtifit image is read at most once, whatever maps are asked for.
+
+    FAmap       the dtifit FA image (other images are found by replacing "FA.nii.gz")
+    DTItags     list of maps to make (MD, AD or RD)
+    mask_nii    mask image (ex. FA_mask.nii.gz)
+    recalc_MD   recalculate MD from the eigenvalues instead of reading _MD
+
+    returns (reference_img, list of float32 arrays in the order of DTItags)
+    '''
+    mask = read_mask(mask_nii)
+    loaded = {}
+    def dtifit_image(suffix):
+        if suffix not in loaded:
+            image_nii = FAmap.replace('FA.nii.gz', suffix + '.nii.gz')
+            if DEBUG: print("Reading {}".format(image_nii))
+            img = nib.load(image_nii)
+            data = img.get_fdata(dtype=np.float32)
+            if data.shape != mask.shape:
+                raise ValueError("Image dimensions of {} {} do not match the mask {}".format(
+                    image_nii, data.shape, mask.shape))
+            loaded[suffix] = (img, data)
+        return loaded[suffix][1]
+
+    volumes = []
+    for DTItag in DTItags:
+        if DTItag == 'MD' and not recalc_MD:
+            data = dtifit_image('MD')
+        elif DTItag == 'MD':
+            data = (dtifit_image('L1') + dtifit_image('L2') + dtifit_image('L3')) / np.float32(3)
+        elif DTItag == 'AD':
+            data = dtifit_image('L1')
+        elif DTItag == 'RD':
+            data = (dtifit_image('L2') + dtifit_image('L3')) / np.float32(2)
+        else:
+            raise ValueError("Don't know how to make {} from dtifit outputs".format(DTItag))
+        volumes.append(np.where(mask, data, 0).astype(np.float32))
+
+    reference_img = next(iter(loaded.values()))[0]
+    return reference_img, volumes
+
+def split_volumes(stack_nii, outputs_nii):
+    '''
+    write each volume of a 4D image out as a 3D image
+
+    stack_nii       the 4D image
+    outputs_nii     list of output paths, one per volume
+    '''
+    stack = nib.load(stack_nii)
+    data = np.asanyarray(stack.dataobj)
+    if data.ndim != 4 or data.shape[3] != len(outputs_nii):
+        raise ValueError("{} has shape {} but {} outputs were given".format(
+            stack_nii, data.shape, len(outputs_nii)))
+    for i, output_nii in enumerate(outputs_nii):
+        if DEBUG: print("Writing {}".format(output_nii))
+        save_like(data[..., i], stack, output_nii)
+
+def main():
+
+    global DEBUG
+
+    arguments       = docopt(__doc__)
+    DEBUG           = arguments['--debug']
+
+    if DEBUG: print(arguments)
+
+    if arguments['preproc']:
+        for image_nii in arguments['<image>']:
+            print("processing {}".format(image_nii))
+            tbss_1_preproc(image_nii)
+
+    if arguments['preproc-check']:
+        shell_script = arguments['--shell-script']
+        if shell_script == None:
+            shell_script = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                        'tbss_1_preproc_noqa.sh')
+        if not check_preproc(arguments['<image>'][0], shell_script):
+            sys.exit(1)
+
+    if arguments['voxel-index']:
+        write_voxel_index(arguments['<reference>'], arguments['<output>'])
+
+    if arguments['skeletonize']:
+        skeletonize_from_projection(arguments['<projection>'],
+                                    arguments['<to_target>'],
+                                    arguments['<output>'])
+
+    if arguments['stack']:
+        stack_masked(arguments['<image>'], arguments['<mask>'], arguments['<output>'])
+
+    if arguments['split']:
+        split_volumes(arguments['<stack>'], arguments['<image>'])
+
+if __name__ == '__main__':
+    main()
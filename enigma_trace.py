@@ -0,0 +1,131 @@
+"""
+Timing and resource traces of the participant pipelines.
+
+Each run of a participant script appends JSON lines to <outputdir>/enigma_trace.jsonl,
+one per external command, one per pipeline step and one for the whole run.
+Every line has:
+    kind          'command', 'step' or 'run'
+    name          the command (ex. tbss_2_reg), the step (ex. reg, skeletonize_MD) or the script
+    participant   the participant output folder name (ex. sub-01_ses-01)
+    host, pid     where it ran
+    run_id        the same for every line of one run of the script
+    start         when it started (seconds since the epoch)
+    wall          wall time in seconds
+    cpu           user + system CPU time in seconds
+    max_rss_mb    peak resident memory in MB
+    status        'done' or 'failed' (commands also have the returncode and cmd)
+Steps and runs also have:
+    process_max_rss_mb  the peak resident memory of this python process so far
+
+For a command the CPU time and peak memory are those of that command alone
+(from os.wait4, the per child version of resource.getrusage(RUSAGE_CHILDREN)).
+For a step the CPU time is the change in getrusage of this process and all its
+children, and max_rss_mb is the largest of the commands run in that step (0 for
+a step that runs no commands). The in process steps (ex. the ROI extraction or
+the QC images) have no peak of their own: getrusage only gives the high water
+mark of the whole process, so process_max_rss_mb is the peak of every step run
+so far, not of this one. For a run max_rss_mb is the largest of everything (its
+commands and the python processes of its steps), the memory a job needs.
+
+run_group_trace_report.py gathers the traces of a group into per step percentiles.
+"""
+import json
+import os
+import resource
+import socket
+import time
+
+TRACE_NAME = 'enigma_trace.jsonl'
+
+## ru_maxrss is in KB on linux (and in bytes on macOS), this turns it into KB
+RSS_SCALE = 1 / 1024.0 if os.uname().sysname == 'Darwin' else 1
+
+## one id for every line written by this run (worker processes get it from the environment)
+RUN_ID = os.environ.setdefault('ENIGMA_TRACE_RUN_ID',
+                               '{}-{}-{}'.format(socket.gethostname(), os.getpid(), int(time.time())))
+
+def trace_path(outputdir):
+    return os.path.join(outputdir, TRACE_NAME)
+
+def rusage_mb(maxrss):
+    return round(maxrss * RSS_SCALE / 1024.0, 1)
+
+def cpu_time(usage):
+    return usage.ru_utime + usage.ru_stime
+
+def snapshot():
+    '''
+    what a step started with (see since)
+    '''
+    return {'start': time.time(),
+            'wall': time.monotonic(),
+            'cpu': cpu_time(resource.getrusage(resource.RUSAGE_SELF)) +
+                   cpu_time(resource.getrusage(resource.RUSAGE_CHILDREN))}
+
+def since(start, kind, name, status = 'done', commands = ()):
+    '''
+    the trace line for a step (or run) that started at the snapshot start
+    commands are the trace lines of the commands it ran (for their peak memory),
+    for a run the lines of all its commands and steps
+    '''
+    cpu = cpu_time(resource.getrusage(resource.RUSAGE_SELF)) + \
+          cpu_time(resource.getrusage(resource.RUSAGE_CHILDREN))
+    self_rss = rusage_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    peaks = [c['max_rss_mb'] for c in commands]
+    if kind == 'run':
+        peaks += [self_rss] + [c.get('process_max_rss_mb', 0.0) for c in commands]
+    return {'kind': kind,
+            'name': name,
+            'start': round(start['start'], 3),
+            'wall': round(time.monotonic() - start['wall'], 3),
+            'cpu': round(cpu - start['cpu'], 3),
+            'max_rss_mb': max(peaks + [0.0]),
+            'process_max_rss_mb': self_rss,
+            'status': status}
+
+def command_line(cmdlist, start, wall, usage, returncode, attempt):
+    '''
+    the trace line for one command, from its os.wait4 resource usage
+    '''
+    return {'kind': 'command',
+            'name': os.path.basename(cmdlist[0]),
+            'start': round(start, 3),
+            'wall': round(wall, 3),
+            'cpu': round(cpu_time(usage), 3) if usage != None else 0.0,
+            'max_rss_mb': rusage_mb(usage.ru_maxrss) if usage != None else 0.0,
+            'status': 'done' if returncode == 0 else 'failed',
+            'returncode': returncode,
+            'attempt': attempt,
+            'cmd': ' '.join(cmdlist)}
+
+def write_line(path, line):
+    '''
+    append one line to the trace at path (a no-op if path is None)
+    the line is written with a single O_APPEND write so that worker processes can share the file
+    '''
+    if path == None:
+        return
+    line = dict(line,
+                participant = os.path.basename(os.path.dirname(os.path.abspath(path))),
+                host = socket.gethostname(),
+                pid = os.getpid(),
+                run_id = RUN_ID)
+    data = (json.dumps(line) + '\n').encode()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+def read_trace(path):
+    '''
+    the lines of one trace file (lines that are not complete JSON are skipped)
+    '''
+    lines = []
+    with open(path, 'r') as f:
+        for text in f:
+            try:
+                lines.append(json.loads(text))
+            except ValueError:
+                pass
+    return lines
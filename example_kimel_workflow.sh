@@ -94,7 +94,7 @@ ENIGMA_DTI_OUT=${OUT_DIR}/enigmaDTI
 
 mkdir -p ${ENIGMA_DTI_OUT}
 
-python ${CODE_DIR}/run_participant_enigma_extract.py --calc-all --debug \
+python ${CODE_DIR}/run_participant_enigma_extract.py --calc-all --n-jobs 3 --debug \
   ${ENIGMA_DTI_OUT}/sub-${subject_id}_${session} ${DTIFIT_OUT}_FA.nii.gz
 
 
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Runs the ENIGMA DTI participant pipeline for every FA map in a dtifit folder, on this machine.
+
+Usage:
+  run_cohort_enigma_extract.py [options] <dtifitdir> <outputdir>
+
+Arguments:
+    <dtifitdir>        Top directory of the dtifit outputs (ex. <OUT_DIR>/dtifit in BIDS layout)
+    <outputdir>        Top directory for the enigmaDTI outputs (one folder per participant is made in here)
+
+Options:
+  --n-jobs N               Number of participants to run at the same time (default = CPUs / threads per job)
+  --threads-per-job N      Number of threads each participant may use (default = 1)
+  --fa-pattern STR         Glob (under dtifitdir) for the FA maps (default = '**/*FA.nii.gz')
+  --logdir DIR             Where to write the participant logs and status (default = <outputdir>/logs)
+  --status-interval SEC    How often (in seconds) to print the running status (default = 60)
+  --calc-MD                Option to process MD image as well
+  --calc-all               Option to process MD, AD and RD
+  --batch-warp             Mask and warp all the non-FA maps together in one applywarp call
+  --recalc-MD              Calculate MD as the mean of L1, L2 and L3 (instead of using the dtifit MD image)
+  -v,--verbose             Verbose logging
+  --debug                  Debug logging in Erin's very verbose style (also passed to the participants)
+  -n,--dry-run             Print what would be run
+  -h,--help                Print this help
+
+DETAILS
+This replaces the SLURM array in example_kimel_workflow.sh (step 3) when all the work
+can be done on one (big) machine. Every FA map under <dtifitdir> matching the
+"--fa-pattern" is found, and run_participant_enigma_extract.py is run on each,
+with at most --n-jobs running at the same time (a ProcessPoolExecutor).
+
+Each participant is written to <outputdir>/<participant> where <participant> is made from
+the BIDS sub- and ses- entities of the FA map name (ex. sub-01_ses-01),
+like the ${ENIGMA_DTI_OUT}/sub-${subject_id}_${session} folders of the example workflow.
+Each participant is run as its own process in its own folder, with its own TMPDIR
+(<outputdir>/<participant>/tmp, removed when the participant finishes without an error),
+and its output going to <logdir>/<participant>.log.
+Participants that already have their *_FAskel_ROIout_avg.csv are skipped.
+
+To keep the machine from being oversubscribed each participant gets --threads-per-job
+threads through OMP_NUM_THREADS (also MKL_NUM_THREADS / OPENBLAS_NUM_THREADS for numpy),
+and FSLSUB_PARALLEL (so any fsl_sub calls run locally with that many jobs).
+
+Progress is printed as participants finish (and every --status-interval seconds), and
+the status of every participant is written to <logdir>/cohort_status.csv.
+Exits with an error if any participant failed.
+"""
+from docopt import docopt
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+import glob
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+DRYRUN = False
+DEBUG = False
+VERBOSE = False
+
+## the thread settings handed to every participant
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'FSLSUB_PARALLEL']
+
+def participant_id(FAmap):
+    '''
+    the participant folder name for an FA map - the BIDS sub- and ses- entities of the name
+    (ex. sub-01_ses-01) or the name without the "_FA.nii.gz" if there are none
+    '''
+    name = os.path.basename(FAmap)
+    entities = re.findall(r'(?:^|_)((?:sub|ses)-[a-zA-Z0-9]+)', name)
+    if len(entities) > 0:
+        return '_'.join(entities)
+    return name.replace('_FA.nii.gz', '').replace('FA.nii.gz', '')
+
+def is_done(FAmap, participant_dir):
+    '''
+    True if the participant pipeline already wrote the FA ROI averages
+    '''
+    image_noext = os.path.basename(FAmap.replace('_FA.nii.gz',''))
+    return os.path.isfile(os.path.join(participant_dir, 'ROI', image_noext + '_FAskel_ROIout_avg.csv'))
+
+def thread_env(threads):
+    '''
+    the environment for one participant, limited to this many threads
+    '''
+    env = dict(os.environ)
+    for var in THREAD_VARIABLES:
+        env[var] = str(threads)
+    return env
+
+def run_participant(cmd, participant_dir, logfile, threads):
+    '''
+    runs one participant (in a worker process), returns (returncode, seconds)
+    '''
+    start = time.time()
+    env = thread_env(threads)
+    env['TMPDIR'] = os.path.join(participant_dir, 'tmp')
+    os.makedirs(env['TMPDIR'], exist_ok = True)
+    with open(logfile, 'w') as log:
+        log.write(' '.join(cmd) + '\n')
+        log.flush()
+        returncode = subprocess.call(cmd, cwd = participant_dir, env = env,
+                                     stdout = log, stderr = subprocess.STDOUT)
+    if returncode == 0:
+        ## kept after a failure, to look at
+        shutil.rmtree(env['TMPDIR'], ignore_errors = True)
+    return returncode, time.time() - start
+
+def print_status(status, total, start):
+    counts = status['status'].value_counts()
+    finished = counts.get('done', 0) + counts.get('failed', 0)
+    line = '[{}/{}] {} done, {} failed, {} running, {} waiting - {:.0f}s elapsed'.format(
+        finished, total, counts.get('done', 0), counts.get('failed', 0),
+        counts.get('running', 0), counts.get('waiting', 0), time.time() - start)
+    ## a rough guess at the time left from the participants finished so far
+    if finished > 0 and finished < total:
+        line += ', about {:.0f}s left'.format((time.time() - start) / finished * (total - finished))
+    print(line, flush = True)
+
+def main():
+
+    global DEBUG
+    global VERBOSE
+    global DRYRUN
+
+    arguments       = docopt(__doc__)
+    dtifitdir       = arguments['<dtifitdir>']
+    outputdir       = arguments['<outputdir>']
+    n_jobs          = arguments['--n-jobs']
+    threads         = arguments['--threads-per-job']
+    fa_pattern      = arguments['--fa-pattern']
+    logdir          = arguments['--logdir']
+    status_interval = arguments['--status-interval']
+    VERBOSE         = arguments['--verbose']
+    DEBUG           = arguments['--debug']
+    DRYRUN          = arguments['--dry-run']
+
+    if DEBUG: print(arguments)
+
+    outputdir = os.path.abspath(outputdir)
+    if fa_pattern == None: fa_pattern = '**/*FA.nii.gz'
+    if logdir == None: logdir = os.path.join(outputdir, 'logs')
+    threads = 1 if threads == None else int(threads)
+    if n_jobs == None:
+        n_jobs = max(1, len(os.sched_getaffinity(0)) // threads)
+    n_jobs = int(n_jobs)
+    status_interval = 60 if status_interval == None else float(status_interval)
+
+    ## the participant script lives next to this one
+    participant_script = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                      'run_participant_enigma_extract.py')
+    participant_options = [opt for opt in ['--calc-MD', '--calc-all', '--batch-warp', '--recalc-MD', '--debug']
+                           if arguments[opt]]
+
+    ## find the FA maps (and make sure they go to different folders)
+    FAmaps = sorted(glob.glob(os.path.join(dtifitdir, fa_pattern), recursive = True))
+    if len(FAmaps) == 0:
+        sys.exit('Could not find any FA maps matching {}'.format(os.path.join(dtifitdir, fa_pattern)))
+    status = pd.DataFrame({'FAmap': [os.path.abspath(f) for f in FAmaps]})
+    status.insert(0, 'participant', [participant_id(f) for f in FAmaps])
+    duplicates = status['participant'][status['participant'].duplicated()]
+    if len(duplicates) > 0:
+        sys.exit('More than one FA map for: {}'.format(', '.join(duplicates.unique())))
+    status['outputdir'] = [os.path.join(outputdir, p) for p in status['participant']]
+    status['status'] = ['skipped' if is_done(f, d) else 'waiting'
+                        for f, d in zip(status['FAmap'], status['outputdir'])]
+    status['seconds'] = float('nan')
+
+    todo = status.index[status['status'] == 'waiting']
+    print('Found {} FA maps, {} to run ({} already done), {} at a time with {} thread(s) each'.format(
+        len(status), len(todo), len(status) - len(todo), n_jobs, threads), flush = True)
+
+    cmds = {}
+    for i in todo:
+        cmds[i] = [sys.executable, participant_script] + participant_options + \
+            [status.loc[i, 'outputdir'], status.loc[i, 'FAmap']]
+        if DEBUG or DRYRUN: print(' '.join(cmds[i]))
+    if DRYRUN or len(todo) == 0:
+        return
+
+    os.makedirs(logdir, exist_ok = True)
+    start = time.time()
+    with ProcessPoolExecutor(max_workers = n_jobs) as pool:
+        futures = {}
+        for i in todo:
+            os.makedirs(status.loc[i, 'outputdir'], exist_ok = True)
+            logfile = os.path.join(logdir, status.loc[i, 'participant'] + '.log')
+            futures[pool.submit(run_participant, cmds[i], status.loc[i, 'outputdir'], logfile, threads)] = i
+        status.loc[todo[:n_jobs], 'status'] = 'running'
+
+        pending = set(futures)
+        while pending:
+            finished, pending = wait(pending, timeout = status_interval, return_when = FIRST_COMPLETED)
+            for future in finished:
+                i = futures[future]
+                try:
+                    returncode, seconds = future.result()
+                except Exception as e:
+                    returncode, seconds = str(e), float('nan')
+                status.loc[i, 'seconds'] = seconds
+                status.loc[i, 'status'] = 'done' if returncode == 0 else 'failed'
+                if returncode != 0 or VERBOSE:
+                    print('{} {} ({:.0f}s)'.format(status.loc[i, 'participant'],
+                                                  status.loc[i, 'status'], seconds), flush = True)
+            ## the executor starts the waiting participants in order
+            n_running = min(n_jobs, len(pending))
+            waiting = [futures[f] for f in futures if f in pending]
+            status.loc[waiting, 'status'] = 'waiting'
+            status.loc[sorted(waiting)[:n_running], 'status'] = 'running'
+            print_status(status.loc[todo], len(todo), start)
+
+    status.to_csv(os.path.join(logdir, 'cohort_status.csv'), index = False)
+    failed = status['participant'][status['status'] == 'failed']
+    if len(failed) > 0:
+        sys.exit('{} participant(s) failed (see {}): {}'.format(len(failed), logdir, ', '.join(failed)))
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@ Options:
   --QCdir <path>           Full path to location of QC outputs (defalt: <outputdir>/QC')
   --tag <tag>              Only QC files with this string in their filename (ex.'DTI60')
   --subject <subid>        Only process the subjects given (good for debugging, default is to do all subs in folder)
+  --sse-threshold N        Count the voxels with an SSE above N as badly fit (default = 50)
   -v,--verbose             Verbose logging
   --debug                  Debug logging in Erin's very verbose style
   -n,--dry-run             Dry run
@@ -22,30 +23,42 @@ This creates some QC outputs from of ditfit pipeline stuff.
 QC outputs are placed within <outputdir>/QC unless specified otherwise ("--QCdir <path").
 Right now QC constist of pictures for every subject.
 Pictures are assembled in html pages for quick viewing.
+The direction pictures (V1 in color where FA > 0.15, see enigma_qc.direction_map)
+are drawn in this process with numpy and Pillow, from the FA and V1 images.
+
+The SSE of the fit is also summarized for every subject, within the brain mask
+(the voxels dtifit fit, where the FA is above zero): the mean, median, 95th and
+99th percentile SSE, the fraction of voxels above "--sse-threshold", and the mean
+SSE of every (axial, in the native space) slice. A slice with a much higher SSE than
+the others is often a slice dropout (worst_slice_ratio is the highest slice mean
+over the median slice mean). The summaries are kept in error/<subject>_sse_stats.json
+(remade when the SSE image is newer) and gathered into:
+    dtifit_sse_summary.csv   one row per subject, the worst first
+    dtifit_sse_slices.csv    the per slice means of every subject
+    qc_sse_ranked.html       the SSE pictures in the same (worst first) order
+Subjects are ranked by their badness: the highest of their group robust z scores
+(median / MAD over the subjects, see enigma_stats.py) of the mean SSE, 99th percentile SSE, fraction
+above the threshold and worst slice ratio.
 
 The inspiration for these QC practices come from engigma DTI
 http://enigma.ini.usc.edu/wp-content/uploads/DTI_Protocols/ENIGMA_FA_Skel_QC_protocol_USC.pdf
 
-Future plan: add section that checks results for normality and identifies outliers..
+To check the results for normality and find the outliers, see run_group_outliers.py
 
-Requires datman python enviroment, FSL and imagemagick.
+Requires nibabel, nilearn and Pillow (FSL and imagemagick are no longer needed).
 
 Written by Erin W Dickie, August 25 2015
 """
 from docopt import docopt
 import os
 import nilearn.plotting
-import tempfile
-import shutil
+import nibabel as nib
+import numpy as np
+import pandas as pd
 import glob
-import subprocess
-import sys
-
-### Erin's little function for running things in the shell
-def docmd(cmdlist):
-    "sends a command (inputed as a list) to the shell"
-    if DEBUG: print(' '.join(cmdlist))
-    if not DRYRUN: subprocess.call(cmdlist)
+import json
+import enigma_qc
+import enigma_stats
 
 def main():
 
@@ -57,17 +70,14 @@ def main():
     QCdir           = arguments['--QCdir']
     TAG             = arguments['--tag']
     SUBID           = arguments['--subject']
+    sse_threshold   = arguments['--sse-threshold']
     VERBOSE         = arguments['--verbose']
     DEBUG           = arguments['--debug']
     DRYRUN          = arguments['--dry-run']
 
     if DEBUG: print(arguments)
     if QCdir == None: QCdir = os.path.join(dtifitdir,'QC')
-
-    ## check that FSL has been loaded - if not exists
-    FSLDIR = os.getenv('FSLDIR')
-    if FSLDIR==None:
-        sys.exit("FSLDIR environment variable is undefined. Try again.")
+    sse_threshold = 50.0 if sse_threshold == None else float(sse_threshold)
 
 
     ## find the files that match the resutls tag...first using the place it should be from doInd-enigma-dti.py
@@ -89,11 +99,6 @@ def main():
     if DEBUG : print("FAmaps after filtering: {}".format(allFAmaps))
     allFAmaps = [ v for v in allFAmaps if "PHA" not in v ] ## remove the phantoms from the list
 
-    #mkdir a tmpdir for the
-    tmpdirbase = tempfile.mkdtemp()
-    # tmpdirbase = os.path.join(QCdir,'tmp')
-    # dm.utils.makedirs(tmpdirbase)
-
     # make the output directories
     # QC_bet_dir = os.path.join(QCdir,'BET')
     QC_V1_dir = os.path.join(QCdir, 'directions')
@@ -106,12 +111,11 @@ def main():
     #maskpics = []
     ssepics = []
     V1pics = []
+    sse_stats = []
     for FAmap in allFAmaps:
         ## manipulate the full path to the FA map to get the other stuff
         basename = os.path.basename(FAmap).replace('_desc-dtifit_FA.nii.gz','')
         pathbase = FAmap.replace('_desc-dtifit_FA.nii.gz','')
-        tmpdir = os.path.join(tmpdirbase,basename)
-        os.makedirs(tmpdir)
 
         # maskpic = os.path.join(QC_bet_dir,basename + 'b0_bet_mask.gif')
         # maskpics.append(maskpic)
@@ -124,10 +128,18 @@ def main():
             #mask_overlay(pathbase + '_desc-dtifit_sse.nii.gz',"", ssepic, tmpdir)
             sse_plots(pathbase + '_desc-dtifit_sse.nii.gz', ssepic, display_mode = "y")
 
-        V1pic = os.path.join(QC_V1_dir,basename + 'dtifit_V1.gif')
+        stats_json = os.path.join(QC_sse_dir, basename + '_sse_stats.json')
+        stats = subject_sse_stats(FAmap, pathbase + '_desc-dtifit_sse.nii.gz', stats_json, sse_threshold)
+        if stats != None:
+            stats['pic'] = ssepic
+            sse_stats.append(stats)
+
+        V1pic = os.path.join(QC_V1_dir,basename + 'dtifit_V1.png')
         V1pics.append(V1pic)
         if os.path.exists(V1pic) == False:
-            V1_overlay(FAmap,pathbase + '_desc-dtifit_V1.nii.gz', V1pic, tmpdir)
+            if DEBUG: print("Drawing {}".format(V1pic))
+            if not DRYRUN:
+                enigma_qc.direction_map(FAmap, pathbase + '_desc-dtifit_V1.nii.gz', V1pic)
 
 
     ## write an html page that shows all the BET mask pics
@@ -156,6 +168,15 @@ def main():
     qchtml.write('</BODY></HTML>\n')
     qchtml.close() # you can omit in most cases as the destructor will call it
 
+    ## the group SSE tables, and the SSE pics with the worst fits first
+    if len(sse_stats) > 0:
+        summary, slices = sse_tables(sse_stats)
+        summary.to_csv(os.path.join(QCdir, 'dtifit_sse_summary.csv'), index = False)
+        slices.to_csv(os.path.join(QCdir, 'dtifit_sse_slices.csv'), index = False)
+        write_ranked_page(os.path.join(QCdir, 'qc_sse_ranked.html'), summary, QCdir)
+        if VERBOSE or DEBUG:
+            print(summary.head(10).drop(columns = ['pic']).to_string(index = False))
+
     ## write an html page that shows all the V1 pics
     qchtml = open(os.path.join(QCdir,'qc_directions.html'),'w')
     qchtml.write('<HTML><TITLE>DTIFIT directions QC page</TITLE>')
@@ -169,35 +190,6 @@ def main():
     qchtml.write('</BODY></HTML>\n')
     qchtml.close() # you can omit in most cases as the destructor will call it
 
-
-    #get rid of the tmpdir
-    shutil.rmtree(tmpdirbase)
-
-def gif_gridtoline(input_gif,output_gif,tmpdir):
-    '''
-    uses imagemagick to take a grid from fsl slices and convert to one line (like in slicesdir)
-    '''
-    docmd(['convert',input_gif, '-resize', '384x384',input_gif])
-    docmd(['convert', input_gif,\
-        '-crop', '100x33%+0+0', os.path.join(tmpdir,'sag.gif')])
-    docmd(['convert', input_gif,\
-        '-crop', '100x33%+0+128', os.path.join(tmpdir,'cor.gif')])
-    docmd(['convert', input_gif,\
-        '-crop', '100x33%+0+256', os.path.join(tmpdir,'ax.gif')])
-    docmd(['montage', '-mode', 'concatenate', '-tile', '3x1', \
-        os.path.join(tmpdir,'sag.gif'),\
-        os.path.join(tmpdir,'cor.gif'),\
-        os.path.join(tmpdir,'ax.gif'),\
-        os.path.join(output_gif)])
-
-def mask_overlay(background_nii,mask_nii, overlay_gif, tmpdir):
-    '''
-    use slices from fsl to overlay the mask on the background (both nii)
-    then make the grid to a line for easier scrolling during QC
-    '''
-    docmd(['slices', background_nii, mask_nii, '-o', os.path.join(tmpdir,'BOmasked.gif')])
-    gif_gridtoline(os.path.join(tmpdir,'BOmasked.gif'),overlay_gif, tmpdir)
-
 def sse_plots(sse_nii, png_out, display_mode = "z"):
     '''
     use nilearn plotting to make an image of the dtifit errors
@@ -217,27 +209,93 @@ def sse_plots(sse_nii, png_out, display_mode = "z"):
        vmin = 0, vmax = 50,
        output_file = png_out)
 
-def V1_overlay(background_nii,V1_nii, overlay_gif, tmpdir):
+def sse_summary(sse, mask, threshold):
+    '''
+    the SSE statistics of one subject (within the mask) and the mean SSE of each axial slice
+    '''
+    values = sse[mask]
+    if values.size == 0:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    ## per slice mean, for the slices with at least a tenth of the typical number of brain voxels
+    counts = mask.sum(axis = (0, 1))
+    sums = np.where(mask, sse, 0).sum(axis = (0, 1))
+    in_brain = counts >= 0.1 * np.median(counts[counts > 0])
+    profile = np.where(in_brain, sums / np.maximum(counts, 1), np.nan)
+    slice_median = np.nanmedian(profile)
+    worst_slice = int(np.nanargmax(profile))
+    return {'n_voxels': int(values.size),
+            'sse_mean': float(values.mean()),
+            'sse_median': float(p50),
+            'sse_p95': float(p95),
+            'sse_p99': float(p99),
+            'frac_above_threshold': float((values > threshold).mean()),
+            'threshold': threshold,
+            'worst_slice': worst_slice,
+            'worst_slice_ratio': float(profile[worst_slice] / slice_median) if slice_median > 0 else float('nan'),
+            'slice_sse_mean': [None if np.isnan(v) else round(float(v), 4) for v in profile]}
+
+def subject_sse_stats(FAmap, sse_nii, stats_json, threshold):
+    '''
+    the SSE statistics of one subject, read from stats_json if it is up to date (else remade and saved)
+    '''
+    subject = os.path.basename(FAmap).replace('_desc-dtifit_FA.nii.gz', '')
+    if not os.path.isfile(sse_nii):
+        print("{} not found, skipping its SSE summary".format(sse_nii))
+        return None
+    if os.path.isfile(stats_json) and os.path.getmtime(stats_json) > os.path.getmtime(sse_nii):
+        with open(stats_json, 'r') as f:
+            stats = json.load(f)
+        if stats.get('threshold') == threshold:
+            return stats
+    if DEBUG: print("Summarizing {}".format(sse_nii))
+    if DRYRUN:
+        return None
+    sse = np.asanyarray(nib.load(sse_nii).dataobj).astype(np.float32)
+    mask = np.asanyarray(nib.load(FAmap).dataobj) > 0
+    stats = sse_summary(sse, mask, threshold)
+    if stats == None:
+        print("{} has no brain voxels, skipping its SSE summary".format(FAmap))
+        return None
+    stats = dict(subject = subject, **stats)
+    with open(stats_json, 'w') as f:
+        json.dump(stats, f)
+    return stats
+
+def sse_tables(sse_stats):
+    '''
+    the group summary (worst first) and the per slice table from the subject statistics
     '''
-    use fslsplit to split the V1 image and take pictures of each direction
-    use slices from fsl to get the background and V1 picks (both nii)
-    recolor the V1 image using imagemagick
-    then make the grid to a line for easier scrolling during QC
+    summary = pd.DataFrame([{k: v for k, v in stats.items() if k != 'slice_sse_mean'} for stats in sse_stats])
+    z = enigma_stats.robust_z(summary[['sse_mean', 'sse_p99', 'frac_above_threshold',
+                                       'worst_slice_ratio']].to_numpy(dtype = float))
+    summary.insert(1, 'badness', np.nanmax(z, axis = 1).round(2))
+    summary = summary.sort_values('badness', ascending = False)
+    summary.insert(1, 'rank', np.arange(1, len(summary) + 1))
+    slices = pd.DataFrame([{'subject': stats['subject'], 'slice': i, 'sse_mean': v}
+                           for stats in sse_stats
+                           for i, v in enumerate(stats['slice_sse_mean']) if v != None])
+    return summary, slices
+
+def write_ranked_page(html_path, summary, QCdir):
     '''
-    docmd(['slices',background_nii,'-o',os.path.join(tmpdir,"background.gif")])
-    docmd(['fslmaths',background_nii,'-thr','0.15','-bin',os.path.join(tmpdir,'FAmask.nii.gz')])
-    docmd(['fslsplit', V1_nii, os.path.join(tmpdir,"V1")])
-    for axis in ['0000','0001','0002']:
-        docmd(['fslmaths',os.path.join(tmpdir,'V1'+axis+'.nii.gz'), '-abs', \
-            '-mul', os.path.join(tmpdir,'FAmask.nii.gz'), os.path.join(tmpdir,'V1'+axis+'abs.nii.gz')])
-        docmd(['slices',os.path.join(tmpdir,'V1'+axis+'abs.nii.gz'),'-o',os.path.join(tmpdir,'V1'+axis+'abs.gif')])
-        # docmd(['convert', os.path.join(tmpdir,'V1'+axis+'abs.gif'),\
-        #         '-fuzz', '15%', '-transparent', 'black', os.path.join(tmpdir,'V1'+axis+'set.gif')])
-    docmd(['convert', os.path.join(tmpdir,'V10000abs.gif'),\
-        os.path.join(tmpdir,'V10001abs.gif'), os.path.join(tmpdir,'V10002abs.gif'),\
-        '-set', 'colorspace', 'RGB', '-combine', '-set', 'colorspace', 'sRGB',\
-        os.path.join(tmpdir,'dirmap.gif')])
-    gif_gridtoline(os.path.join(tmpdir,'dirmap.gif'),overlay_gif, tmpdir)
+    write an html page of the SSE pics in the order of the summary, with their statistics
+    '''
+    qchtml = open(html_path,'w')
+    qchtml.write('<HTML><TITLE>DTIFIT Error QC page (worst first)</TITLE>')
+    qchtml.write('<BODY BGCOLOR=#333333>\n')
+    qchtml.write('<h1><font color="white">DTIFIT Error QC page (worst first)</font></h1>')
+    for row in summary.itertuples():
+        relpath = os.path.relpath(row.pic,QCdir)
+        qchtml.write('<p><font color="white">{}. {} badness {:.1f}: mean {:.1f}, p99 {:.1f}, '
+                     '{:.1%} above {:g}, worst slice {} ({:.1f} x the median slice)</font><br>\n'.format(
+                     row.rank, row.subject, row.badness, row.sse_mean, row.sse_p99,
+                     row.frac_above_threshold, row.threshold, row.worst_slice, row.worst_slice_ratio))
+        qchtml.write('<a href="'+ relpath + '" style="color: #99CCFF" >')
+        qchtml.write('<img src="' + relpath + '" "WIDTH=800" > ')
+        qchtml.write(relpath + '</a></p>\n')
+    qchtml.write('</BODY></HTML>\n')
+    qchtml.close()
 
 if __name__ == '__main__':
     main()
@@ -14,6 +14,9 @@ Arguments:
 Options:
   --ROItxt-tag STR         String within the individual participants results that identifies their data (default = 'ROIout_avg')
   --output-nVox            Output value from "nVoxels" column instead of "Average"
+  --n-jobs N               Number of csv files to read at the same time (default = 1)
+  --incremental            Only read csv files that are new or changed since the last run (see below)
+  --store DIR              Also add the results to this (parquet) results store (see enigma_store.py)
   -v,--verbose             Verbose logging
   --debug                  Debug logging in Erin's very verbose style
   -n,--dry-run             Dry run
@@ -33,17 +36,38 @@ of the output file.
 The option "--ROItxt-tag <STR>" can be used to change the search string "_ROIout_avg"
 in order to search for different pipeline output files.
 
+With "--incremental" a manifest (<resultsfile>.manifest.json) of the csv files
+that went into the results (path, mtime, size and sha256) is kept next to the results.
+On the next run only the csv files that are new, or whose contents changed, are read,
+the rest of the values come from the previous results file, and the rows for
+csv files that no longer exist are dropped. The output is the same as a full run.
+If the manifest does not match the results file (or the settings changed)
+everything is read again.
+
+With "--store <DIR>" the "Average" and "nVoxels" values of every subject are also
+added to a typed parquet store, under <DIR>/metric=<postfix>/ (see enigma_store.py).
+Only subjects that are not in the store yet, or whose csv file changed, are read and
+appended - the rows already in the store are not rewritten.
+
+The results file (and manifest) are written to a temporary file first and then
+moved into place, so an interrupted run never leaves a half written table.
+
 Written by Erin W Dickie, July 30 2015
 Adapted from ENIGMA_MASTER.sh - Generalized October 2nd David Rotenberg Updated Feb 2015 by JP+TB
 #Note -need ot expand path on FAskel -or it fails if relative paths given...
 """
 from docopt import docopt
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import glob
 import os
 import sys
 import subprocess
 import datetime
+import json
+import enigma_roi
+import enigma_store
 
 
 
@@ -59,6 +83,9 @@ def main():
     resultsfile     = arguments['<resultsfile>']
     ROItxt_tag      = arguments['--ROItxt-tag']
     OUTPUT_nVOXELS  = arguments['--output-nVox']
+    n_jobs          = arguments['--n-jobs']
+    INCREMENTAL     = arguments['--incremental']
+    store           = arguments['--store']
     VERBOSE         = arguments['--verbose']
     DEBUG           = arguments['--debug']
     DRYRUN          = arguments['--dry-run']
@@ -70,6 +97,7 @@ def main():
     if resultsfile == None:
         resultsfile = os.path.join(outputdir,'ENIGMA-DTI-results.csv')
     if ROItxt_tag == None: ROItxt_tag = postfix + 'skel_ROIout_avg'
+    n_jobs = 1 if n_jobs == None else int(n_jobs)
 
     SUBFOLDERS = True ## assume that the file is inside a heirarchy that contains folders with subject names
     ## find the files that match the resutls tag...first using the place it should be from doInd-enigma-dti.py
@@ -90,40 +118,146 @@ def main():
     firstROItxt = pd.read_csv(ROIfiles[0], sep=',', dtype=str, comment='#')
     tractnames = firstROItxt['Tract'].tolist() # reads the tract names from the 'Tract' column for template
     tractcolnames = [tract + '_' + postfix for tract in tractnames]
-
-    ####set up the resutls dataframe
     cols = ['id'] + tractcolnames
-    results = pd.DataFrame(columns = cols)
-
-
-    ###now need to insert the new dataness...
-    for csvfile in ROIfiles:
-        # for each csv - read it using pandas
-        csvdata = pd.read_csv(csvfile, sep=',', dtype=str, comment='#')
-        if SUBFOLDERS == True:
-            # if this data follows the dm-proc-enigmadti.py structure: search for the subid
-            ###### if should be two direcotories up from the file
-            this_id = os.path.basename(os.path.dirname(os.path.dirname(csvfile)))
-        else:
-            ## if not - use the csv filename as the subgject id
-            this_id = os.path.basename(csvfile)
-
-        ## if the subject id is not present in the results dataframe - create a new row for it
-        idx = len(results)
-        results = results.append(pd.DataFrame(columns = cols, index = [idx]))
-        results.id[idx] = this_id
-        for i in range(len(tractnames)):
-            ## for each tract in the list, update the value in the results
-            tractname = tractnames[i]
-            tractcolname = tractcolnames[i]
-            if OUTPUT_nVOXELS:
-                val = int(csvdata.loc[csvdata['Tract']==tractname]['nVoxels'])
+
+    if SUBFOLDERS == True:
+        # if this data follows the dm-proc-enigmadti.py structure: search for the subid
+        ###### if should be two direcotories up from the file
+        ids = [os.path.basename(os.path.dirname(os.path.dirname(csvfile))) for csvfile in ROIfiles]
+    else:
+        ## if not - use the csv filename as the subgject id
+        ids = [os.path.basename(csvfile) for csvfile in ROIfiles]
+
+    ## with --incremental, reuse the values for the csvs that have not changed
+    valuecol = 'nVoxels' if OUTPUT_nVOXELS else 'Average'
+    manifest_file = resultsfile + '.manifest.json'
+    previous = load_manifest(manifest_file, resultsfile, cols, valuecol) if INCREMENTAL else {}
+    rows = [None] * len(ROIfiles)
+    manifest = []
+    for i, csvfile in enumerate(ROIfiles):
+        st = os.stat(csvfile)
+        entry = {'path': csvfile, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+        old_entry, old_values = previous.get(csvfile, (None, None))
+        if INCREMENTAL:
+            if old_entry != None and old_entry['size'] == entry['size'] and \
+                    old_entry['mtime_ns'] == entry['mtime_ns']:
+                entry['sha256'] = old_entry['sha256']
             else:
-                val = float(csvdata.loc[csvdata['Tract']==tractname]['Average'])
-            results[tractcolname][idx] = val
+                entry['sha256'] = enigma_roi.file_hash(csvfile)
+            if old_entry != None and old_entry['sha256'] == entry['sha256']:
+                rows[i] = old_values
+        manifest.append(entry)
+    to_read = [i for i in range(len(ROIfiles)) if rows[i] is None]
+    if VERBOSE: print('Reading {} of {} csv files'.format(len(to_read), len(ROIfiles)))
+
+    ## read the csvs (in parallel) - one row of values per file
+    with ThreadPoolExecutor(max_workers = n_jobs) as pool:
+        new_rows = pool.map(lambda i: read_roi_values(ROIfiles[i], tractnames, valuecol), to_read)
+        for i, values in zip(to_read, new_rows):
+            rows[i] = values
+
+    ## then stack them into the results dataframe in one go
+    results = pd.DataFrame(np.vstack(rows), columns = tractcolnames)
+    if OUTPUT_nVOXELS:
+        results = results.astype(np.int64)
+    results.insert(0, 'id', ids)
+
+    ## write the results out to a file (and the manifest that goes with it)
+    write_atomic(resultsfile, lambda path: results.to_csv(path, sep=',', columns = cols, index = False))
+    if INCREMENTAL:
+        manifest = {'value_column': valuecol,
+                    'results_sha256': enigma_roi.file_hash(resultsfile),
+                    'files': manifest}
+        write_atomic(manifest_file, lambda path: write_json(path, manifest))
+
+    if store:
+        update_store(store, postfix, ROIfiles, ids, tractnames, n_jobs)
+
+def update_store(store, metric, ROIfiles, ids, tractnames, n_jobs):
+    '''
+    append the subjects that are new to the store (or whose csv changed)
+    with both their "Average" and "nVoxels" values
+    '''
+    stored = enigma_store.read_store(store, metric, columns = ['source', 'source_size', 'source_mtime_ns'])
+    stored = {(row.subject, row.session): (row.source, row.source_size, row.source_mtime_ns)
+              for row in stored.itertuples()}
+    info = []
+    for csvfile, this_id in zip(ROIfiles, ids):
+        st = os.stat(csvfile)
+        subject, session = enigma_store.split_id(this_id)
+        if stored.get((subject, session)) != (csvfile, st.st_size, st.st_mtime_ns):
+            info.append((this_id, subject, session, csvfile, st.st_size, st.st_mtime_ns))
+    if VERBOSE: print('Adding {} of {} subjects to {}'.format(len(info), len(ROIfiles), store))
+    if len(info) == 0:
+        return
+
+    with ThreadPoolExecutor(max_workers = n_jobs) as pool:
+        tables = list(pool.map(lambda row: read_roi_columns(row[3], tractnames, enigma_store.VALUE_COLUMNS), info))
+
+    table = pd.DataFrame(info, columns = enigma_store.INFO_COLUMNS[:-1])
+    table['written'] = pd.Timestamp.now(tz = 'UTC')
+    averages = pd.DataFrame(np.vstack([t['Average'].values for t in tables]),
+                            columns = [tract + '_Average' for tract in tractnames])
+    nvoxels = pd.DataFrame(np.vstack([t['nVoxels'].values for t in tables]).astype(np.int64),
+                           columns = [tract + '_nVoxels' for tract in tractnames])
+    enigma_store.append_store(store, metric, pd.concat([table, averages, nvoxels], axis = 1))
+
+def load_manifest(manifest_file, resultsfile, cols, valuecol):
+    '''
+    reads the manifest from a previous --incremental run
+    returns a dictionary of csv path -> (manifest entry, row of values from the results file)
+    which is empty if the manifest and results file do not match (or do not exist)
+    '''
+    if not (os.path.isfile(manifest_file) and os.path.isfile(resultsfile)):
+        return {}
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('value_column') != valuecol or \
+            manifest.get('results_sha256') != enigma_roi.file_hash(resultsfile):
+        if VERBOSE: print('{} is out of date, reading all csv files'.format(manifest_file))
+        return {}
+    old_results = pd.read_csv(resultsfile, sep=',', dtype={'id': str}, float_precision='round_trip')
+    if old_results.columns.tolist() != cols or len(old_results) != len(manifest['files']):
+        if VERBOSE: print('{} does not match {}, reading all csv files'.format(manifest_file, resultsfile))
+        return {}
+    old_values = old_results[cols[1:]].values.astype(float)
+    return {entry['path']: (entry, old_values[i]) for i, entry in enumerate(manifest['files'])}
+
+def write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent = 1)
+
+def write_atomic(path, write):
+    '''
+    calls write() on a temporary file next to path, then moves it into place
+    '''
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def read_roi_values(csvfile, tractnames, valuecol):
+    '''
+    reads one participants ROI csv and returns the valuecol ("Average" or "nVoxels")
+    as a float array in the order of tractnames
+    '''
+    return read_roi_columns(csvfile, tractnames, [valuecol])[valuecol].values
 
-    ## write the results out to a file
-    results.to_csv(resultsfile, sep=',', columns = cols, index = False)
+def read_roi_columns(csvfile, tractnames, valuecols):
+    '''
+    reads one participants ROI csv and returns the valuecols as
+    a float DataFrame with one row per tract (in the order of tractnames)
+    '''
+    csvdata = pd.read_csv(csvfile, sep=',', dtype=str, comment='#')
+    values = csvdata.set_index('Tract')[valuecols].reindex(tractnames)
+    missing = values.isnull().all(axis = 1)
+    if missing.any():
+        raise ValueError('{} is missing tracts: {}'.format(
+            csvfile, ', '.join(values.index[missing])))
+    return values.astype(float)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+Checks the group ENIGMA DTI results for normality and finds the outlier subjects.
+
+Usage:
+  run_group_outliers.py [options] <resultsfile>...
+
+Arguments:
+    <resultsfile>      Group results csv files written by run_group_enigma_concat.py
+                       (or run_group_roi_matrix.py), one per metric (ex. group_enigmaDTI_FA.csv)
+
+Options:
+  --output-dir DIR         Where to write the report (default = the folder of the first <resultsfile>)
+  --qc-dir DIR             The skeleton QC pages of run_group_qc_enigma.py (default = <output-dir>/QC)
+  --site-file CSV          A csv with an "id" column and a site (or scanner) column, to score each site on its own
+  --site-column NAME       The site column of the "--site-file" (default = site)
+  --outlier-z Z            Flag values with a robust z score beyond Z (default = 3.5)
+  --mahalanobis-p P        Flag subjects whose Mahalanobis distance over the tracts of a metric has a p value below P (default = 0.001)
+  --top N                  Print the N worst subjects (default = 20)
+  -v,--verbose             Verbose logging
+  --debug                  Debug logging in Erin's very verbose style
+
+DETAILS
+Loads every metric table (the metric is the part of the column names after the
+last "_", ex. FA in CC_FA) into one subjects x (tract, metric) matrix, and then:
+
+1. robust z scores: (value - median) / (1.4826 x median absolute deviation) of
+   every tract and metric, over all subjects (or, with "--site-file", over the
+   subjects of the same site), with the spread floor of enigma_stats.py.
+   Values beyond "--outlier-z" are outliers.
+2. Mahalanobis distances: for every metric, the distance of each subject over all
+   the tracts of that metric (on the robust z scores), with the covariance from the
+   subjects that have no univariate outliers, compared to a chi squared distribution
+   (with the rank of the covariance as the degrees of freedom - the bilateral and
+   composite tracts are averages of the others). This catches subjects with an
+   unusual pattern across tracts even when no single tract is extreme.
+3. normality: the skew, kurtosis and D'Agostino-Pearson test of every tract and metric.
+
+Subjects with a missing value in a metric get no distance for that metric, and are
+left out of its normality tests. Everything is computed on whole arrays (one pass
+over the subjects x tracts matrix), so 10000 subjects (4 metrics of 42 tracts) are
+read, scored and written in under a second ("--verbose" prints how long it took).
+
+Writes to the output folder:
+    group_outlier_values.csv     every outlying value (id, metric, tract, value, z)
+    group_outlier_subjects.csv   one row per subject, the worst first
+    group_normality.csv          the normality test of every tract and metric
+    group_outliers.html          the flagged subjects, linked to their skeleton QC pages
+"""
+from docopt import docopt
+import numpy as np
+import pandas as pd
+import scipy.special
+import os
+import sys
+import time
+import enigma_stats
+
+DEBUG = False
+VERBOSE = False
+
+def read_results(resultsfiles):
+    '''
+    one subjects x (tract, metric) table from the results files (an outer join on id)
+
+    returns (ids, values, tracts, metrics), values is a float array and
+    tracts/metrics give the tract and metric of each of its columns
+    '''
+    tables = []
+    for resultsfile in resultsfiles:
+        if DEBUG: print("Reading {}".format(resultsfile))
+        table = pd.read_csv(resultsfile, sep = ',', comment = '#')
+        tables.append(table.drop_duplicates('id', keep = 'last').set_index('id'))
+    results = pd.concat(tables, axis = 1, join = 'outer')
+    results = results.loc[:, ~results.columns.duplicated()]
+    tracts = np.array([column.rsplit('_', 1)[0] for column in results.columns])
+    metrics = np.array([column.rsplit('_', 1)[-1] for column in results.columns])
+    text_columns = [c for c in results.columns if not pd.api.types.is_numeric_dtype(results[c])]
+    if len(text_columns) > 0:
+        results[text_columns] = results[text_columns].apply(pd.to_numeric, errors = 'coerce')
+    values = results.to_numpy(dtype = np.float64)
+    return results.index.astype(str).to_numpy(), values, tracts, metrics
+
+def site_robust_z(values, sites):
+    '''
+    robust z scores of every column, within each site
+    '''
+    z = np.full(values.shape, np.nan)
+    for site in pd.unique(sites):
+        rows = sites == site
+        z[rows] = enigma_stats.robust_z(values[rows])
+    return z
+
+def mahalanobis(z, outlier_z):
+    '''
+    the squared Mahalanobis distance of every row of z (subjects x tracts of one metric),
+    with the covariance of the complete rows without univariate outliers
+
+    returns (distances, degrees of freedom), distances are NaN for rows with missing values
+    '''
+    complete = ~np.isnan(z).any(axis = 1)
+    clean = complete & (np.abs(np.where(complete[:, None], z, 0)) <= outlier_z).all(axis = 1)
+    d2 = np.full(len(z), np.nan)
+    if clean.sum() <= 2:
+        return d2, 0
+    reference = z[clean]
+    center = reference.mean(axis = 0)
+    covariance = np.cov(reference, rowvar = False)
+    precision = np.linalg.pinv(covariance, hermitian = True)
+    centered = z[complete] - center
+    d2[complete] = ((centered @ precision) * centered).sum(axis = 1)
+    return d2, int(np.linalg.matrix_rank(covariance, hermitian = True))
+
+def dagostino_pearson(block):
+    '''
+    the skew, (excess) kurtosis, D'Agostino-Pearson K2 statistic and its p value of every column
+    (the same as scipy.stats.normaltest, written out in numpy - scipy.stats alone takes most of a second to import)
+    '''
+    n = float(len(block))
+    centered = block - block.mean(axis = 0)
+    squared = centered * centered
+    m2 = squared.mean(axis = 0)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        skew = (squared * centered).mean(axis = 0) / m2 ** 1.5
+        kurtosis = (squared * squared).mean(axis = 0) / m2 ** 2
+        ## skew test
+        y = skew * np.sqrt((n + 1) * (n + 3) / (6.0 * (n - 2)))
+        beta2 = 3.0 * (n * n + 27 * n - 70) * (n + 1) * (n + 3) / ((n - 2) * (n + 5) * (n + 7) * (n + 9))
+        w2 = -1 + np.sqrt(2 * (beta2 - 1))
+        delta = 1 / np.sqrt(0.5 * np.log(w2))
+        alpha = np.sqrt(2.0 / (w2 - 1))
+        y = np.where(y == 0, 1, y)
+        z_skew = delta * np.log(y / alpha + np.sqrt((y / alpha) ** 2 + 1))
+        ## kurtosis test
+        expected = 3.0 * (n - 1) / (n + 1)
+        variance = 24.0 * n * (n - 2) * (n - 3) / ((n + 1) * (n + 1) * (n + 3) * (n + 5))
+        x = (kurtosis - expected) / np.sqrt(variance)
+        sqrt_beta1 = 6.0 * (n * n - 5 * n + 2) / ((n + 7) * (n + 9)) * np.sqrt(6.0 * (n + 3) * (n + 5) / (n * (n - 2) * (n - 3)))
+        a = 6.0 + 8.0 / sqrt_beta1 * (2.0 / sqrt_beta1 + np.sqrt(1 + 4.0 / sqrt_beta1 ** 2))
+        term1 = 1 - 2 / (9.0 * a)
+        denom = 1 + x * np.sqrt(2 / (a - 4.0))
+        term2 = np.sign(denom) * np.cbrt((1 - 2.0 / a) / np.abs(denom))
+        term2 = np.where(denom == 0, np.nan, term2)
+        z_kurtosis = (term1 - term2) / np.sqrt(2 / (9.0 * a))
+    k2 = z_skew ** 2 + z_kurtosis ** 2
+    ## K2 has a chi squared distribution with 2 degrees of freedom
+    return skew, kurtosis - 3, k2, np.exp(-k2 / 2)
+
+def normality(values, tracts, metrics):
+    '''
+    the skew, kurtosis and D'Agostino-Pearson normality test of every column (complete rows only)
+    '''
+    rows = []
+    for metric in pd.unique(metrics):
+        columns = metrics == metric
+        block = values[:, columns]
+        block = block[~np.isnan(block).any(axis = 1)]
+        n = len(block)
+        skew, kurtosis, stat, p = dagostino_pearson(block)
+        if n < 20:
+            ## the test is not valid for small groups
+            stat, p = np.full(block.shape[1], np.nan), np.full(block.shape[1], np.nan)
+        rows.append(pd.DataFrame({'metric': metric,
+                                  'tract': tracts[columns],
+                                  'n': n,
+                                  'mean': block.mean(axis = 0),
+                                  'sd': block.std(axis = 0, ddof = 1),
+                                  'skew': skew,
+                                  'kurtosis': kurtosis,
+                                  'normaltest_stat': stat,
+                                  'normaltest_p': p}))
+    table = pd.concat(rows, ignore_index = True)
+    ## Bonferroni over all the tests
+    table['normal'] = (table['normaltest_p'] > 0.05 / len(table)).where(table['normaltest_p'].notna())
+    return table
+
+def find_outliers(ids, values, tracts, metrics, sites, outlier_z, mahalanobis_p):
+    '''
+    the outlying values (long table), the per subject summary (worst first)
+    '''
+    z = enigma_stats.robust_z(values) if sites is None else site_robust_z(values, sites)
+    abs_z = np.nan_to_num(np.abs(z), nan = 0.0)
+
+    rows, columns = np.nonzero(abs_z > outlier_z)
+    outlier_values = pd.DataFrame({'id': ids[rows],
+                                   'metric': metrics[columns],
+                                   'tract': tracts[columns],
+                                   'value': values[rows, columns],
+                                   'z': z[rows, columns].round(2)})
+    if sites is not None:
+        outlier_values.insert(1, 'site', sites[rows])
+    outlier_values = outlier_values.iloc[np.argsort(-np.abs(outlier_values['z'].to_numpy()), kind = 'stable')]
+
+    worst = abs_z.argmax(axis = 1)
+    subjects = pd.DataFrame({'id': ids,
+                             'n_outlier_values': (abs_z > outlier_z).sum(axis = 1),
+                             'max_abs_z': abs_z.max(axis = 1).round(2),
+                             'worst_value': [metrics[c] + ' ' + tracts[c] for c in worst],
+                             'n_missing': np.isnan(values).sum(axis = 1)})
+    if sites is not None:
+        subjects.insert(1, 'site', sites)
+    flagged_multivariate = np.zeros(len(ids), dtype = bool)
+    for metric in pd.unique(metrics):
+        d2, df = mahalanobis(z[:, metrics == metric], outlier_z)
+        p = scipy.special.chdtrc(df, d2) if df > 0 else np.full(len(d2), np.nan)
+        subjects['mahalanobis_' + metric] = np.sqrt(d2).round(2)
+        subjects['mahalanobis_p_' + metric] = p
+        flagged_multivariate |= np.nan_to_num(p, nan = 1.0) < mahalanobis_p
+    subjects['multivariate_outlier'] = flagged_multivariate
+    subjects['flagged'] = (subjects['n_outlier_values'] > 0) | flagged_multivariate
+    min_p = subjects.filter(like = 'mahalanobis_p_').min(axis = 1).fillna(1.0)
+    subjects = subjects.assign(_min_p = min_p).sort_values(
+        ['flagged', 'max_abs_z', '_min_p'], ascending = [False, False, True]).drop(columns = '_min_p')
+    return outlier_values, subjects
+
+def write_report(html_path, subjects, outlier_values, qc_dir, outlier_z):
+    '''
+    write an html page of the flagged subjects, linked to their skeleton QC pages
+    '''
+    report_dir = os.path.dirname(os.path.abspath(html_path))
+    ## the 10 worst values of each subject, as text
+    listed = outlier_values.groupby('id', sort = False).head(10)
+    listed_text = (listed['metric'] + ' ' + listed['tract'] + ' z=' + listed['z'].map('{:.1f}'.format).astype(str)
+                   ).groupby(listed['id'], sort = False).agg(', '.join).to_dict()
+    flagged = subjects[subjects['flagged']]
+    qchtml = open(html_path, 'w')
+    qchtml.write('<HTML><TITLE>ENIGMA DTI outliers</TITLE>')
+    qchtml.write('<BODY BGCOLOR=#333333>\n')
+    qchtml.write('<h1><font color="white">ENIGMA DTI outliers ({} of {} subjects)</font></h1>\n'.format(
+        len(flagged), len(subjects)))
+    qc_base = os.path.relpath(qc_dir, report_dir)
+    for this_id, max_abs_z, worst_value, n_outlier_values, multivariate in zip(
+            flagged['id'], flagged['max_abs_z'], flagged['worst_value'],
+            flagged['n_outlier_values'], flagged['multivariate_outlier']):
+        qc_page = os.path.join(qc_base, this_id, 'index.html')
+        qchtml.write('<p><a href="' + qc_page + '" style="color: #99CCFF" >' + this_id + '</a>')
+        qchtml.write('<font color="white"> max |z| {:.1f} ({}), {} values beyond {}{}</font><br>\n'.format(
+            max_abs_z, worst_value, n_outlier_values, outlier_z,
+            ', multivariate outlier' if multivariate else ''))
+        if this_id in listed_text:
+            qchtml.write('<font color="white" size="2">' + listed_text[this_id] + '</font>')
+        qchtml.write('</p>\n')
+    qchtml.write('</BODY></HTML>\n')
+    qchtml.close()
+
+def main():
+
+    global DEBUG
+    global VERBOSE
+
+    arguments       = docopt(__doc__)
+    resultsfiles    = arguments['<resultsfile>']
+    output_dir      = arguments['--output-dir']
+    qc_dir          = arguments['--qc-dir']
+    site_file       = arguments['--site-file']
+    site_column     = arguments['--site-column']
+    outlier_z       = arguments['--outlier-z']
+    mahalanobis_p   = arguments['--mahalanobis-p']
+    top             = arguments['--top']
+    VERBOSE         = arguments['--verbose']
+    DEBUG           = arguments['--debug']
+
+    if DEBUG: print(arguments)
+
+    if output_dir == None: output_dir = os.path.dirname(os.path.abspath(resultsfiles[0]))
+    if qc_dir == None: qc_dir = os.path.join(output_dir, 'QC')
+    if site_column == None: site_column = 'site'
+    outlier_z = 3.5 if outlier_z == None else float(outlier_z)
+    mahalanobis_p = 0.001 if mahalanobis_p == None else float(mahalanobis_p)
+    top = 20 if top == None else int(top)
+
+    start = time.perf_counter()
+    ids, values, tracts, metrics = read_results(resultsfiles)
+    sites = None
+    if site_file:
+        site_table = pd.read_csv(site_file, dtype = {'id': str}).drop_duplicates('id', keep = 'last')
+        if site_column not in site_table.columns:
+            sys.exit("{} has no {} column".format(site_file, site_column))
+        sites = site_table.set_index('id')[site_column].reindex(ids).fillna('unknown').astype(str).to_numpy()
+    if VERBOSE:
+        print("{} subjects, {} tracts of {}".format(len(ids), len(set(tracts)), ', '.join(pd.unique(metrics))))
+
+    outlier_values, subjects = find_outliers(ids, values, tracts, metrics, sites, outlier_z, mahalanobis_p)
+    normality_table = normality(values, tracts, metrics)
+
+    os.makedirs(output_dir, exist_ok = True)
+    outlier_values.to_csv(os.path.join(output_dir, 'group_outlier_values.csv'), index = False)
+    subjects.to_csv(os.path.join(output_dir, 'group_outlier_subjects.csv'), index = False)
+    normality_table.to_csv(os.path.join(output_dir, 'group_normality.csv'), index = False)
+    write_report(os.path.join(output_dir, 'group_outliers.html'), subjects, outlier_values, qc_dir, outlier_z)
+    if VERBOSE: print("Read, scored and wrote the report in {:.2f}s".format(time.perf_counter() - start))
+
+    flagged = subjects[subjects['flagged']]
+    print("{} of {} subjects flagged ({} values beyond |z| {}, {} multivariate outliers), see {}".format(
+        len(flagged), len(subjects), len(outlier_values), outlier_z,
+        int(subjects['multivariate_outlier'].sum()), os.path.join(output_dir, 'group_outliers.html')))
+    not_normal = normality_table[normality_table['normal'] == False]
+    tested = normality_table['normal'].notna().sum()
+    print("{} of {} tract and metric distributions are not normal".format(len(not_normal), tested))
+    with pd.option_context('display.width', 200, 'display.max_columns', 30):
+        if len(flagged) > 0:
+            print(flagged.head(top)[['id', 'n_outlier_values', 'max_abs_z', 'worst_value',
+                                     'multivariate_outlier']].to_string(index = False))
+        if VERBOSE and len(not_normal) > 0:
+            print(not_normal[['metric', 'tract', 'n', 'skew', 'kurtosis', 'normaltest_p']].to_string(index = False))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""
+Projects any scalar maps onto the skeletons of an existing ENIGMA DTI run (without registering again).
+
+Usage:
+  run_group_project_maps.py [options] <enigmadir> <mapsdir> <metric>...
+
+Arguments:
+    <enigmadir>        Top directory of an ENIGMA DTI run (with the <participant>/FA/ folders)
+    <mapsdir>          Top directory of the scalar maps (ex. a BIDS derivatives folder)
+    <metric>           NAME=SUFFIX - the metric name (used in the output file and column names)
+                       and how its file names end (ex. MK=desc-MK_dki.nii.gz)
+
+Options:
+  --outputdir DIR          Where to write the outputs (default = <enigmadir>)
+  --participant-label LIST Comma separated participants to run (ex. sub-01_ses-01) (default = all)
+  --reorient               Run fslreorient2std on the maps first (ex. for qsirecon outputs)
+  --n-jobs N               Number of participants to run at the same time (default = 1)
+  --no-qc                  Do not make the skeleton QC images
+  --qc-renderer NAME       Draw the QC images with nilearn or numpy (see enigma_qc.py) (default = nilearn)
+  --rerun-all              Run every participant/metric, even the ones that are up to date
+  -v,--verbose             Verbose logging
+  --debug                  Debug logging in Erin's very verbose style
+  -n,--dry-run             Dry run
+
+DETAILS
+This is for adding a new metric (ex. DKI MK/AK/RK, free-water corrected FA) to a
+study that has already been run through run_participant_enigma_extract.py.
+The maps are found with <mapsdir>/**/*<SUFFIX>, and matched to the ENIGMA run by
+the BIDS sub- and ses- entities of their names (ex. sub-01_ses-01). The maps have to be
+in the same (native) space as the FA map that was registered (ex. the dtifit outputs).
+
+For each participant, the maps are masked with the FA mask of the ENIGMA run,
+stacked into one 4D image and warped to the target with a single applywarp call,
+using the warp from the FA registration (FA/*_FA_to_target_warp.nii.gz).
+They are then skeletonized with the projection recorded for the FA skeleton
+(FA/*_FA_projection_index.nii.gz, or tbss_skeleton -a on the FA skeleton for
+older runs), and the ROI values extracted and averaged.
+No registration (tbss_2_reg) is ever run - participants without a warp are reported and skipped.
+
+The outputs follow the layout of the participant pipeline:
+  <outputdir>/<participant>/<NAME>/*_<NAME>{_to_target,skel}.nii.gz
+  <outputdir>/<participant>/ROI/*_<NAME>skel_ROIout{,_avg}.csv
+so that run_group_enigma_concat.py, run_group_roi_matrix.py and the QC scripts
+work with "<NAME>" as the postfix.
+
+Each participant and metric is recorded in <outputdir>/<participant>/.enigma_steps
+(see enigma_steps.py) - running this again only does the maps that are new or changed.
+
+Requires FSL (applywarp, and fslreorient2std for "--reorient").
+"""
+from docopt import docopt
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import os
+import sys
+import enigma_exec
+import enigma_qc
+import enigma_roi
+import enigma_steps
+import enigma_tbss
+import run_cohort_enigma_extract as cohort
+
+DRYRUN = False
+DEBUG = False
+VERBOSE = False
+REORIENT = False
+RERUN_ALL = False
+QC_RENDERER = 'nilearn'
+
+### Erin's little function for running things in the shell
+def docmd(cmdlist):
+    "sends a command (inputed as a list) to the shell, stops if it fails"
+    enigma_exec.docmd(cmdlist, debug = DEBUG, dryrun = DRYRUN)
+
+def find_maps(mapsdir, metrics):
+    '''
+    find the maps of each metric under mapsdir
+    returns a dictionary of participant -> {metric name: map path}
+    '''
+    maps = {}
+    for name, suffix in metrics:
+        for image in sorted(glob.glob(os.path.join(mapsdir, '**', '*' + suffix), recursive = True)):
+            participant = cohort.participant_id(image)
+            if name in maps.get(participant, {}):
+                sys.exit('More than one {} map for {}: {} and {}'.format(
+                    name, participant, maps[participant][name], image))
+            maps.setdefault(participant, {})[name] = os.path.abspath(image)
+    return maps
+
+def enigma_run(enigma_participant_dir):
+    '''
+    the outputs of an earlier ENIGMA DTI run that are reused
+    returns a dictionary of paths (or None if there is no FA registration)
+    '''
+    warps = glob.glob(os.path.join(enigma_participant_dir, 'FA', '*_FA_to_target_warp.nii.gz'))
+    if len(warps) != 1:
+        return None
+    FAstem = os.path.basename(warps[0]).replace('_to_target_warp.nii.gz', '')
+    FAdir = os.path.dirname(warps[0])
+    return {'stem': FAstem[:-len('_FA')],
+            'warp': warps[0],
+            'target': os.path.join(FAdir, 'target.nii.gz'),
+            'mask': os.path.join(FAdir, FAstem + '_mask.nii.gz'),
+            'skel': os.path.join(FAdir, FAstem + 'skel.nii.gz'),
+            'projection': os.path.join(FAdir, FAstem + '_projection_index.nii.gz')}
+
+def project_participant(participant, maps, enigma_participant_dir, outputdir, templates, qc):
+    '''
+    project one participants maps onto their ENIGMA skeleton
+    returns the list of metrics that were run
+    '''
+    run = enigma_run(enigma_participant_dir)
+    if run == None:
+        raise RuntimeError('No FA registration found in {}'.format(enigma_participant_dir))
+    participant_dir = os.path.join(outputdir, participant)
+    ROIoutdir = os.path.join(participant_dir, 'ROI')
+
+    ## work out which metrics are not up to date
+    todo = []
+    for name in sorted(maps):
+        stem = run['stem'] + '_' + name
+        paths = {'map': maps[name],
+                 'to_target': os.path.join(participant_dir, name, stem + '_to_target.nii.gz'),
+                 'skel': os.path.join(participant_dir, name, stem + 'skel.nii.gz'),
+                 'png': os.path.join(participant_dir, name, stem + 'skel.png'),
+                 'csv': os.path.join(ROIoutdir, stem + 'skel_ROIout'),
+                 'avgcsv': os.path.join(ROIoutdir, stem + 'skel_ROIout_avg')}
+        inputs = [maps[name], run['mask'], run['warp'], run['target'],
+                  run['projection'] if os.path.isfile(run['projection']) else run['skel'],
+                  templates['lookup_table'], templates['skeleton'], templates['atlas']]
+        outputs = [paths['to_target'], paths['skel'], paths['csv'] + '.csv', paths['avgcsv'] + '.csv',
+                   enigma_roi.coverage_path(paths['csv'])]
+        params = {'reorient': REORIENT, 'combinations': enigma_roi.TRACT_COMBINATIONS}
+        step = 'project_' + name
+        key = enigma_steps.step_key(step, inputs, outputs, params, participant_dir)
+        if not RERUN_ALL and enigma_steps.step_is_current(participant_dir, step, key, outputs):
+            if VERBOSE: print('Skipping {} {} (up to date)'.format(participant, name))
+            continue
+        todo.append((name, paths, step, key, inputs, outputs, params))
+    if len(todo) == 0:
+        return []
+
+    for name, paths, step, key, inputs, outputs, params in todo:
+        os.makedirs(os.path.dirname(paths['to_target']), exist_ok = True)
+    os.makedirs(ROIoutdir, exist_ok = True)
+
+    ## put the maps in standard orientation (like the FA was)
+    images = []
+    for name, paths, step, key, inputs, outputs, params in todo:
+        if REORIENT:
+            origdata = os.path.join(participant_dir, name, 'origdata', os.path.basename(paths['map']))
+            os.makedirs(os.path.dirname(origdata), exist_ok = True)
+            docmd(['fslreorient2std', paths['map'], origdata])
+            images.append(origdata)
+        else:
+            images.append(paths['map'])
+
+    ## mask with the FA mask and warp them all with one applywarp call
+    tmpdir = os.path.join(participant_dir, 'tmp_project')
+    os.makedirs(tmpdir, exist_ok = True)
+    stack = os.path.join(tmpdir, run['stem'] + '_stack.nii.gz')
+    stack_to_target = os.path.join(tmpdir, run['stem'] + '_stack_to_target.nii.gz')
+    if DEBUG: print(' '.join(['enigma_tbss.py', 'stack', run['mask'], stack] + images))
+    if not DRYRUN:
+        enigma_tbss.stack_masked(images, run['mask'], stack)
+    docmd(['applywarp', '-i', stack, '-o', stack_to_target,
+           '-r', run['target'], '-w', run['warp']])
+    to_targets = [paths['to_target'] for name, paths, step, key, inputs, outputs, params in todo]
+    if DEBUG: print(' '.join(['enigma_tbss.py', 'split', stack_to_target] + to_targets))
+    if not DRYRUN:
+        enigma_tbss.split_volumes(stack_to_target, to_targets)
+    docmd(['rm', '-r', tmpdir])
+
+    for name, paths, step, key, inputs, outputs, params in todo:
+        ## skeletonize with the FA skeletons projection
+        if os.path.isfile(run['projection']):
+            if DEBUG: print(' '.join(['enigma_tbss.py', 'skeletonize', run['projection'], paths['to_target'], paths['skel']]))
+            if not DRYRUN:
+                enigma_tbss.skeletonize_from_projection(run['projection'], paths['to_target'], paths['skel'])
+        else:
+            docmd(['tbss_skeleton',
+                   '-i', templates['tbss_skeleton_input'],
+                   '-s', templates['tbss_skeleton_alt'],
+                   '-p', str(templates['skel_thresh']), templates['distancemap'], templates['search_rule_mask'],
+                   run['skel'], paths['skel'], '-a', paths['to_target']])
+
+        ## ROI extract and average
+        if DEBUG: print(' '.join(['enigma_roi.py', 'extract', templates['lookup_table'], templates['skeleton'],
+                                  templates['atlas'], paths['csv'], paths['skel']]))
+        if DEBUG: print(' '.join(['enigma_roi.py', 'average', paths['csv'] + '.csv', paths['avgcsv'] + '.csv']))
+        if DRYRUN:
+            continue
+        enigma_roi.extract_roi(templates['lookup_table'], templates['skeleton'], templates['atlas'],
+                               paths['csv'], paths['skel'])
+        enigma_roi.average_subject_tracts(paths['csv'] + '.csv', paths['avgcsv'] + '.csv')
+
+        if qc:
+            enigma_qc.overlay_skel(skel_nii = paths['skel'],
+                                   overlay_png_path = paths['png'],
+                                   renderer = QC_RENDERER)
+        if key == None:
+            key = enigma_steps.step_key(step, inputs, outputs, params, participant_dir)
+        enigma_steps.save_record(participant_dir, step, key, inputs, outputs, params)
+    return [name for name, paths, step, key, inputs, outputs, params in todo]
+
+def init_worker(debug, verbose, dryrun, reorient, rerun_all, qc_renderer):
+    '''
+    set the module settings in a worker process
+    '''
+    global DEBUG, VERBOSE, DRYRUN, REORIENT, RERUN_ALL, QC_RENDERER
+    DEBUG, VERBOSE, DRYRUN, REORIENT, RERUN_ALL, QC_RENDERER = debug, verbose, dryrun, reorient, rerun_all, qc_renderer
+
+def main():
+
+    global DEBUG
+    global VERBOSE
+    global DRYRUN
+    global REORIENT
+    global RERUN_ALL
+    global QC_RENDERER
+
+    arguments       = docopt(__doc__)
+    enigmadir       = arguments['<enigmadir>']
+    mapsdir         = arguments['<mapsdir>']
+    metric_specs    = arguments['<metric>']
+    outputdir       = arguments['--outputdir']
+    participants    = arguments['--participant-label']
+    REORIENT        = arguments['--reorient']
+    n_jobs          = arguments['--n-jobs']
+    QC              = not arguments['--no-qc']
+    qc_renderer     = arguments['--qc-renderer']
+    RERUN_ALL       = arguments['--rerun-all']
+    VERBOSE         = arguments['--verbose']
+    DEBUG           = arguments['--debug']
+    DRYRUN          = arguments['--dry-run']
+
+    if DEBUG: print(arguments)
+    if qc_renderer != None: QC_RENDERER = qc_renderer
+    if QC_RENDERER not in enigma_qc.RENDERERS:
+        sys.exit("--qc-renderer must be one of {}".format(', '.join(enigma_qc.RENDERERS)))
+
+    ENIGMAREPO = os.path.dirname(os.path.realpath(__file__))
+
+    # check that ENIGMAHOME environment variable exists
+    # or set the ENIGMAHOME to engimaDTI is the correct file found
+    ENIGMAHOME = os.getenv('ENIGMAHOME')
+    if ENIGMAHOME==None:
+        potential_enigmahome = os.path.join(ENIGMAREPO, 'enigmaDTI')
+        if os.path.isfile(os.path.join(potential_enigmahome, 'ENIGMA_DTI_FA.nii.gz')):
+            ENIGMAHOME=potential_enigmahome
+            ENIGMAROI=os.path.join(ENIGMAREPO, 'ROIextraction_info')
+        else:
+            sys.exit("ENIGMAHOME environment variable is undefined. Try again.")
+    else:
+         ENIGMAROI=ENIGMAHOME
+    FSLDIR = os.getenv('FSLDIR', '')
+
+    metrics = []
+    for spec in metric_specs:
+        if '=' not in spec:
+            sys.exit('Metrics are given as NAME=SUFFIX (ex. MK=desc-MK_dki.nii.gz), not {}'.format(spec))
+        metrics.append(tuple(spec.split('=', 1)))
+
+    enigmadir = os.path.abspath(enigmadir)
+    outputdir = enigmadir if outputdir == None else os.path.abspath(outputdir)
+    n_jobs = 1 if n_jobs == None else int(n_jobs)
+
+    ## the same templates and settings as run_participant_enigma_extract.py
+    templates = {'lookup_table': os.path.join(ENIGMAROI, 'ENIGMA_look_up_table.txt'),
+                 'skeleton': os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA_skeleton.nii.gz'),
+                 'atlas': os.path.join(ENIGMAROI, 'JHU-WhiteMatter-labels-1mm.nii.gz'),
+                 'skel_thresh': 0.049,
+                 'distancemap': os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA_skeleton_mask_dst.nii.gz'),
+                 'search_rule_mask': os.path.join(FSLDIR, 'data', 'standard', 'LowerCingulum_1mm.nii.gz'),
+                 'tbss_skeleton_input': os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA.nii.gz'),
+                 'tbss_skeleton_alt': os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA_skeleton_mask.nii.gz')}
+
+    maps = find_maps(mapsdir, metrics)
+    if participants:
+        maps = {p: m for p, m in maps.items() if p in participants.split(',')}
+    if len(maps) == 0:
+        sys.exit('Could not find any maps ending in {}'.format(', '.join(s for n, s in metrics)))
+    print('Found maps for {} participants'.format(len(maps)))
+
+    failed = []
+    with ProcessPoolExecutor(max_workers = n_jobs, initializer = init_worker,
+                             initargs = (DEBUG, VERBOSE, DRYRUN, REORIENT, RERUN_ALL, QC_RENDERER)) as pool:
+        futures = {pool.submit(project_participant, participant, maps[participant],
+                               os.path.join(enigmadir, participant), outputdir, templates, QC): participant
+                   for participant in sorted(maps)}
+        for future in as_completed(futures):
+            participant = futures[future]
+            try:
+                done = future.result()
+                if VERBOSE or len(done) > 0:
+                    print('{}: {}'.format(participant, ', '.join(done) if done else 'up to date'), flush = True)
+            except Exception as e:
+                print('{} failed: {}'.format(participant, e), flush = True)
+                failed.append(participant)
+
+    if len(failed) > 0:
+        sys.exit('{} participant(s) failed: {}'.format(len(failed), ', '.join(sorted(failed))))
+
+if __name__ == '__main__':
+    main()
@@ -11,8 +11,11 @@ Arguments:
 Options:
   --calc-MD                Also run QC for MD values,
   --calc-all               Also run QC for for MD, AD, and RD values.
-  --subject-filter         String to filter subject list by
+  --subject-filter STR     String to filter subject list by
   --index                  Only write index pages and exit
+  --n-jobs N               Number of QC images to draw at the same time (default = 1)
+  --rerender               Draw every QC image, even the ones that are up to date
+  --qc-renderer NAME       Draw the QC images with nilearn or numpy (see enigma_qc.py) (default = nilearn)
   -v,--verbose             Verbose logging
   --debug                  Debug logging in Erin's very verbose style
   -n,--dry-run             Dry run
@@ -23,12 +26,17 @@ This creates some QC outputs from of enigmaDTI pipeline stuff.
 QC outputs are placed within <outputdir>/QC.
 Right now QC constist of pictures of the skeleton on the registered image, for every subject.
 Pictures are assembled in html pages for quick viewing.
+The pictures are drawn by a pool of "--n-jobs" processes (each sets up
+matplotlib and nilearn once and then draws many pictures). With "--qc-renderer numpy"
+they are drawn with numpy and Pillow instead of nilearn. A picture is only
+drawn again if it is older than the skeleton or _to_target image it shows,
+so running this again after adding subjects only draws the new ones.
 This is configured to work for outputs of the enigma dti pipeline (dm-proc-enigmadti.py).
 
 The inspiration for these QC practices come from engigma DTI
 http://enigma.ini.usc.edu/wp-content/uploads/DTI_Protocols/ENIGMA_FA_Skel_QC_protocol_USC.pdf
 
-Future plan: add section that checks results for normality and identifies outliers..
+To check the results for normality and find the outliers, see run_group_outliers.py
 
 Requires datman python enviroment, FSL and imagemagick.
 
@@ -37,22 +45,29 @@ Written by Erin W Dickie, August 14 2015
 from docopt import docopt
 import pandas as pd
 import os
-import nilearn.plotting 
 from glob import glob
 import tempfile
 import shutil
+import sys
+import enigma_exec
+import enigma_qc
+
+DRYRUN = False
+DEBUG = False
+VERBOSE = False
+QC_RENDERER = 'nilearn'
 
 ### Erin's little function for running things in the shell
 def docmd(cmdlist):
-    "sends a command (inputed as a list) to the shell"
-    if DEBUG: print(' '.join(cmdlist))
-    if not DRYRUN: subprocess.call(cmdlist)
+    "sends a command (inputed as a list) to the shell, stops if it fails"
+    enigma_exec.docmd(cmdlist, debug = DEBUG, dryrun = DRYRUN)
 
 def main():
 
     global DEBUG
     global VERBOSE
     global DRYRUN
+    global QC_RENDERER
 
     arguments       = docopt(__doc__)
     outputdir       = arguments['<outputdir>']
@@ -60,64 +75,114 @@ def main():
     index_only      = arguments['--index']
     CALC_MD         = arguments['--calc-MD']
     CALC_ALL        = arguments['--calc-all']
+    RERENDER        = arguments['--rerender']
+    n_jobs          = arguments['--n-jobs']
+    qc_renderer     = arguments['--qc-renderer']
     VERBOSE         = arguments['--verbose']
     DEBUG           = arguments['--debug']
     DRYRUN          = arguments['--dry-run']
 
     if DEBUG: print(arguments)
+    n_jobs = 1 if n_jobs == None else int(n_jobs)
+    if qc_renderer != None: QC_RENDERER = qc_renderer
+    if QC_RENDERER not in enigma_qc.RENDERERS:
+        sys.exit("--qc-renderer must be one of {}".format(', '.join(enigma_qc.RENDERERS)))
 
     ## if no result file is given use the default name
     outputdir = os.path.normpath(outputdir)
-    all_FAskels = glob('{}/sub*/FA/*skel*'.format(outputdir))
+    all_FAskels = glob('{}/sub*/FA/*FAskel.nii.gz'.format(outputdir))
     all_FAskels.sort()
 
     if subject_filter:
-        FAskels = [x for x in FAskels if test_sub in x]
+        FAskels = [x for x in all_FAskels if subject_filter in x]
     else:
         FAskels = all_FAskels
 
     tags = ['FA']
     if CALC_MD: tags = tags + ['MD']
-    if CALC_ALL: tags = tags + ['MD','RD','AD']
+    if CALC_ALL: tags = tags + [tag for tag in ['MD','RD','AD'] if tag not in tags]
 
     ## find the files that match the resutls tag...first using the place it should be from doInd-enigma-dti.py
     QCdir = os.path.join(outputdir,'QC')
     os.makedirs(QCdir , exist_ok=True)
 
-    for FAskel in FAskels:
-        if not index_only:
-            build_subject_page(FAskel, QCdir, tags)
+    failed = []
+    if not index_only:
+        pages = [subject_pics(FAskel, QCdir, tags) for FAskel in FAskels]
+        renders = [(pic, (skel_nii, pic, display_mode), {})
+                   for subject_session, qc_subdir, pics in pages
+                   for skel_nii, pic, display_mode in pics
+                   if RERENDER or not is_fresh(pic, skel_nii)]
+        n_pics = sum(len(pics) for subject_session, qc_subdir, pics in pages)
+        print("Rendering {} of {} QC images ({} are up to date)".format(
+            len(renders), n_pics, n_pics - len(renders)))
+        try:
+            enigma_exec.run_branches(render_pic, renders, n_jobs,
+                                     initializer = init_render_worker, initargs = (DEBUG, QC_RENDERER))
+        except enigma_exec.BranchError as e:
+            failed = e.failed
+        for subject_session, qc_subdir, pics in pages:
+            write_subject_page(subject_session, qc_subdir, [pic for skel_nii, pic, display_mode in pics])
 
     for tag in tags:
         for display_mode in ["z", "x"]:
             build_index(QCdir, tag, display_mode)
 
-def build_subject_page(FAskel, QCdir, tags):
-    '''
-    builds the images from a single subject
-    
-    FAskel     path to the participants FAskeletin image
-    QCdir      path to the qc images outputdirectory
-    tags       list of the tags (FA, MD, RD, AD)
+    if len(failed) > 0:
+        sys.exit("{} QC image(s) could not be made".format(len(failed)))
+
+def subject_pics(FAskel, QCdir, tags):
     '''
-    subject_session = subject_session = os.path.basename(os.path.dirname(os.path.dirname(FAskel)))
+    the QC images of a single subject
 
+    returns the subject_session, its qc folder and a list of (skel_nii, pic, display_mode)
+    for the tags whose skeleton image exists
+    '''
+    subject_session = os.path.basename(os.path.dirname(os.path.dirname(FAskel)))
     qc_subdir = os.path.join(QCdir, subject_session)
-
-    if DEBUG: print("Building QC page for {}".format(subject_session))
-
-    os.makedirs(qc_subdir, exist_ok=True)
-    subpics = []
-    
+    pics = []
     for tag in tags:
+        skel_nii = FAskel.replace("FA", tag)
+        if not os.path.isfile(skel_nii):
+            print("{} not found, skipping its QC images".format(skel_nii))
+            continue
         for display_mode in ["z", "x"]:
             pic = os.path.join(qc_subdir, '{}_{}skel_{}.png'.format(
                 subject_session, tag, display_mode))
-            overlay_skel(FAskel.replace("FA", tag), pic, 
-                display_mode = display_mode)
-            subpics.append(pic)
+            pics.append((skel_nii, pic, display_mode))
+    return subject_session, qc_subdir, pics
 
-        ## write an html page that shows all the pics
+def is_fresh(pic, skel_nii):
+    '''
+    True if the QC image is newer than the skeleton and the _to_target image it is drawn from
+    '''
+    if not os.path.isfile(pic):
+        return False
+    sources = [skel_nii, enigma_qc.background_path(skel_nii)]
+    return os.path.getmtime(pic) > max(os.path.getmtime(f) for f in sources if os.path.isfile(f))
+
+def init_render_worker(debug, qc_renderer):
+    '''
+    set up a render process once (the Agg backend - no display needed), it then draws many images
+    '''
+    global DEBUG
+    global QC_RENDERER
+    DEBUG = debug
+    QC_RENDERER = qc_renderer
+    if QC_RENDERER == 'nilearn':
+        import matplotlib
+        matplotlib.use('Agg')
+
+def render_pic(skel_nii, pic, display_mode):
+    if DEBUG: print("Rendering {}".format(pic))
+    os.makedirs(os.path.dirname(pic), exist_ok=True)
+    enigma_qc.overlay_skel(skel_nii, pic, display_mode = display_mode, renderer = QC_RENDERER)
+
+def write_subject_page(subject_session, qc_subdir, subpics):
+    '''
+    write the html page that shows all the pics of one subject
+    '''
+    os.makedirs(qc_subdir, exist_ok=True)
     qchtml = open(os.path.join(qc_subdir, 'index.html'),'w')
     qchtml.write('<HTML><TITLE>' + subject_session + 'skeleton QC page</TITLE>')
     qchtml.write('<BODY BGCOLOR=#333333>\n')
@@ -153,31 +218,6 @@ def build_index(QCdir, tag, display_mode):
         qchtml.close() # you can omit in most cases as the destructor will call it
 
 
-def overlay_skel(skel_nii, overlay_png_path, display_mode = "z"):
-    '''
-    create an overlay image montage of
-    skel_nii image in orange on top of the background_nii
-    Uses nilearn plotting
-
-    skel_nii        the nifty image to be overlayed in magenta (i.e. "FAskel.nii.gz")
-    overlay_png_path     the name of the output (output.png)
-    '''
-    if display_mode=="x":
-        cut_coords = [-36, -16, 2, 10, 42]
-    if display_mode=="y":
-        cut_coords = [-40, -20, -10, 0, 10, 20]
-    if display_mode=="z":
-        cut_coords = [-4, 2, 8, 12, 20, 40]
-
-    nilearn.plotting.plot_img(skel_nii, 
-        bg_img = skel_nii.replace("skel", "_to_target"),
-        threshold = 0.000001, 
-        display_mode = display_mode,
-        cut_coords = cut_coords, 
-        cmap = "Oranges", 
-        colorbar = True,
-        output_file = overlay_png_path)
-
 def overlay_skel_fsl(background_nii, skel_nii,overlay_gif):
     '''
     create an overlay image montage of
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+Builds the group ENIGMA DTI results table straight from every subjects skeleton image.
+
+Usage:
+  run_group_roi_matrix.py [options] <outputdir> <postfix> <resultsfile>
+
+Arguments:
+    <outputdir>        Top directory for the output file structure
+    <postfix>          Metric to extract (ex FA, MD, RD, OD), also appended to the column names
+    <resultsfile>      Filename for the results csv output
+
+Options:
+  --skel-tag STR           String that ends the skeleton image names (default = '<postfix>skel.nii.gz')
+  --values-file NPY        Where to keep the subjects x skeleton voxels matrix (default = <outputdir>/group_<postfix>skel_values.npy)
+  --lookup-table TXT       Atlas look up table (default = ENIGMA_look_up_table.txt from ENIGMAHOME)
+  --atlas NII              Atlas label image (default = JHU-WhiteMatter-labels-1mm.nii.gz from ENIGMAHOME)
+  --output-nVox            Output value from "nVoxels" column instead of "Average"
+  --rebuild                Re-read all skeleton images even if the values file is up to date
+  --n-jobs N               Number of skeleton images to read at the same time (default = 1)
+  -v,--verbose             Verbose logging
+  --debug                  Debug logging in Erin's very verbose style
+  -n,--dry-run             Dry run
+
+DETAILS
+This gives the same table as running the ROI extraction for every subject and
+then run_group_enigma_concat.py - but without reading any per-subject csv files.
+Every <outputdir>/<subject>/<postfix>/*<postfix>skel.nii.gz image is read once
+and only its skeleton voxels are kept, in a memory-mapped (numpy .npy) float32
+array of subjects x skeleton voxels. The whole subjects x tracts table then
+comes from one sparse matrix product over the atlas labels
+(and a second one for the bilateral/composite tracts).
+
+The values file is reused as long as the template skeleton and the skeleton
+images have not changed, so re-extracting a whole study after changing
+the atlas or the look up table ("--atlas", "--lookup-table") does not read any images.
+
+Requires ENIGMAHOME to be set (or the enigmaDTI folder of this repo to exist),
+like run_participant_enigma_extract.py.
+"""
+from docopt import docopt
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import glob
+import json
+import os
+import sys
+import enigma_roi
+
+DRYRUN = False
+DEBUG = False
+VERBOSE = False
+
+def main():
+
+    global DEBUG
+    global VERBOSE
+    global DRYRUN
+
+    arguments       = docopt(__doc__)
+    outputdir       = arguments['<outputdir>']
+    postfix         = arguments['<postfix>']
+    resultsfile     = arguments['<resultsfile>']
+    skel_tag        = arguments['--skel-tag']
+    values_file     = arguments['--values-file']
+    lookup_table    = arguments['--lookup-table']
+    atlas           = arguments['--atlas']
+    OUTPUT_nVOXELS  = arguments['--output-nVox']
+    REBUILD         = arguments['--rebuild']
+    n_jobs          = arguments['--n-jobs']
+    VERBOSE         = arguments['--verbose']
+    DEBUG           = arguments['--debug']
+    DRYRUN          = arguments['--dry-run']
+
+    if DEBUG: print(arguments)
+
+    ENIGMAREPO = os.path.dirname(os.path.realpath(__file__))
+
+    # check that ENIGMAHOME environment variable exists
+    # or set the ENIGMAHOME to engimaDTI is the correct file found
+    ENIGMAHOME = os.getenv('ENIGMAHOME')
+    if ENIGMAHOME==None:
+        potential_enigmahome = os.path.join(ENIGMAREPO, 'enigmaDTI')
+        if os.path.isfile(os.path.join(potential_enigmahome, 'ENIGMA_DTI_FA.nii.gz')):
+            ENIGMAHOME=potential_enigmahome
+            ENIGMAROI=os.path.join(ENIGMAREPO, 'ROIextraction_info')
+        else:
+            sys.exit("ENIGMAHOME environment variable is undefined. Try again.")
+    else:
+         ENIGMAROI=ENIGMAHOME
+
+    outputdir = os.path.normpath(outputdir)
+    if skel_tag == None: skel_tag = postfix + 'skel.nii.gz'
+    if values_file == None:
+        values_file = os.path.join(outputdir, 'group_{}skel_values.npy'.format(postfix))
+    if lookup_table == None:
+        lookup_table = os.path.join(ENIGMAROI, 'ENIGMA_look_up_table.txt')
+    if atlas == None:
+        atlas = os.path.join(ENIGMAROI, 'JHU-WhiteMatter-labels-1mm.nii.gz')
+    n_jobs = 1 if n_jobs == None else int(n_jobs)
+    template_skel = os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA_skeleton.nii.gz')
+
+    ## find the skeletons - they should be in <outputdir>/<subject>/<postfix>/
+    skel_files = sorted(glob.glob(os.path.join(outputdir, '*', postfix, '*' + skel_tag)))
+    if len(skel_files) == 0:
+        sys.exit('Could not find any skeleton images ending in {}'.format(skel_tag))
+    subject_ids = [os.path.basename(os.path.dirname(os.path.dirname(f))) for f in skel_files]
+    if DEBUG: print(skel_files)
+
+    index = enigma_roi.load_skeleton_index(template_skel, atlas)
+    ## keep the columns in voxel order, so the values do not depend on the atlas
+    column_order = np.argsort(index.voxels)
+    voxels = np.asarray(index.voxels)[column_order]
+    labels = np.asarray(index.labels)[column_order]
+
+    values = load_skeleton_values(values_file, skel_files, template_skel,
+                                  index.shape, voxels, n_jobs, REBUILD)
+    if DRYRUN: return
+
+    ## one sparse product for the atlas ROIs, and another for the averaged tracts
+    lut = enigma_roi.read_look_up_table(lookup_table)
+    roi_names = ['AverageFA'] + [name for code, name in lut]
+    roi_averages, roi_nvoxels = enigma_roi.group_roi_stats(values, labels, [code for code, name in lut])
+    tractnames, tract_averages, tract_nvoxels = enigma_roi.average_tracts(
+        roi_averages, roi_nvoxels, roi_names)
+
+    tractcolnames = [tract + '_' + postfix for tract in tractnames]
+    if OUTPUT_nVOXELS:
+        results = pd.DataFrame(tract_nvoxels.astype(np.int64), columns = tractcolnames)
+    else:
+        results = pd.DataFrame(tract_averages, columns = tractcolnames)
+    results.insert(0, 'id', subject_ids)
+
+    ## write the results out to a file
+    ## (6 significant digits, like the per-subject *_ROIout_avg.csv files)
+    if VERBOSE: print("Writing {} subjects to {}".format(len(results), resultsfile))
+    results.to_csv(resultsfile, sep=',', index = False, float_format = '%g')
+
+def load_skeleton_values(values_file, skel_files, template_skel, shape, voxels, n_jobs, rebuild):
+    '''
+    returns the (memory-mapped) subjects x skeleton voxels array
+    re-reading the skeleton images only if needed
+
+    values_file     the .npy file holding the array
+    skel_files      list of skeleton images (one per row)
+    template_skel   the template skeleton (if it changes, the file is rebuilt)
+    shape           the image dimensions of the template
+    voxels          flat (fortran order) indices of the skeleton voxels (the columns)
+    n_jobs          number of images to read at the same time
+    rebuild         re-read the images even if the file is up to date
+    '''
+    info_file = values_file.replace('.npy', '') + '.json'
+    info = {'template_skeleton_sha256': enigma_roi.file_hash(template_skel),
+            'nvoxels': int(len(voxels)),
+            'files': [[f, os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in skel_files]}
+
+    if not rebuild and os.path.isfile(values_file) and os.path.isfile(info_file):
+        with open(info_file, 'r') as f:
+            if json.load(f) == info:
+                if VERBOSE: print("Reusing skeleton values from {}".format(values_file))
+                return np.load(values_file, mmap_mode='r')
+
+    if VERBOSE: print("Reading {} skeleton images into {}".format(len(skel_files), values_file))
+    if DRYRUN: return None
+
+    tmp_file = values_file.replace('.npy', '') + '.tmp.npy'
+    values = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32,
+                                       shape=(len(skel_files), len(voxels)))
+
+    def read_row(row):
+        data = enigma_roi.load_volume(skel_files[row])
+        if data.shape != tuple(shape):
+            raise ValueError("Image dimensions of {} {} do not match the skeleton {}".format(
+                skel_files[row], data.shape, shape))
+        values[row] = data.ravel(order='F')[voxels]
+        if DEBUG: print("Read {}".format(skel_files[row]))
+
+    with ThreadPoolExecutor(max_workers = n_jobs) as pool:
+        list(pool.map(read_row, range(len(skel_files))))
+    values.flush()
+    del values
+
+    os.replace(tmp_file, values_file)
+    with open(info_file, 'w') as f:
+        json.dump(info, f)
+    return np.load(values_file, mmap_mode='r')
+
+if __name__ == '__main__':
+    main()
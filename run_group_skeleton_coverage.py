@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Gathers the skeleton coverage diagnostics of a group and flags the subjects to check.
+
+Usage:
+  run_group_skeleton_coverage.py [options] <outputdir>
+
+Arguments:
+    <outputdir>        Top directory of the participant outputs (ex. enigmaDTI)
+
+Options:
+  --output-file CSV        Write the group table here (default = <outputdir>/group_skeleton_coverage.csv)
+  --min-coverage F         Flag images with less of the skeleton covered than this (default = 0.95)
+  --min-tract-coverage F   Flag images with a tract covered less than this (default = 0.8)
+  --outlier-z Z            Flag images with a robust z score of their coverage or median value beyond Z (default = 3.5)
+  -v,--verbose             Verbose logging
+  --debug                  Debug logging in Erin's very verbose style
+
+DETAILS
+Reads the <outputdir>/*/ROI/*_coverage.json files written by enigma_roi.extract_roi
+(for every metric of every participant) into one table, with one row per image:
+the fraction of the template skeleton with data, the worst covered tract, the
+number of zero, NaN and negative voxels and the percentiles of the values.
+
+A registration failure (or a cropped or empty image) shows up as missing
+skeleton, so an image is flagged when:
+    low_coverage        its coverage is below "--min-coverage", or Z robust standard
+                        deviations (1.4826 x the median absolute deviation, see
+                        enigma_stats.py) below the median coverage of that metric
+    low_tract_coverage  one of its tracts is covered less than "--min-tract-coverage"
+    empty_tract         one of its tracts has no data at all
+    nan_voxels          it has NaN values on the skeleton
+    value_outlier       its median value is Z robust standard deviations away from the
+                        median of that metric
+The table is sorted with the flagged images first (the lowest coverage first),
+so the images to open are at the top.
+"""
+from docopt import docopt
+import pandas as pd
+import glob
+import json
+import os
+import re
+import sys
+import enigma_stats
+
+DEBUG = False
+VERBOSE = False
+
+def metric_name(coverage_json):
+    '''
+    the metric of a coverage file (ex. FA for sub-01_FA_FAskel_coverage.json)
+    '''
+    match = re.search(r'([^_]+)skel_coverage\.json$', os.path.basename(coverage_json))
+    return match.group(1) if match else os.path.basename(coverage_json).replace('_coverage.json', '')
+
+def read_coverage(outputdir):
+    '''
+    a DataFrame with one row per coverage file of the participants in outputdir
+    '''
+    rows = []
+    for path in sorted(glob.glob(os.path.join(outputdir, '*', 'ROI', '*_coverage.json'))):
+        if DEBUG: print("Reading {}".format(path))
+        try:
+            with open(path, 'r') as f:
+                coverage = json.load(f)
+        except ValueError as e:
+            print("Could not read {}: {}".format(path, e))
+            continue
+        row = {'participant': os.path.basename(os.path.dirname(os.path.dirname(path))),
+               'metric': metric_name(path)}
+        row.update({k: v for k, v in coverage.items() if k not in ['percentiles', 'tract_coverage', 'empty_tracts']})
+        row.update({'p{}'.format(q): v for q, v in coverage['percentiles'].items()})
+        row['empty_tracts'] = ';'.join(coverage['empty_tracts'])
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def flag_images(table, min_coverage, min_tract_coverage, outlier_z):
+    '''
+    add the robust z scores and the flags (a ";" separated list per image) to the table
+    '''
+    table = table.copy()
+    by_metric = table.groupby('metric')
+    table['coverage_z'] = by_metric['coverage'].transform(lambda v: enigma_stats.robust_z(v.to_numpy(dtype = float))).round(2)
+    table['median_z'] = by_metric['p50'].transform(lambda v: enigma_stats.robust_z(v.to_numpy(dtype = float))).round(2)
+    flags = {'low_coverage': (table['coverage'] < min_coverage) | (table['coverage_z'] < -outlier_z),
+             'low_tract_coverage': table['worst_tract_coverage'].fillna(0) < min_tract_coverage,
+             'empty_tract': table['empty_tracts'] != '',
+             'nan_voxels': table['nan_nvoxels'] > 0,
+             'value_outlier': table['median_z'].abs() > outlier_z}
+    table['flags'] = [';'.join(name for name in flags if flags[name].iloc[i]) for i in range(len(table))]
+    table['flagged'] = table['flags'] != ''
+    return table.sort_values(['flagged', 'coverage'], ascending = [False, True])
+
+def main():
+
+    global DEBUG
+    global VERBOSE
+
+    arguments           = docopt(__doc__)
+    outputdir           = arguments['<outputdir>']
+    output_file         = arguments['--output-file']
+    min_coverage        = arguments['--min-coverage']
+    min_tract_coverage  = arguments['--min-tract-coverage']
+    outlier_z           = arguments['--outlier-z']
+    VERBOSE             = arguments['--verbose']
+    DEBUG               = arguments['--debug']
+
+    if DEBUG: print(arguments)
+
+    if output_file == None: output_file = os.path.join(outputdir, 'group_skeleton_coverage.csv')
+    min_coverage = 0.95 if min_coverage == None else float(min_coverage)
+    min_tract_coverage = 0.8 if min_tract_coverage == None else float(min_tract_coverage)
+    outlier_z = 3.5 if outlier_z == None else float(outlier_z)
+
+    table = read_coverage(outputdir)
+    if len(table) == 0:
+        sys.exit("No */ROI/*_coverage.json files found in {}".format(outputdir))
+    table = flag_images(table, min_coverage, min_tract_coverage, outlier_z)
+    if os.path.dirname(output_file) != '':
+        os.makedirs(os.path.dirname(output_file), exist_ok = True)
+    table.to_csv(output_file, index = False)
+
+    flagged = table[table['flagged']]
+    print("{} images of {} participants, {} flagged, written to {}".format(
+        len(table), table['participant'].nunique(), len(flagged), output_file))
+    with pd.option_context('display.width', 200, 'display.max_columns', 30):
+        print(table.groupby('metric')['coverage'].describe(percentiles = [0.01, 0.5]).round(4).to_string())
+        if len(flagged) > 0 and (VERBOSE or len(flagged) <= 20):
+            print(flagged[['participant', 'metric', 'coverage', 'coverage_z', 'worst_tract',
+                           'worst_tract_coverage', 'nan_nvoxels', 'median_z', 'flags']].to_string(index = False))
+
+if __name__ == '__main__':
+    main()
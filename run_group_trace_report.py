@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+Summarizes the timing traces of a group of participant runs.
+
+Usage:
+  run_group_trace_report.py [options] <outputdir>
+
+Arguments:
+    <outputdir>        Top directory of the participant outputs (ex. enigmaDTI)
+
+Options:
+  --kind KIND              What to summarize, step, command or run (default = step)
+  --summary-file CSV       Write the per step summary here (default = <outputdir>/logs/trace_<kind>_summary.csv)
+  --outliers-file CSV      Write the slow outliers here (default = <outputdir>/logs/trace_<kind>_outliers.csv)
+  --outlier-z Z            Flag runs of a step with a robust z score of the wall time above Z (default = 3.5)
+  --last-run               Only use the latest run of each participant
+  -v,--verbose             Verbose logging
+  --debug                  Debug logging in Erin's very verbose style
+
+DETAILS
+Reads the <outputdir>/*/enigma_trace.jsonl files written by the participant
+scripts (see enigma_trace.py) and, for every step (or command, or whole run),
+prints and writes the number of runs and the 50th, 90th, 95th and 99th
+percentiles of the wall time, CPU time and peak memory. The peak memory of a
+step is that of the commands it ran (the in process steps have none of their
+own, see enigma_trace.py), the peak memory of a run is that of the whole job.
+
+A run of a step is flagged as a slow outlier when its wall time is more than Z
+robust standard deviations (1.4826 x the median absolute deviation, at least
+one second, see enigma_stats.py) above the median of that step. The hosts whose
+steps are, on median, 1.5 times slower than the group (ex. nodes with a slow
+filesystem) are listed as well.
+
+The last lines give SLURM settings sized from the whole runs (the 99th percentile
+plus 25 percent) for "--time" and "--mem-per-cpu".
+"""
+from docopt import docopt
+import numpy as np
+import pandas as pd
+import glob
+import math
+import os
+import sys
+import enigma_stats
+import enigma_trace
+
+DEBUG = False
+VERBOSE = False
+
+## percentiles in the summary
+PERCENTILES = [50, 90, 95, 99]
+
+## a host is slow if its steps take this many times the group median
+SLOW_HOST_RATIO = 1.5
+
+def read_traces(outputdir, last_run = False):
+    '''
+    a DataFrame of every trace line of the participants in outputdir
+    '''
+    lines = []
+    for path in sorted(glob.glob(os.path.join(outputdir, '*', enigma_trace.TRACE_NAME))):
+        if DEBUG: print("Reading {}".format(path))
+        lines.extend(enigma_trace.read_trace(path))
+    traces = pd.DataFrame(lines)
+    if len(traces) > 0 and last_run:
+        runs = traces.groupby(['participant', 'run_id'])['start'].min().reset_index()
+        latest = runs.sort_values('start').groupby('participant').tail(1)
+        traces = traces[traces['run_id'].isin(latest['run_id'])]
+    return traces
+
+def summarize(traces):
+    '''
+    per name percentiles of the wall time, CPU time and peak memory
+    '''
+    rows = []
+    for name, group in traces.groupby('name', sort = False):
+        row = {'name': name, 'n': len(group)}
+        for column in ['wall', 'cpu', 'max_rss_mb']:
+            values = group[column].to_numpy(dtype = float)
+            for q, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                row['{}_p{}'.format(column, q)] = round(value, 1)
+            row['{}_max'.format(column)] = round(values.max(), 1)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def find_outliers(traces, z_threshold):
+    '''
+    the runs of each step with a wall time z_threshold robust z scores above the median of that step
+    '''
+    traces = traces.copy()
+    traces['step_median_wall'] = traces.groupby('name')['wall'].transform('median')
+    traces['wall_z'] = traces.groupby('name')['wall'].transform(lambda wall: enigma_stats.robust_z(wall.to_numpy(dtype = float), min_spread = 1.0))
+    outliers = traces[traces['wall_z'] > z_threshold]
+    return outliers.sort_values('wall_z', ascending = False)[
+        ['participant', 'name', 'host', 'wall', 'step_median_wall', 'wall_z', 'max_rss_mb', 'run_id']]
+
+def slow_hosts(traces):
+    '''
+    the median (over its runs) of the wall time divided by the group median of the step, for every host
+    '''
+    ratio = traces['wall'] / traces.groupby('name')['wall'].transform('median').clip(lower = 1.0)
+    hosts = ratio.groupby(traces['host']).agg(['median', 'count'])
+    hosts.columns = ['median_ratio', 'n']
+    return hosts.sort_values('median_ratio', ascending = False)
+
+def slurm_time(seconds):
+    minutes = int(math.ceil(seconds / 60.0))
+    return '{:02d}:{:02d}:00'.format(minutes // 60, minutes % 60)
+
+def main():
+
+    global DEBUG
+    global VERBOSE
+
+    arguments       = docopt(__doc__)
+    outputdir       = arguments['<outputdir>']
+    kind            = arguments['--kind']
+    summary_file    = arguments['--summary-file']
+    outliers_file   = arguments['--outliers-file']
+    outlier_z       = arguments['--outlier-z']
+    last_run        = arguments['--last-run']
+    VERBOSE         = arguments['--verbose']
+    DEBUG           = arguments['--debug']
+
+    if DEBUG: print(arguments)
+
+    if kind == None: kind = 'step'
+    if kind not in ['step', 'command', 'run']:
+        sys.exit("--kind must be one of step, command or run")
+    outlier_z = 3.5 if outlier_z == None else float(outlier_z)
+    if summary_file == None:
+        summary_file = os.path.join(outputdir, 'logs', 'trace_{}_summary.csv'.format(kind))
+    if outliers_file == None:
+        outliers_file = os.path.join(outputdir, 'logs', 'trace_{}_outliers.csv'.format(kind))
+
+    traces = read_traces(outputdir, last_run)
+    if len(traces) == 0:
+        sys.exit("No {} files found in {}".format(enigma_trace.TRACE_NAME, outputdir))
+    done = traces[(traces['kind'] == kind) & (traces['status'] == 'done')]
+    print("{} participants, {} runs, {} {} records".format(
+        traces['participant'].nunique(), traces['run_id'].nunique(), len(done), kind))
+
+    summary = summarize(done)
+    outliers = find_outliers(done, outlier_z)
+    for path in [summary_file, outliers_file]:
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+    summary.to_csv(summary_file, index = False)
+    outliers.to_csv(outliers_file, index = False)
+
+    with pd.option_context('display.width', 200, 'display.max_columns', 30):
+        print(summary[['name', 'n', 'wall_p50', 'wall_p95', 'wall_p99', 'wall_max',
+                       'cpu_p50', 'max_rss_mb_p50', 'max_rss_mb_p99', 'max_rss_mb_max']].to_string(index = False))
+        print("\n{} slow outliers (robust z > {}), written to {}".format(len(outliers), outlier_z, outliers_file))
+        if len(outliers) > 0 and (VERBOSE or len(outliers) <= 20):
+            print(outliers.to_string(index = False))
+
+        hosts = slow_hosts(done)
+        slow = hosts[hosts['median_ratio'] > SLOW_HOST_RATIO]
+        if len(slow) > 0:
+            print("\nHosts slower than {} x the group median:".format(SLOW_HOST_RATIO))
+            print(slow.round(2).to_string())
+        elif VERBOSE:
+            print("\nHosts:")
+            print(hosts.round(2).to_string())
+
+    runs = traces[(traces['kind'] == 'run') & (traces['status'] == 'done')]
+    if len(runs) > 0:
+        wall_p99, rss_p99 = np.percentile(runs['wall'], 99), np.percentile(runs['max_rss_mb'], 99)
+        print("\nSuggested SLURM settings (from {} runs, 99th percentile + 25%):".format(len(runs)))
+        print("#SBATCH --time={}".format(slurm_time(1.25 * wall_p99)))
+        print("#SBATCH --mem-per-cpu={}M".format(int(math.ceil(1.25 * rss_p99))))
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,12 @@ Arguments:
 Options:
   --calc-MD                Option to process MD image as well
   --calc-all               Option to process MD, AD and RD
+  --batch-warp             Mask and warp all the non-FA maps together in one applywarp call
+  --recalc-MD              Calculate MD as the mean of L1, L2 and L3 (instead of using the dtifit MD image)
+  --rerun-all              Run every step, even the ones that are up to date
+  --n-jobs N               Number of the MD, AD and RD branches to run at the same time (default = 1)
+  --retries N              Retry a failed FSL command up to N times (default = 0)
+  --qc-renderer NAME       Draw the QC images with nilearn or numpy (see enigma_qc.py) (default = nilearn)
   -v,--verbose             Verbose logging
   --debug                  Debug logging in Erin's very verbose style
   -n,--dry-run             Dry run
@@ -30,6 +36,24 @@ So, the script will not run if more than one FA image (or the wrong FAimage) is
 By default, this extracts FA values for each ROI in the atlas.
 To extract MD as well, call with the "--calc-MD" option.
 To extract FA, MD, RD and AD, call with the "--calc-all" option.
+The non-FA maps are calculated and masked in memory from the dti-fit outputs
+(AD = L1, RD = (L2 + L3) / 2), reading each dti-fit image only once.
+With "--batch-warp" they are stacked into one 4D image and warped with a
+single applywarp call (instead of one applywarp per map).
+Each step (preproc, reg, postreg, skeletonize, ROI, average, QC - and the same for
+the non-FA maps) declares its inputs, outputs and parameters, and is recorded in
+<outputdir>/.enigma_steps/ when it finishes (see enigma_steps.py). Running the script
+again on the same outputdir skips every step whose record is still up to date, so
+a rerun after a crash (or after changing only the look up table) does not redo the
+registration. Use "--rerun-all" to run every step anyway.
+Once FA is done, the MD, AD and RD branches only read the FA outputs and
+each write to their own folder (and their own files in ROI/), so with
+"--n-jobs" they are run at the same time, in separate processes.
+If a branch fails the others still finish, then the script exits with an error.
+If an FSL command fails (exits with a non zero code) the run stops right away
+and the outputs of the step it was part of are removed, so that nothing is
+skeletonized or extracted from a half written image. Use "--retries" to retry
+failed commands first (ex. for a busy filesystem).
 Requires ENIGMA dti enviroment to be set (for example):
 module load FSL/5.0.7 R/3.1.1 ENIGMA-DTI/2015.01
 also requires datman python enviroment.
@@ -40,57 +64,202 @@ http://enigma.ini.usc.edu/protocols/dti-protocols/
 """
 from docopt import docopt
 import pandas as pd
-import nilearn.plotting
 import glob
 import os
 import sys
-import subprocess
+import enigma_exec
+import enigma_qc
+import enigma_roi
+import enigma_steps
+import enigma_tbss
+import enigma_trace
 
 DRYRUN = False
 DEBUG = False
+RERUN_ALL = False
+RETRIES = 0
+QC_RENDERER = 'nilearn'
+TRACE = None
+
+## the steps that are running (step name -> (key, inputs, outputs, params))
+_running_steps = {}
+## when they started (step name -> (enigma_trace.snapshot, number of commands run before))
+_step_starts = {}
 
 ### Erin's little function for running things in the shell
 def docmd(cmdlist):
-    "sends a command (inputed as a list) to the shell"
-    if DEBUG: print(' '.join(cmdlist))
-    if not DRYRUN: subprocess.call(cmdlist)
+    "sends a command (inputed as a list) to the shell, stops the run if it fails"
+    enigma_exec.docmd(cmdlist, debug = DEBUG, dryrun = DRYRUN, retries = RETRIES, trace = TRACE)
+
+def remove_partial_outputs():
+    '''
+    remove the outputs of the steps that were running when a command
+    (or one of the in process steps) failed
+    '''
+    for step in list(_running_steps):
+        key, inputs, outputs, params = _running_steps.pop(step)
+        trace_step(step, 'failed')
+        for f in outputs:
+            if os.path.isfile(f):
+                print("Removing {} (step {} failed)".format(f, step))
+                os.remove(f)
+
+def step_needed(step, inputs, outputs, params = {}):
+    '''
+    True if the step has to be run - False if its record in
+    <outputdir>/.enigma_steps is up to date (same inputs, outputs and params)
+    '''
+    key = enigma_steps.step_key(step, inputs, outputs, params, OUTPUTDIR)
+    if not RERUN_ALL and enigma_steps.step_is_current(OUTPUTDIR, step, key, outputs):
+        print("Skipping {} (up to date)".format(step))
+        return False
+    _running_steps[step] = (key, inputs, outputs, params)
+    _step_starts[step] = (enigma_trace.snapshot(), len(enigma_exec.COMMAND_LOG))
+    return True
+
+def trace_step(step, status):
+    '''
+    add the time, CPU time and peak memory of a step to the trace, returns its wall time
+    (nothing is written for a step that was already traced)
+    '''
+    start, first_command = _step_starts.pop(step, (None, None))
+    if start == None:
+        return 0.0
+    line = enigma_trace.since(start, 'step', step, status, enigma_exec.COMMAND_LOG[first_command:])
+    enigma_trace.write_line(TRACE, line)
+    return line['wall']
+
+def step_done(step):
+    '''
+    record a step (started with step_needed) as finished
+    '''
+    key, inputs, outputs, params = _running_steps.pop(step)
+    wall = trace_step(step, 'done')
+    print("{} took {:.1f}s".format(step, wall))
+    if DRYRUN: return
+    if key == None:
+        ## the inputs were made by an earlier step of this run
+        key = enigma_steps.step_key(step, inputs, outputs, params, OUTPUTDIR)
+    enigma_steps.save_record(OUTPUTDIR, step, key, inputs, outputs, params)
+
+## the globals the metric branches need (set in main, and in each branch worker)
+BRANCH_GLOBALS = ['DEBUG', 'DRYRUN', 'RERUN_ALL', 'RETRIES', 'QC_RENDERER', 'TRACE', 'OUTPUTDIR', 'ENIGMAHOME', 'ENIGMAREPO', 'ENIGMAROI',
+                  'skel_thresh', 'distancemap', 'search_rule_mask', 'tbss_skeleton_input', 'tbss_skeleton_alt']
+
+def init_branch_worker(settings):
+    '''
+    set this scripts globals in a worker process (see enigma_exec.run_branches)
+    '''
+    globals().update(settings)
+
+def dtifit_inputs(FAmap, DTItags, recalc_MD = False):
+    '''
+    the dtifit images read to make the DTItags maps
+    '''
+    suffixes = []
+    for DTItag in DTItags:
+        if DTItag == 'MD' and not recalc_MD:
+            suffixes += ['MD']
+        elif DTItag == 'MD':
+            suffixes += ['L1', 'L2', 'L3']
+        elif DTItag == 'AD':
+            suffixes += ['L1']
+        elif DTItag == 'RD':
+            suffixes += ['L2', 'L3']
+    return [FAmap.replace('FA.nii.gz', suffix + '.nii.gz') for suffix in sorted(set(suffixes))]
+
+def skeleton_params():
+    '''
+    the tbss_skeleton settings (all skeletonize steps depend on these)
+    '''
+    return {'skel_thresh': skel_thresh,
+            'tbss_skeleton_input': tbss_skeleton_input,
+            'tbss_skeleton_alt': tbss_skeleton_alt,
+            'distancemap': distancemap,
+            'search_rule_mask': search_rule_mask}
 
 ##############################################################################
 ## Now process the MD if that option was asked for
 ## if processing MD also set up for MD-ness
-def run_non_FA(DTItag, outputdir, FAmap, FAskel):
+def mask_non_FA(DTItags, outputdir, FAmap, recalc_MD = False, stack = None):
+    """
+    Make the non-FA images (MD, AD or RD) from the dti-fit outputs, masked with
+    the subjects FA mask. AD is _L1 in dti-fit and RD the average of _L2 and _L3.
+    These are calculated in memory (reading each dti-fit image once) and written
+    to <DTItag>/*_<DTItag>.nii.gz, or as the volumes of one 4D image if stack is given
+    """
+    image_noext = os.path.basename(FAmap.replace('_FA.nii.gz',''))
+    FAmask = os.path.join(outputdir,'FA', image_noext + '_FA_mask.nii.gz')
+    masked = [os.path.join(outputdir, DTItag, image_noext + '_' + DTItag + '.nii.gz')
+              for DTItag in DTItags]
+
+    if DEBUG: print("Masking {} from {} with {}".format(', '.join(DTItags), FAmap, FAmask))
+    if DRYRUN: return
+    reference_img, volumes = enigma_tbss.dtifit_scalar_maps(FAmap, DTItags, FAmask, recalc_MD)
+    if stack:
+        enigma_tbss.write_stack(volumes, reference_img, stack)
+    else:
+        for volume, masked_nii in zip(volumes, masked):
+            os.makedirs(os.path.dirname(masked_nii), exist_ok=True)
+            enigma_tbss.save_like(volume, reference_img, masked_nii)
+
+def warp_non_FA_batch(DTItags, outputdir, FAmap, recalc_MD = False):
+    """
+    Mask and warp all the non-FA images in one go,
+    by stacking them into a 4D image for a single applywarp call.
+    Writes the same <DTItag>/*_<DTItag>_to_target.nii.gz images as run_non_FA
+    """
+    image_noext = os.path.basename(FAmap.replace('_FA.nii.gz',''))
+    to_targets = [os.path.join(outputdir, DTItag, image_noext + '_' + DTItag + '_to_target.nii.gz')
+                  for DTItag in DTItags]
+    FAmask = os.path.join(outputdir,'FA', image_noext + '_FA_mask.nii.gz')
+    FAwarp = os.path.join(outputdir,'FA', image_noext + '_FA_to_target_warp.nii.gz')
+    target = os.path.join(outputdir,'FA', 'target.nii.gz')
+    if not step_needed('warp', dtifit_inputs(FAmap, DTItags, recalc_MD) + [FAmask, FAwarp, target],
+                       to_targets, {'maps': DTItags, 'recalc_MD': recalc_MD}):
+        return
+
+    tmpdir = os.path.join(outputdir, 'tmp_warp')
+    docmd(['mkdir', '-p', tmpdir])
+    stack = os.path.join(tmpdir, image_noext + '_stack.nii.gz')
+    stack_to_target = os.path.join(tmpdir, image_noext + '_stack_to_target.nii.gz')
+
+    ## mask with subjects FA mask
+    mask_non_FA(DTItags, outputdir, FAmap, recalc_MD, stack = stack)
+
+    # applywarp calculated for FA map (once for all the images)
+    docmd(['applywarp', '-i', stack, \
+        '-o', stack_to_target, \
+        '-r', os.path.join(outputdir,'FA', 'target'),\
+        '-w', os.path.join(outputdir,'FA', image_noext + '_FA_to_target_warp.nii.gz')])
+
+    if DEBUG: print(' '.join(['enigma_tbss.py', 'split', stack_to_target] + to_targets))
+    if not DRYRUN:
+        for to_target in to_targets:
+            os.makedirs(os.path.dirname(to_target), exist_ok=True)
+        enigma_tbss.split_volumes(stack_to_target, to_targets)
+    docmd(['rm', '-r', tmpdir])
+    step_done('warp')
+
+def run_non_FA(DTItag, outputdir, FAmap, FAskel, warped = False):
     """
     The Pipeline to run to extract non-FA values (MD, AD or RD)
+    Expects the masked image from mask_non_FA (or if warped is True,
+    the _to_target image already made by warp_non_FA_batch)
+    """
+    try:
+        non_FA_steps(DTItag, outputdir, FAmap, FAskel, warped)
+    finally:
+        remove_partial_outputs()
+
+def non_FA_steps(DTItag, outputdir, FAmap, FAskel, warped = False):
+    """
+    the steps of run_non_FA
     """
     O_dir = os.path.join(outputdir,DTItag)
     image_noext = os.path.basename(FAmap.replace('_FA.nii.gz',''))
     ROIoutdir = os.path.join(outputdir, 'ROI')
 
-    O_dir_orig = os.path.join(O_dir, 'origdata')
-    os.makedirs(O_dir_orig, exist_ok=True)
-
-    if DTItag == 'MD':
-        image_i = FAmap.replace('FA.nii.gz','MD.nii.gz')
-        image_o = os.path.join(O_dir_orig,image_noext + '_' + DTItag + '.nii.gz')
-        # copy over the MD image if not done already
-        if os.path.isfile(image_o) == False:
-            docmd(['cp',image_i,image_o])
-
-    if DTItag == 'AD':
-        image_i = FAmap.replace('FA.nii.gz','L1.nii.gz')
-        image_o = os.path.join(O_dir_orig,image_noext + '_' + DTItag + '.nii.gz')
-        # copy over the AD image - this is _L1 in dti-fit
-        if os.path.isfile(image_o) == False:
-            docmd(['cp',image_i,image_o])
-
-    if DTItag == 'RD':
-        imageL2 = FAmap.replace('FA.nii.gz','L2.nii.gz')
-        imageL3 = FAmap.replace('FA.nii.gz','L3.nii.gz')
-        image_o = os.path.join(O_dir_orig,image_noext + '_' + DTItag + '.nii.gz')
-        # create the RD image as an average of '_L2' and '_L3' images from dti-fit
-        if os.path.isfile(image_o) == False:
-            docmd(['fslmaths', imageL2, '-add', imageL3, '-div', "2", image_o])
-
     masked =    os.path.join(O_dir,image_noext + '_' + DTItag + '.nii.gz')
     to_target = os.path.join(O_dir,image_noext + '_' + DTItag + '_to_target.nii.gz')
     skel =      os.path.join(O_dir, image_noext + '_' + DTItag +'skel.nii.gz')
@@ -98,69 +267,95 @@ def run_non_FA(DTItag, outputdir, FAmap, FAskel):
     csvout1 =   os.path.join(ROIoutdir, image_noext + '_' + DTItag + 'skel_ROIout')
     csvout2 =   os.path.join(ROIoutdir, image_noext + '_' + DTItag + 'skel_ROIout_avg')
 
-    ## mask with subjects FA mask
-    docmd(['fslmaths', image_o, '-mas', \
-      os.path.join(outputdir,'FA', image_noext + '_FA_mask.nii.gz'), \
-      masked])
-
-    # applywarp calculated for FA map
-    docmd(['applywarp', '-i', masked, \
-        '-o', to_target, \
-        '-r', os.path.join(outputdir,'FA', 'target'),\
-        '-w', os.path.join(outputdir,'FA', image_noext + '_FA_to_target_warp.nii.gz')])
-
-    ## tbss_skeleton step
-    docmd(['tbss_skeleton', \
-          '-i', tbss_skeleton_input, \
-          '-s', tbss_skeleton_alt, \
-          '-p', str(skel_thresh), distancemap, search_rule_mask,
-           FAskel, skel, '-a', to_target])
+    FAwarp = os.path.join(outputdir,'FA', image_noext + '_FA_to_target_warp.nii.gz')
+    target = os.path.join(outputdir,'FA', 'target.nii.gz')
+    if not warped and step_needed('warp_' + DTItag, [masked, FAwarp, target], [to_target]):
+        # applywarp calculated for FA map
+        docmd(['applywarp', '-i', masked, \
+            '-o', to_target, \
+            '-r', os.path.join(outputdir,'FA', 'target'),\
+            '-w', FAwarp])
+        step_done('warp_' + DTItag)
+
+    ## tbss_skeleton step - reuse the projection recorded during the FA step if we have it
+    FAproj = os.path.join(outputdir, 'FA', image_noext + '_FA_projection_index.nii.gz')
+    if os.path.isfile(FAproj) or DRYRUN:
+        if step_needed('skeletonize_' + DTItag, [FAproj, to_target], [skel]):
+            if DEBUG: print(' '.join(['enigma_tbss.py', 'skeletonize', FAproj, to_target, skel]))
+            if not DRYRUN:
+                enigma_tbss.skeletonize_from_projection(FAproj, to_target, skel)
+            step_done('skeletonize_' + DTItag)
+    elif step_needed('skeletonize_' + DTItag,
+                     [tbss_skeleton_input, tbss_skeleton_alt, distancemap, search_rule_mask, FAskel, to_target],
+                     [skel], skeleton_params()):
+        docmd(['tbss_skeleton', \
+              '-i', tbss_skeleton_input, \
+              '-s', tbss_skeleton_alt, \
+              '-p', str(skel_thresh), distancemap, search_rule_mask,
+               FAskel, skel, '-a', to_target])
+        step_done('skeletonize_' + DTItag)
 
     ## ROI extract
-    docmd([os.path.join(ENIGMAROI,'singleSubjROI_exe'),
-              os.path.join(ENIGMAROI,'ENIGMA_look_up_table.txt'), \
-              os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA_skeleton.nii.gz'), \
-              os.path.join(ENIGMAROI, 'JHU-WhiteMatter-labels-1mm.nii.gz'), \
-              csvout1, skel])
+    run_roi_extract(csvout1, skel, 'ROI_' + DTItag)
 
     ## ROI average
-    docmd([os.path.join(ENIGMAROI, 'averageSubjectTracts_exe'), csvout1 + '.csv', csvout2 + '.csv'])
+    run_roi_average(csvout1 + '.csv', csvout2 + '.csv', 'average_' + DTItag)
 
-    if not DRYRUN:
-        overlay_skel(skel_nii = skel, 
-                    overlay_png_path = skelqa)
-        
+    run_overlay_skel(skel, skelqa, 'QC_' + DTItag)
 
-def overlay_skel(skel_nii, overlay_png_path, display_mode = "z"):
+def run_roi_extract(csvout, skel, step = 'ROI'):
     '''
-    create an overlay image montage of
-    skel_nii image in orange on top of the background_nii
-    Uses nilearn plotting
+    extract the ROI values from a skeleton image into <csvout>.csv
+    (in process, replaces the call to singleSubjROI_exe)
+    '''
+    lookup_table = os.path.join(ENIGMAROI,'ENIGMA_look_up_table.txt')
+    template_skel = os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA_skeleton.nii.gz')
+    atlas = os.path.join(ENIGMAROI, 'JHU-WhiteMatter-labels-1mm.nii.gz')
+    if not step_needed(step, [lookup_table, template_skel, atlas, skel],
+                       [csvout + '.csv', enigma_roi.coverage_path(csvout)]):
+        return
+    if DEBUG: print(' '.join(['enigma_roi.py', 'extract', lookup_table, template_skel, atlas, csvout, skel]))
+    if not DRYRUN:
+        enigma_roi.extract_roi(lookup_table, template_skel, atlas, csvout, skel)
+    step_done(step)
 
-    skel_nii        the nifty image to be overlayed in magenta (i.e. "FAskel.nii.gz")
-    overlay_png_path     the name of the output (output.png)
+def run_roi_average(csvin, csvout, step = 'average'):
+    '''
+    average the ROI table into the bilateral and composite tracts
+    (in process, replaces the call to averageSubjectTracts_exe)
     '''
-    if display_mode=="x":
-        cut_coords = [-36, -16, 2, 10, 42]
-    if display_mode=="y":
-        cut_coords = [-40, -20, -10, 0, 10, 20]
-    if display_mode=="z":
-        cut_coords = [-4, 2, 8, 12, 20, 40]
-
-    nilearn.plotting.plot_img(skel_nii, 
-        bg_img = skel_nii.replace("skel", "_to_target"),
-        threshold = 0.000001, 
-        display_mode = display_mode,
-        cut_coords = cut_coords, 
-        cmap = "Oranges", 
-        colorbar = True,
-        output_file = overlay_png_path)
+    ## the tract definitions are part of the step, so changing them reruns it
+    params = {'dropped': enigma_roi.DROPPED_ROIS, 'combinations': enigma_roi.TRACT_COMBINATIONS}
+    if not step_needed(step, [csvin], [csvout], params):
+        return
+    if DEBUG: print(' '.join(['enigma_roi.py', 'average', csvin, csvout]))
+    if not DRYRUN:
+        enigma_roi.average_subject_tracts(csvin, csvout)
+    step_done(step)
 
+def run_overlay_skel(skel, overlay_png_path, step = 'QC'):
+    '''
+    make the skeleton QC image (see enigma_qc.overlay_skel)
+    '''
+    ## the renderer is part of the step, so switching renderers redraws the image
+    params = {'renderer': QC_RENDERER}
+    if not step_needed(step, [skel, enigma_qc.background_path(skel)], [overlay_png_path], params):
+        return
+    if not DRYRUN:
+        enigma_qc.overlay_skel(skel_nii = skel,
+                    overlay_png_path = overlay_png_path,
+                    renderer = QC_RENDERER)
+    step_done(step)
 
 def main():
 
     global DEBUG
     global DRYRUN
+    global RERUN_ALL
+    global RETRIES
+    global QC_RENDERER
+    global TRACE
+    global OUTPUTDIR
 
     global ENIGMAHOME
     global ENIGMAREPO
@@ -177,11 +372,21 @@ def main():
     FAmap           = arguments['<FAmap>']
     CALC_MD         = arguments['--calc-MD']
     CALC_ALL        = arguments['--calc-all']
+    BATCH_WARP      = arguments['--batch-warp']
+    RECALC_MD       = arguments['--recalc-MD']
+    RERUN_ALL       = arguments['--rerun-all']
+    n_jobs          = arguments['--n-jobs']
+    retries         = arguments['--retries']
+    qc_renderer     = arguments['--qc-renderer']
     VERBOSE         = arguments['--verbose']
     DEBUG           = arguments['--debug']
     DRYRUN          = arguments['--dry-run']
+    RETRIES         = 0 if retries == None else int(retries)
+    QC_RENDERER     = 'nilearn' if qc_renderer == None else qc_renderer
 
     if DEBUG: print(arguments)
+    if QC_RENDERER not in enigma_qc.RENDERERS:
+        sys.exit("--qc-renderer must be one of {}".format(', '.join(enigma_qc.RENDERERS)))
 
     ENIGMAREPO = os.path.dirname(os.path.realpath(__file__))
 
@@ -208,20 +413,26 @@ def main():
         sys.exit("Input file {} doesn't exist.".format(FAmap))
     
     # check that the input MD map exists - if MD CALC chosen
-    if CALC_MD | CALC_ALL:
+    if (CALC_MD | CALC_ALL) and not RECALC_MD:
         MDmap = FAmap.replace('FA.nii.gz','MD.nii.gz')
         if os.path.isfile(MDmap) == False:
             sys.exit("Input file {} doesn't exist.".format(MDmap))
     # check that the input L1, L2, and L3 maps exists - if CALC_ALL chosen
     
-    if CALC_ALL:
+    if CALC_ALL | ((CALC_MD | CALC_ALL) and RECALC_MD):
         for L in ['L1.nii.gz','L2.nii.gz','L3.nii.gz']:
             Lmap = FAmap.replace('FA.nii.gz', L)
             if os.path.isfile(Lmap) == False:
                 sys.exit("Input file {} doesn't exist.".format(Lmap))
 
     # make some output directories
+    ## (absolute paths - the steps run after the cd into outputdir, and their records hold these paths)
     outputdir = os.path.abspath(outputdir)
+    FAmap = os.path.abspath(FAmap)
+    OUTPUTDIR = outputdir
+    if not DRYRUN:
+        TRACE = enigma_trace.trace_path(outputdir)
+    run_start = enigma_trace.snapshot()
 
     ## These are the links to some templates and settings from enigma
     skel_thresh = 0.049
@@ -236,13 +447,19 @@ def main():
     csvout1 = os.path.join(ROIoutdir, image_noext + '_FAskel_ROIout')
     csvout2 = os.path.join(ROIoutdir, image_noext + '_FAskel_ROIout_avg')
     FAskel = os.path.join(outputdir,'FA', image_noext + '_FAskel.nii.gz')
+    FAtarget = os.path.join(outputdir,'FA', image_noext + '_FA_to_target.nii.gz')
+    FAdir = os.path.join(outputdir, 'FA')
+    FAtoFA = os.path.join(FAdir, image_noext + '_FA.nii.gz')
+    FAmask = os.path.join(FAdir, image_noext + '_FA_mask.nii.gz')
+    FAwarp = os.path.join(FAdir, image_noext + '_FA_to_target_warp.nii.gz')
+    target = os.path.join(FAdir, 'target.nii.gz')
+    FAproj = os.path.join(FAdir, image_noext + '_FA_projection_index.nii.gz')
     ###############################################################################
     ## setting up
     ## if teh outputfile is not inside the outputdir than copy is there
-    outdir_niis = glob.glob(outputdir + '/*.nii.gz') + glob.glob(outputdir + '*.nii')
-    if len(outdir_niis) == 0:
-        docmd(['cp',FAmap,os.path.join(outputdir,FAimage)])
-    else:
+    ## (a rerun of the same FA image is fine - its finished steps are skipped)
+    outdir_niis = glob.glob(outputdir + '/*.nii.gz') + glob.glob(outputdir + '/*.nii')
+    if len([f for f in outdir_niis if os.path.basename(f) != FAimage]) > 0:
         # if more than one FA image is present in outputdir...we have a problem.
         sys.exit("Ouputdir already contains nii images..bad news..exiting")
 
@@ -251,63 +468,112 @@ def main():
     os.putenv('SGE_ON','false')
     ###############################################################################
     print("TBSS STEP 1")
-
-    docmd([os.path.join(ENIGMAREPO,'tbss_1_preproc_noqa.sh'), FAimage])
+    ## the python version of tbss_1_preproc_noqa.sh
+    if step_needed('preproc', [FAmap], [FAtoFA, FAmask, os.path.join(outputdir, 'origdata', FAimage)]):
+        docmd(['cp',FAmap,os.path.join(outputdir,FAimage)])
+        if DEBUG: print(' '.join(['enigma_tbss.py', 'preproc', FAimage]))
+        if not DRYRUN:
+            enigma_tbss.tbss_1_preproc(FAimage)
+        step_done('preproc')
 
     ###############################################################################
     print("TBSS STEP 2")
-    docmd(['tbss_2_reg', '-t', os.path.join(ENIGMAHOME,'ENIGMA_DTI_FA.nii.gz')])
+    template = os.path.join(ENIGMAHOME,'ENIGMA_DTI_FA.nii.gz')
+    if step_needed('reg', [FAtoFA, FAmask, template], [FAwarp, target], {'target': template}):
+        docmd(['tbss_2_reg', '-t', template])
+        step_done('reg')
 
     ###############################################################################
     print("TBSS STEP 3")
-    docmd(['tbss_3_postreg','-S'])
+    if step_needed('postreg', [FAtoFA, FAwarp, target], [FAtarget], {'postreg': '-S'}):
+        docmd(['tbss_3_postreg','-S'])
+        step_done('postreg')
 
     ###############################################################################
     print("Skeletonize...")
     # Note many of the options for this are printed at the top of this script
-    docmd(['tbss_skeleton', \
-        '-i', tbss_skeleton_input, \
-        '-s', tbss_skeleton_alt, \
-        '-p', str(skel_thresh), distancemap, search_rule_mask,
-        'FA/' + image_noext + '_FA_to_target.nii.gz',
-        FAskel])
-
-    ###############################################################################
-    print("Convert skeleton datatype to 'float'...")
-    docmd(['fslmaths', FAskel, '-mul', '1', FAskel, '-odt', 'float'])
+    skeleton_inputs = [tbss_skeleton_input, tbss_skeleton_alt, distancemap, search_rule_mask]
+    if step_needed('skeletonize', skeleton_inputs + [FAtarget], [FAskel, FAproj], skeleton_params()):
+        docmd(['tbss_skeleton', \
+            '-i', tbss_skeleton_input, \
+            '-s', tbss_skeleton_alt, \
+            '-p', str(skel_thresh), distancemap, search_rule_mask,
+            FAtarget,
+            FAskel])
+
+        ###############################################################################
+        print("Convert skeleton datatype to 'float'...")
+        docmd(['fslmaths', FAskel, '-mul', '1', FAskel, '-odt', 'float'])
+
+        ###############################################################################
+        print("Record the skeleton projection...")
+        ## run tbss_skeleton once (with the same inputs run_non_FA would use) projecting
+        ## the voxel indices, so that the other metrics can be skeletonized by indexing
+        voxel_index = os.path.join(outputdir, 'FA', image_noext + '_FA_voxel_index.nii.gz')
+        if DEBUG: print(' '.join(['enigma_tbss.py', 'voxel-index', FAtarget, voxel_index]))
+        if not DRYRUN:
+            enigma_tbss.write_voxel_index(FAtarget, voxel_index)
+        docmd(['tbss_skeleton', \
+            '-i', tbss_skeleton_input, \
+            '-s', tbss_skeleton_alt, \
+            '-p', str(skel_thresh), distancemap, search_rule_mask,
+            FAskel, FAproj, '-a', voxel_index])
+        docmd(['rm', voxel_index])
+        step_done('skeletonize')
 
     ###############################################################################
     print("ROI part 1...")
-    ## note - right now this uses the _exe for ENIGMA - can probably rewrite this with nibabel
-    docmd([os.path.join(ENIGMAROI,'singleSubjROI_exe'),
-            os.path.join(ENIGMAROI,'ENIGMA_look_up_table.txt'), \
-            os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA_skeleton.nii.gz'), \
-            os.path.join(ENIGMAROI, 'JHU-WhiteMatter-labels-1mm.nii'), \
-            csvout1, FAskel])
+    run_roi_extract(csvout1, FAskel)
 
     ###############################################################################
     ## part 2 - loop through all subjects to create ROI file
     ##			removing ROIs not of interest and averaging others
-    ##          note: also using the _exe files to do this at the moment
     print("ROI part 2...")
-    docmd([os.path.join(ENIGMAROI, 'averageSubjectTracts_exe'), csvout1 + '.csv', csvout2 + '.csv'])
+    run_roi_average(csvout1 + '.csv', csvout2 + '.csv')
 
-    if not DRYRUN:
-        overlay_skel(skel_nii = FAskel, 
-                    overlay_png_path = FAskel.replace(".nii.gz", ".png"))
+    run_overlay_skel(FAskel, FAskel.replace(".nii.gz", ".png"))
 
     ## run the pipeline for MD - if asked
+    ## and for AD and RD - if asked
+    non_FA_tags = []
     if CALC_MD | CALC_ALL:
-        run_non_FA('MD', outputdir, FAmap, FAskel)
-
-    ## run the pipeline for AD and RD - if asked
+        non_FA_tags.append('MD')
     if CALC_ALL:
-        run_non_FA('AD', outputdir, FAmap, FAskel)
-        run_non_FA('RD', outputdir, FAmap, FAskel)
+        non_FA_tags += ['AD', 'RD']
+
+    if BATCH_WARP and len(non_FA_tags) > 0:
+        print("Warping {}...".format(', '.join(non_FA_tags)))
+        warp_non_FA_batch(non_FA_tags, outputdir, FAmap, RECALC_MD)
+    elif len(non_FA_tags) > 0:
+        print("Masking {}...".format(', '.join(non_FA_tags)))
+        masked = [os.path.join(outputdir, DTItag, image_noext + '_' + DTItag + '.nii.gz')
+                  for DTItag in non_FA_tags]
+        if step_needed('mask', dtifit_inputs(FAmap, non_FA_tags, RECALC_MD) + [FAmask], masked,
+                       {'maps': non_FA_tags, 'recalc_MD': RECALC_MD}):
+            mask_non_FA(non_FA_tags, outputdir, FAmap, RECALC_MD)
+            step_done('mask')
+
+    n_jobs = 1 if n_jobs == None else int(n_jobs)
+    branch_settings = {name: globals()[name] for name in BRANCH_GLOBALS}
+    try:
+        enigma_exec.run_branches(run_non_FA,
+            [(DTItag, (DTItag, outputdir, FAmap, FAskel), {'warped': BATCH_WARP}) for DTItag in non_FA_tags],
+            n_jobs, initializer = init_branch_worker, initargs = (branch_settings,))
+    except enigma_exec.BranchError as e:
+        sys.exit("The {} branch(es) failed".format(', '.join(e.failed)))
 
     ###############################################################################
     os.putenv('SGE_ON','true')
+    if TRACE != None:
+        ## the peak memory of the run is the largest of its steps and commands (in every branch)
+        this_run = [line for line in enigma_trace.read_trace(TRACE) if line['run_id'] == enigma_trace.RUN_ID]
+        enigma_trace.write_line(TRACE, enigma_trace.since(run_start, 'run', os.path.basename(__file__),
+                                                          commands = this_run))
     print("Done !!")
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    finally:
+        ## nothing is left running when main finishes, so this only removes the outputs of a failed step
+        remove_partial_outputs()
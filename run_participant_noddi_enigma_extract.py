@@ -13,6 +13,10 @@ Arguments:
     --session <string>        BIDS session id
 
 Options:
+  --batch-warp             Mask and warp OD, ISOVF and ICVF together in one applywarp call
+  --n-jobs N               Number of the OD, ISOVF and ICVF branches to run at the same time (default = 1)
+  --retries N              Retry a failed FSL command up to N times (default = 0)
+  --qc-renderer NAME       Draw the QC images with nilearn or numpy (see enigma_qc.py) (default = nilearn)
   -v,--verbose             Verbose logging
   --debug                  Debug logging in Erin's very verbose style
   -n,--dry-run             Dry run
@@ -20,29 +24,53 @@ Options:
 
 DETAILS
 Requires that both enigma DTI and AMICO NODDI has already been run
+With "--batch-warp" the NODDI maps are stacked into one 4D image and masked and
+warped with a single applywarp call (instead of one fslmaths and applywarp per map).
+The OD, ISOVF and ICVF branches each write to their own folder (and their own
+files in ROI/), so with "--n-jobs" they are run at the same time, in separate processes.
+If a branch fails the others still finish, then the script exits with an error.
+The fslreorient2std calls are also run at the same time (up to "--n-jobs").
+If an FSL command fails (exits with a non zero code) the run stops right away.
 """
 
 from docopt import docopt
 import pandas as pd
-import nilearn.plotting
 import glob
 import os
 import sys
-import subprocess
+import enigma_exec
+import enigma_qc
+import enigma_roi
+import enigma_tbss
+import enigma_trace
 
 DRYRUN = False
 DEBUG = False
+RETRIES = 0
+QC_RENDERER = 'nilearn'
+TRACE = None
+
+## the globals the NODDI branches need (set in main, and in each branch worker)
+BRANCH_GLOBALS = ['DEBUG', 'DRYRUN', 'RETRIES', 'QC_RENDERER', 'TRACE', 'ENIGMAHOME', 'FSLDIR', 'ENIGMAREPO', 'ENIGMAROI']
+
+def init_branch_worker(settings):
+    '''
+    set this scripts globals in a worker process (see enigma_exec.run_branches)
+    '''
+    globals().update(settings)
 
 ### Erin's little function for running things in the shell
 def docmd(cmdlist):
-    "sends a command (inputed as a list) to the shell"
-    if DEBUG: print(' '.join(cmdlist))
-    if not DRYRUN: subprocess.call(cmdlist)
+    "sends a command (inputed as a list) to the shell, stops the run if it fails"
+    enigma_exec.docmd(cmdlist, debug = DEBUG, dryrun = DRYRUN, retries = RETRIES, trace = TRACE)
 		
 ##############################################################################
 
 def fsl2std_noddi_output(NODDItag, noddi_dir, outputdir, subject, session):
-    'convert the noddi output to enigma input with fslreorient2std'
+    '''
+    make the origdata folder and return the fslreorient2std command (a list)
+    that converts the noddi output to enigma input
+    '''
 	
     if session:
         image_i = os.path.join(noddi_dir, subject, session,"dwi", 
@@ -63,16 +91,14 @@ def fsl2std_noddi_output(NODDItag, noddi_dir, outputdir, subject, session):
                                     subject, NODDItag, 
                                     'origdata')])
 		
-	# actually run the fslreoiient2std bit
-    docmd(['fslreorient2std',image_i,image_o])
+	# the fslreorient2std bit (run by main)
+    return ['fslreorient2std',image_i,image_o]
 	
-## Now process the MD if that option was asked for
-## if processing MD also set up for MD-ness
-def run_non_FA(NODDItag, outputdir, enigmadir, subject, session):
+def noddi_paths(outputdir, enigmadir, subject, session):
     """
-    The Pipeline to run to extract non-FA values (MD, AD or RD)
+    Returns the subjects output directory, the stem of the noddi images,
+    and the FA directory and FA stem from the enigma outputs
     """
-     
     if session:
         O_dir = os.path.join(outputdir, 
 						 '{}_{}'.format(subject,session))
@@ -87,6 +113,52 @@ def run_non_FA(NODDItag, outputdir, enigmadir, subject, session):
         FA_dir = os.path.join(enigmadir, 
 							 subject, "FA")
         FA_stem = "{}_space-T1w_desc-dtifit_FA".format(subject)
+    return O_dir, noddi_stem, FA_dir, FA_stem
+
+def warp_noddi_batch(NODDItags, outputdir, enigmadir, subject, session):
+    """
+    Mask and warp all the NODDI images in one go,
+    by stacking them into a 4D image for a single applywarp call.
+    Writes the same <NODDItag>/*_<NODDItag>_to_target.nii.gz images as run_non_FA
+    """
+    O_dir, noddi_stem, FA_dir, FA_stem = noddi_paths(outputdir, enigmadir, subject, session)
+    origdata = [os.path.join(O_dir, NODDItag, 'origdata', noddi_stem + NODDItag + ".nii.gz")
+                for NODDItag in NODDItags]
+    to_targets = [os.path.join(O_dir, NODDItag, noddi_stem + NODDItag + '_to_target.nii.gz')
+                  for NODDItag in NODDItags]
+
+    tmpdir = os.path.join(O_dir, 'tmp_warp')
+    docmd(['mkdir', '-p', tmpdir])
+    stack = os.path.join(tmpdir, noddi_stem + 'stack.nii.gz')
+    stack_to_target = os.path.join(tmpdir, noddi_stem + 'stack_to_target.nii.gz')
+
+    ## mask with subjects FA mask
+    FAmask = os.path.join(FA_dir, FA_stem + '_mask.nii.gz')
+    if DEBUG: print(' '.join(['enigma_tbss.py', 'stack', FAmask, stack] + origdata))
+    if not DRYRUN:
+        enigma_tbss.stack_masked(origdata, FAmask, stack)
+
+    # applywarp calculated for FA map (once for all the images)
+    docmd(['applywarp', '-i', stack, \
+        '-o', stack_to_target, \
+        '-r', os.path.join(FA_dir, 'target'),\
+        '-w', os.path.join(FA_dir, FA_stem + '_to_target_warp.nii.gz')])
+
+    if DEBUG: print(' '.join(['enigma_tbss.py', 'split', stack_to_target] + to_targets))
+    if not DRYRUN:
+        enigma_tbss.split_volumes(stack_to_target, to_targets)
+    docmd(['rm', '-r', tmpdir])
+
+## Now process the MD if that option was asked for
+## if processing MD also set up for MD-ness
+def run_non_FA(NODDItag, outputdir, enigmadir, subject, session, warped = False):
+    """
+    The Pipeline to run to extract non-FA values (MD, AD or RD)
+    If warped is True, the _to_target image was already made by warp_noddi_batch
+    """
+    start = enigma_trace.snapshot()
+    first_command = len(enigma_exec.COMMAND_LOG)
+    O_dir, noddi_stem, FA_dir, FA_stem = noddi_paths(outputdir, enigmadir, subject, session)
 
     masked =    os.path.join(O_dir, NODDItag, noddi_stem + NODDItag + '.nii.gz')
     to_target = os.path.join(O_dir, NODDItag, noddi_stem + NODDItag + '_to_target.nii.gz')
@@ -95,75 +167,81 @@ def run_non_FA(NODDItag, outputdir, enigmadir, subject, session):
     csvout1 =   os.path.join(O_dir, 'ROI', noddi_stem  + NODDItag + 'skel_ROIout')
     csvout2 =   os.path.join(O_dir, 'ROI', noddi_stem + NODDItag + 'skel_ROIout_avg')
 
-    ## mask with subjects FA mask
-    docmd(['fslmaths', 
-		   os.path.join(O_dir, NODDItag, 'origdata', 
-						noddi_stem + NODDItag + ".nii.gz"),
-		   '-mas', \
-		   os.path.join(FA_dir, FA_stem + '_mask.nii.gz'), \
-      masked])
-
-    # applywarp calculated for FA map
-    docmd(['applywarp', '-i', masked, \
-        '-o', to_target, \
-        '-r', os.path.join(FA_dir, 'target'),\
-        '-w', os.path.join(FA_dir, FA_stem + '_to_target_warp.nii.gz')])
+    if not warped:
+        ## mask with subjects FA mask
+        docmd(['fslmaths', 
+               os.path.join(O_dir, NODDItag, 'origdata', 
+                            noddi_stem + NODDItag + ".nii.gz"),
+               '-mas', \
+               os.path.join(FA_dir, FA_stem + '_mask.nii.gz'), \
+          masked])
 
-    ## tbss_skeleton step
-    skel_thresh = 0.049
-    docmd(['tbss_skeleton', \
-          '-i', os.path.join(ENIGMAHOME,'ENIGMA_DTI_FA.nii.gz'), \
-          '-s', os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA_skeleton_mask.nii.gz'), \
-          '-p', str(skel_thresh),
-		   os.path.join(ENIGMAHOME,'ENIGMA_DTI_FA_skeleton_mask_dst.nii.gz'),
-		   os.path.join(FSLDIR,'data','standard','LowerCingulum_1mm.nii.gz'),
-           os.path.join(FA_dir, FA_stem +'skel.nii.gz'),
-           skel, 
-           '-a', to_target])
+        # applywarp calculated for FA map
+        docmd(['applywarp', '-i', masked, \
+            '-o', to_target, \
+            '-r', os.path.join(FA_dir, 'target'),\
+            '-w', os.path.join(FA_dir, FA_stem + '_to_target_warp.nii.gz')])
+
+    ## tbss_skeleton step - reuse the projection recorded by the enigma run if it has one
+    FAproj = os.path.join(FA_dir, FA_stem + '_projection_index.nii.gz')
+    if os.path.isfile(FAproj):
+        if DEBUG: print(' '.join(['enigma_tbss.py', 'skeletonize', FAproj, to_target, skel]))
+        if not DRYRUN:
+            enigma_tbss.skeletonize_from_projection(FAproj, to_target, skel)
+    else:
+        skel_thresh = 0.049
+        docmd(['tbss_skeleton', \
+              '-i', os.path.join(ENIGMAHOME,'ENIGMA_DTI_FA.nii.gz'), \
+              '-s', os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA_skeleton_mask.nii.gz'), \
+              '-p', str(skel_thresh),
+               os.path.join(ENIGMAHOME,'ENIGMA_DTI_FA_skeleton_mask_dst.nii.gz'),
+               os.path.join(FSLDIR,'data','standard','LowerCingulum_1mm.nii.gz'),
+               os.path.join(FA_dir, FA_stem +'skel.nii.gz'),
+               skel, 
+               '-a', to_target])
 
     ## ROI extract
-    docmd([os.path.join(ENIGMAROI,'singleSubjROI_exe'),
-              os.path.join(ENIGMAROI,'ENIGMA_look_up_table.txt'), \
-              os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA_skeleton.nii.gz'), \
-              os.path.join(ENIGMAROI, 'JHU-WhiteMatter-labels-1mm.nii.gz'), \
-              csvout1, skel])
+    run_roi_extract(csvout1, skel)
 
     ## ROI average
-    docmd([os.path.join(ENIGMAROI, 'averageSubjectTracts_exe'), csvout1 + '.csv', csvout2 + '.csv'])
+    run_roi_average(csvout1 + '.csv', csvout2 + '.csv')
 
     if not DRYRUN:
-         overlay_skel(skel_nii = skel, 
-                      overlay_png_path = skelqa)
+         enigma_qc.overlay_skel(skel_nii = skel,
+                      overlay_png_path = skelqa,
+                      renderer = QC_RENDERER)
 
-def overlay_skel(skel_nii, overlay_png_path, display_mode = "z"):
+    enigma_trace.write_line(TRACE, enigma_trace.since(start, 'step', NODDItag,
+                                                      commands = enigma_exec.COMMAND_LOG[first_command:]))
+
+def run_roi_extract(csvout, skel):
+    '''
+    extract the ROI values from a skeleton image into <csvout>.csv
+    (in process, replaces the call to singleSubjROI_exe)
     '''
-    create an overlay image montage of
-    skel_nii image in orange on top of the background_nii
-    Uses nilearn plotting
+    lookup_table = os.path.join(ENIGMAROI,'ENIGMA_look_up_table.txt')
+    template_skel = os.path.join(ENIGMAHOME, 'ENIGMA_DTI_FA_skeleton.nii.gz')
+    atlas = os.path.join(ENIGMAROI, 'JHU-WhiteMatter-labels-1mm.nii.gz')
+    if DEBUG: print(' '.join(['enigma_roi.py', 'extract', lookup_table, template_skel, atlas, csvout, skel]))
+    if not DRYRUN:
+        enigma_roi.extract_roi(lookup_table, template_skel, atlas, csvout, skel)
 
-    skel_nii        the nifty image to be overlayed in magenta (i.e. "FAskel.nii.gz")
-    overlay_png_path     the name of the output (output.png)
+def run_roi_average(csvin, csvout):
     '''
-    if display_mode=="x":
-        cut_coords = [-36, -16, 2, 10, 42]
-    if display_mode=="y":
-        cut_coords = [-40, -20, -10, 0, 10, 20]
-    if display_mode=="z":
-        cut_coords = [-4, 2, 8, 12, 20, 40]
-
-    nilearn.plotting.plot_img(skel_nii, 
-        bg_img = skel_nii.replace("skel", "_to_target"),
-        threshold = 0.000001, 
-        display_mode = display_mode,
-        cut_coords = cut_coords, 
-        cmap = "Oranges", 
-        colorbar = True,
-        output_file = overlay_png_path)
+    average the ROI table into the bilateral and composite tracts
+    (in process, replaces the call to averageSubjectTracts_exe)
+    '''
+    if DEBUG: print(' '.join(['enigma_roi.py', 'average', csvin, csvout]))
+    if not DRYRUN:
+        enigma_roi.average_subject_tracts(csvin, csvout)
 
 def main():
 
     global DEBUG
     global DRYRUN
+    global RETRIES
+    global QC_RENDERER
+    global TRACE
 
     global ENIGMAHOME
     global FSLDIR
@@ -182,10 +260,19 @@ def main():
     enigma_outputdir  = arguments['--enigma_outputdir']
     subject         = arguments['--subject']
     session         = arguments['--session']
+    BATCH_WARP      = arguments['--batch-warp']
+    n_jobs          = arguments['--n-jobs']
+    retries         = arguments['--retries']
+    qc_renderer     = arguments['--qc-renderer']
     DEBUG           = arguments['--debug']
     DRYRUN          = arguments['--dry-run']
+    RETRIES         = 0 if retries == None else int(retries)
+    QC_RENDERER     = 'nilearn' if qc_renderer == None else qc_renderer
+    n_jobs          = 1 if n_jobs == None else int(n_jobs)
 
     if DEBUG: print(arguments)
+    if QC_RENDERER not in enigma_qc.RENDERERS:
+        sys.exit("--qc-renderer must be one of {}".format(', '.join(enigma_qc.RENDERERS)))
 
     ENIGMAREPO = os.path.dirname(os.path.realpath(__file__))
     
@@ -219,20 +306,47 @@ def main():
     else:
         ROIoutdir = os.path.join(outputdir, subject, 'ROI')
     docmd(["mkdir", "-p", ROIoutdir])
+    if not DRYRUN:
+        TRACE = enigma_trace.trace_path(os.path.dirname(ROIoutdir))
+    run_start = enigma_trace.snapshot()
 		
-    for nodditag in ["OD", "ISOVF", "ICVF"]:
-        fsl2std_noddi_output(NODDItag = nodditag, 
-                             noddi_dir = noddi_outputdir, 
-                             outputdir = outputdir, 
-                             subject = subject, 
-                             session = session)
-		 
-        run_non_FA(NODDItag = nodditag, 
-                   outputdir = outputdir, 
-                   enigmadir = enigma_outputdir, 
-                   subject = subject, 
-                   session = session)
-	
+    nodditags = ["OD", "ISOVF", "ICVF"]
+    reorient_cmds = []
+    for nodditag in nodditags:
+        reorient_cmds.append(enigma_exec.Command(nodditag,
+                             fsl2std_noddi_output(NODDItag = nodditag, 
+                                                  noddi_dir = noddi_outputdir, 
+                                                  outputdir = outputdir, 
+                                                  subject = subject, 
+                                                  session = session), []))
+    enigma_exec.run_commands(reorient_cmds, n_jobs, retries = RETRIES, debug = DEBUG, dryrun = DRYRUN,
+                             trace = TRACE)
+
+    if BATCH_WARP:
+        print("Warping {}...".format(', '.join(nodditags)))
+        warp_noddi_batch(NODDItags = nodditags,
+                         outputdir = outputdir,
+                         enigmadir = enigma_outputdir,
+                         subject = subject,
+                         session = session)
+
+    branch_settings = {name: globals()[name] for name in BRANCH_GLOBALS}
+    branches = [(nodditag, (), {'NODDItag': nodditag,
+                                'outputdir': outputdir,
+                                'enigmadir': enigma_outputdir,
+                                'subject': subject,
+                                'session': session,
+                                'warped': BATCH_WARP}) for nodditag in nodditags]
+    try:
+        enigma_exec.run_branches(run_non_FA, branches, n_jobs,
+                                 initializer = init_branch_worker, initargs = (branch_settings,))
+    except enigma_exec.BranchError as e:
+        sys.exit("The {} branch(es) failed".format(', '.join(e.failed)))
+
+    if TRACE != None:
+        this_run = [line for line in enigma_trace.read_trace(TRACE) if line['run_id'] == enigma_trace.RUN_ID]
+        enigma_trace.write_line(TRACE, enigma_trace.since(run_start, 'run', os.path.basename(__file__),
+                                                          commands = this_run))
     print("Done !!")
 
 if __name__ == '__main__':